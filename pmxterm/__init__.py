@@ -1,6 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .terminal import TerminalWidget
-from .frontend import Backend, BackendManager
-from .schemes import ColorScheme
+import importlib.util
+
+# Without PyQt only the backend and the benchmarks can be used, errors
+# importing the frontend itself are not hidden
+HAS_QT = any(importlib.util.find_spec(name) is not None
+    for name in ("PyQt5", "PyQt4"))
+
+if HAS_QT:
+    from .terminal import TerminalWidget
+    from .frontend import Backend, BackendManager
+    from .schemes import ColorScheme
@@ -5,6 +5,9 @@ import sys
 
 FS_ENCODING = sys.getfilesystemencoding()
 
+# Scrollback memory budget of a terminal, in bytes
+HISTORY_BYTES = 4 * 1024 * 1024
+
 # VT100 Constants and masks
 
 #modesoff SGR0         Turn off character attributes          ^[[m
@@ -28,4 +31,7 @@ SGR39 = 0x10000000
 # Default background color
 SGR49 = 0x20000000
 
-DEFAULTSGR = SGR39 | SGR49
\ No newline at end of file
+DEFAULTSGR = SGR39 | SGR49
+
+# Colors with this bit are 24-bit 0xRRGGBB values, not palette indexes
+TRUECOLOR = 0x01000000
\ No newline at end of file
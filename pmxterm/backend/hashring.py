@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Consistent hashing, maps keys like session ids to nodes like worker
+# indexes. Every node owns many points of the ring, so keys spread evenly
+# and adding or removing a node only moves the keys of that node.
+# License: GPL2
+
+import bisect
+import hashlib
+
+def _hash(value):
+    # Stable between processes and runs, unlike hash()
+    digest = hashlib.md5(str(value).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+class HashRing(object):
+    def __init__(self, nodes = (), replicas = 128):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash("%s#%d" % (node, replica))
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+            self.owners[point] = node
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = _hash("%s#%d" % (node, replica))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                self.points.remove(point)
+
+    def nodes(self):
+        return sorted(set(self.owners.values()))
+
+    def node(self, key):
+        """The node owning key, the first point after its hash"""
+        if not self.points:
+            raise KeyError(key)
+        index = bisect.bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# Input of the frontends to the bytes a terminal sends. Special keys
+# arrive as "~" and a letter, the sequence sent depends on the modes of
+# the keyboard set by the program. The backend translates the input of
+# proc_write, frontends writing to the pty themselves translate it here
+# with the modes of the last frame.
+# Only the standard library is used, the frontend imports it as well.
+# License: GPL2
+
+ANSI_KEYS = {
+    '~':'~',
+    'A':'\x1b[A',
+    'B':'\x1b[B',
+    'C':'\x1b[C',
+    'D':'\x1b[D',
+    'F':'\x1b[F',
+    'H':'\x1b[H',
+    '1':'\x1b[5~',
+    '2':'\x1b[6~',
+    '3':'\x1b[2~',
+    '4':'\x1b[3~',
+    'a':'\x1bOP',
+    'b':'\x1bOQ',
+    'c':'\x1bOR',
+    'd':'\x1bOS',
+    'e':'\x1b[15~',
+    'f':'\x1b[17~',
+    'g':'\x1b[18~',
+    'h':'\x1b[19~',
+    'i':'\x1b[20~',
+    'j':'\x1b[21~',
+    'k':'\x1b[23~',
+    'l':'\x1b[24~',
+}
+
+# Cursor keys in application mode
+APP_KEYS = dict(ANSI_KEYS, **{
+    'A':'\x1bOA',
+    'B':'\x1bOB',
+    'C':'\x1bOC',
+    'D':'\x1bOD',
+    'F':'\x1bOF',
+    'H':'\x1bOH',
+})
+
+def translate(d, keys, escape = False):
+    """Text of the input d with the keys modes, (cursorkey, backspace,
+    lfnewline), and escape when the last input ended with a "~". Returns
+    the text and the escape for the next input"""
+    cursorkey, backspace, lfnewline = keys
+    if not escape and '~' not in d:
+        # No cursor keys, a paste is translated at once
+        table = {}
+        if backspace:
+            table[127] = 8
+        if lfnewline:
+            table[13] = '\r\n'
+        return (d.translate(table) if table else d), False
+    o = []
+    append = o.append
+    for c in d:
+        char = ord(c)
+        if escape:
+            escape = False
+            try:
+                if cursorkey:
+                    append(APP_KEYS[c])
+                else:
+                    append(ANSI_KEYS[c])
+            except KeyError:
+                pass
+        elif c == '~':
+            escape = True
+        elif char == 127:
+            if backspace:
+                append(chr(8))
+            else:
+                append(chr(127))
+        else:
+            append(c)
+            if lfnewline and char == 13:
+                append(chr(10))
+    return ''.join(o), escape
@@ -11,58 +11,157 @@ import constants
 import socket
 import json
 import queue
+import threading
+import itertools
+import traceback
 
 from multiprocessing import Process, Queue
-from multiprocessing.reduction import recv_handle, send_handle
 from multiplexer import Multiplexer
+from multiplexer.reactor import Reactor
+from notifier import Notifier
+from hashring import HashRing
+from protocol import Connection
 
-queue_multiplexer = Queue()
+# Commands for every multiplexer worker and for any one of them, the
+# others go to the worker owning the session, their first argument
+FANOUT_COMMANDS = ('proc_buryall', 'proc_disconnect', 'proc_stats')
+ANY_COMMANDS = ('setup_channel', 'platform')
+# Seconds a worker has to stop, burying its sessions takes KILL_TIMEOUT
+STOP_TIMEOUT = 5.0
+
+queues_multiplexer = []
 queue_notifier = Queue()
-procs = set()
 shutdown = False
 
 # ===========
 # = Workers =
 # ===========
-def worker_multiplexer(queue_multiplexer, queue_notifier):
+def worker_multiplexer(queue_multiplexer, queue_notifier, settings):
     global shutdown
 
     def debug(*args, **kwargs):
         print(args, kwargs)
 
-    multiplexer = Multiplexer(queue_notifier)
+    multiplexer = Multiplexer(queue_notifier, **settings)
     while not shutdown:
-        pycmd = queue_multiplexer.get()
-        getattr(multiplexer, pycmd["command"], debug)(*pycmd["args"])
+        # Signals are seen between commands
+        try:
+            pycmd = queue_multiplexer.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if pycmd is None:
+            break
+        try:
+            getattr(multiplexer, pycmd["command"], debug)(*pycmd["args"])
+        except Exception:
+            # A bad command fails alone, the sessions go on
+            traceback.print_exc()
+    # The sessions are buried and their processes reaped
+    multiplexer.stop()
 
-def worker_notifier(queue_notifier):
+def worker_notifier(queue_notifier, workers):
     global shutdown
-    
-    channels = {}
+
+    # Messages are taken from the queue by a thread and delivered by
+    # the reactor, that writes to the clients when they can take it
+    reactor = Reactor()
+    notifier = Notifier(reactor, workers)
+
+    def receive():
+        global shutdown
+        while not shutdown:
+            message = queue_notifier.get()
+            if message is None:
+                # Every multiplexer is done
+                shutdown = True
+                reactor.wakeup()
+                break
+            reactor.call_later(0, notifier.message, message)
+
+    thread = threading.Thread(target=receive)
+    thread.daemon = True
+    thread.start()
+    signal.set_wakeup_fd(reactor.wakeup_w)
     while not shutdown:
-        message = queue_notifier.get()
-        if message['cmd'] == 'send':
-            channel = channels[message['channel']]
-            data = json.dumps(message['payload']).encode(constants.FS_ENCODING)
-            channel.send(data)
-        elif message['cmd'] == 'buried_all':
-            for channel in channels.values():
-                channel.close()
-        elif message['cmd'] == 'setup_channel':
-            s = socket.socket(socket.AF_UNIX)
-            s.connect(message['address'])
-            channels[message['channel']] = s
-            
-def worker_client(queue_multiplexer, queue_notifier, sock):
+        reactor.run_once()
+    notifier.close()
+
+def serve_clients(server, queues_multiplexer):
     global shutdown
 
-    _id = sock.fileno()
+    # Every client is read on one reactor, its commands go to the worker
+    # owning the session, their first argument
+    reactor = Reactor()
+    ring = HashRing(range(len(queues_multiplexer)))
+    client_ids = itertools.count(1)
+
+    def route(pycmd):
+        if pycmd["command"] in FANOUT_COMMANDS:
+            for queue_multiplexer in queues_multiplexer:
+                queue_multiplexer.put(pycmd)
+        elif pycmd["command"] in ANY_COMMANDS or len(pycmd["args"]) < 2:
+            queues_multiplexer[0].put(pycmd)
+        else:
+            queues_multiplexer[ring.node(pycmd["args"][1])].put(pycmd)
+
+    def accept():
+        try:
+            conn, address = server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        client = next(client_ids)
+        reactor.add_reader(conn.fileno(), receive, client, conn,
+            Connection(conn.sendall, conn.family == socket.AF_UNIX))
+
+    def receive(client, conn, connection):
+        # Many commands can arrive in one read, and one in many
+        try:
+            data = conn.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (IOError, OSError):
+            data = b""
+        try:
+            if not data:
+                raise EOFError
+            for pycmd in connection.feed(data):
+                pycmd["args"].insert(0, client)
+                route(pycmd)
+        except Exception as error:
+            # Only this client is gone, the others are still served
+            if not isinstance(error, (EOFError, ValueError)):
+                traceback.print_exc()
+            reactor.remove_reader(conn.fileno())
+            conn.close()
+            route({"command": "proc_disconnect", "args": [ client ]})
+
+    server.setblocking(False)
+    reactor.add_reader(server.fileno(), accept)
+    # Signals wake up the reactor to see the shutdown
+    signal.set_wakeup_fd(reactor.wakeup_w)
     while not shutdown:
-        data = sock.recv(4096)
-        print(data)
-        pycmd = json.loads(data.decode(constants.FS_ENCODING))
-        pycmd["args"].insert(0, _id)
-        queue_multiplexer.put(pycmd)
+        reactor.run_once()
+
+def run_asyncio(server, settings):
+    import asyncio
+    from multiplexer import AsyncMultiplexer
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    multiplexer = AsyncMultiplexer(loop, **settings)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    listener = loop.run_until_complete(multiplexer.serve(server))
+    try:
+        loop.run_forever()
+    finally:
+        multiplexer.stop()
+        listener.close()
+        tasks = asyncio.all_tasks(loop)
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+        loop.close()
 
 def get_addresses(args):
     pub_addr = rep_addr = None
@@ -73,14 +172,29 @@ def get_addresses(args):
         return (address, 0)
     return None
 
-# Install singla handler
+def stop_workers(mprocs, nproc):
+    # Multiplexers first, their last messages go through the notifier,
+    # and the queues once nobody uses them
+    for queue_multiplexer in queues_multiplexer:
+        queue_multiplexer.put(None)
+    for proc in mprocs:
+        proc.join(STOP_TIMEOUT)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+    queue_notifier.put(None)
+    nproc.join(STOP_TIMEOUT)
+    if nproc.is_alive():
+        nproc.terminate()
+        nproc.join()
+    for queue_multiplexer in queues_multiplexer:
+        queue_multiplexer.close()
+    queue_notifier.close()
+
+# Install signal handler, every process stops on its own loop
 def signal_handler(signum, frame):
     global shutdown
     shutdown = True
-    queue_multiplexer.close()
-    queue_notifier.close()
-    for proc in procs:
-        proc.terminate()
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
@@ -99,6 +213,22 @@ if __name__ == "__main__":
     parser.add_argument('-p', metavar='<port>', dest='pub_port',
         type=int, help='Port number of the socket'
     )
+    parser.add_argument('-e', metavar='<engine>', dest='engine', type=str,
+        default="process", choices=("process", "asyncio"),
+        help='Run the multiplexer, notifier and clients as "process"es or on one "asyncio" loop'
+    )
+    parser.add_argument('-w', metavar='<workers>', dest='workers', type=int,
+        default=os.cpu_count() or 1, help='Multiplexer processes sharing the sessions, "process" engine only'
+    )
+    parser.add_argument('-s', metavar='<shells>', dest='pool_size', type=int,
+        default=0, help='Shells started ahead for new sessions, per multiplexer'
+    )
+    parser.add_argument('-f', metavar='<rate>', dest='frame_rate', type=int,
+        default=60, help='Screen frames per second of a session at most'
+    )
+    parser.add_argument('-r', metavar='<share>', dest='read_share', type=float,
+        default=0.5, help='Share of the multiplexer a session with bulk output takes while others compete, 0 to not throttle'
+    )
     args = parser.parse_args()
     if args.type == "unix" and args.address is not None:
         parser.print_help()
@@ -113,36 +243,34 @@ if __name__ == "__main__":
     server = socket.socket(args.type == "unix" and socket.AF_UNIX or socket.AF_INET)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
     server.bind(address)
-    server.listen(5)
+    server.listen(socket.SOMAXCONN)
 
     print("To connect a client to this backend, use:")
     print(json.dumps({'address': server.getsockname()}))
     sys.stdout.flush()
+
+    # Settings of every multiplexer
+    settings = { 'pool_size': args.pool_size, 'frame_rate': args.frame_rate,
+        'read_share': args.read_share or None }
+    if args.engine == "asyncio":
+        run_asyncio(server, settings)
+        sys.exit()
     
-    # Start the multiplexer
-    mproc = Process(target=worker_multiplexer,
-        args=(queue_multiplexer, queue_notifier), name="multiplexer"
-    )
-    mproc.start()
-    procs.add(mproc)
+    # Start the multiplexers, sessions are sharded between them
+    mprocs = []
+    for index in range(max(args.workers, 1)):
+        queue_multiplexer = Queue()
+        mproc = Process(target=worker_multiplexer,
+            args=(queue_multiplexer, queue_notifier, settings), name="multiplexer-%d" % index
+        )
+        mproc.start()
+        mprocs.append(mproc)
+        queues_multiplexer.append(queue_multiplexer)
 
     # Start the notifier
     nproc = Process(target=worker_notifier,
-        args=(queue_notifier, ), name="notifier"
+        args=(queue_notifier, len(queues_multiplexer)), name="notifier"
     )
     nproc.start()
-    procs.add(nproc)
-    while not shutdown:
-        try:
-            conn, address = server.accept()
-        except InterruptedError:
-            continue
-
-        # Start the notifier
-        cproc = Process(target=worker_client, 
-            args=(queue_multiplexer, queue_notifier, conn), name="client"
-        )
-        cproc.start()
-        procs.add(cproc)
-        
-        conn.close()
\ No newline at end of file
+    serve_clients(server, queues_multiplexer)
+    stop_workers(mprocs, nproc)
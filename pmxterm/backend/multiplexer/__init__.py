@@ -2,5 +2,6 @@ import sys
 
 if sys.platform.startswith("linux"):
     from .linux import Multiplexer
+    from .aio import AsyncMultiplexer
 elif sys.platform == "win32":
     from .windows import Multiplexer
\ No newline at end of file
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Multiplexer running on an asyncio event loop. Pty reads, client
+# connections and notifier sends share one thread, without the
+# supervisor thread and the queues between processes.
+# License: GPL2
+
+import errno
+import socket
+import asyncio
+import itertools
+import traceback
+
+from multiplexer import linux
+from notifier import Notifier, resolve
+from protocol import Connection
+
+class AsyncNotifier(Notifier):
+    """Notifier on the event loop, the client notifiers are connected
+    by a task and the channel attached once it succeeds"""
+    def setup_channel(self, client, address, capabilities):
+        try:
+            family, sockaddr = resolve(address)
+            sock = socket.socket(family)
+        except (IOError, OSError, ValueError) as error:
+            self.failed(client, address, error)
+            return
+        sock.setblocking(False)
+        self.abort(client)
+        self.connecting[client] = { 'sock': sock, 'address': address,
+            'capabilities': capabilities, 'pending': [],
+            'handle': self.reactor.create_task(self.connect(client, sock, sockaddr)) }
+
+    async def connect(self, client, sock, sockaddr):
+        error = None
+        try:
+            await asyncio.wait_for(self.reactor.sock_connect(sock, sockaddr),
+                self.CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            error = OSError(errno.ETIMEDOUT, "timed out")
+        except (IOError, OSError) as failure:
+            error = failure
+        attempt = self.connecting.get(client)
+        if attempt is None or attempt['sock'] is not sock:
+            return
+        if error is None:
+            self.attach(client, sock)
+        else:
+            self.abort(client)
+            self.failed(client, attempt['address'], error)
+
+class AsyncMultiplexer(linux.Multiplexer):
+    def __init__(self, loop, **kwargs):
+        self.loop = loop
+        self.notifier = AsyncNotifier(loop)
+        self.connections = set()
+        self.client_ids = itertools.count(1)
+        linux.Multiplexer.__init__(self, None, **kwargs)
+
+    def start(self):
+        # The event loop methods are the ones of the reactor
+        self.reactor = self.loop
+
+    def stop(self):
+        self.proc_shutdown()
+        self.notifier.close()
+        for writer in list(self.connections):
+            writer.close()
+
+    # Notifier
+    def _command(self, name, channel, **kwargs):
+        kwargs.update({'cmd': name, 'channel': channel})
+        self.notifier.message(kwargs)
+
+    # Clients
+    def execute(self, client, pycmd):
+        try:
+            getattr(self, pycmd["command"])(client, *pycmd["args"])
+        except Exception:
+            traceback.print_exc()
+
+    async def serve_client(self, reader, writer):
+        client = next(self.client_ids)
+        connection = Connection(writer.write,
+            writer.get_extra_info('socket').family == socket.AF_UNIX)
+        self.connections.add(writer)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for pycmd in connection.feed(data):
+                    self.execute(client, pycmd)
+        except (IOError, OSError, ValueError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+            self.proc_disconnect(client)
+
+    async def serve(self, server):
+        """Accept clients on the listening socket server"""
+        if server.family == socket.AF_UNIX:
+            return await asyncio.start_unix_server(self.serve_client, sock = server)
+        return await asyncio.start_server(self.serve_client, sock = server)
@@ -6,91 +6,214 @@
 
 import sys
 import os
+import errno
 import fcntl
 import threading
 import time
 import termios
 import pty
 import signal
+import socket
 import struct
-import select
-import subprocess
+from multiprocessing.reduction import send_handle
 
+import constants
+import protocol
+import sharedscreen
 from multiplexer import base
+from multiplexer.reactor import Reactor
 from vt100 import Terminal
 
 FS_ENCODING = sys.getfilesystemencoding()
 
+def set_winsize(fd, w, h):
+    # Size of the terminal of a pty, the process is sent a SIGWINCH
+    try:
+        fcntl.ioctl(fd,
+            struct.unpack('i',
+                struct.pack('I', termios.TIOCSWINSZ)
+            )[0],
+            struct.pack("HHHH", h, w, 0, 0))
+    except (IOError, OSError):
+        pass
+
 def synchronized(func):
+    # Hold the registry lock, sessions are only added and removed with it
     def wrapper(self, *args, **kwargs):
-        try:
-            self.lock.acquire()
-        except AttributeError:
-            self.lock = threading.RLock()
-            self.lock.acquire()
-        try:
-            result = func(self, *args, **kwargs)
-        finally:
-            self.lock.release()
-        return result
+        with self.lock:
+            return func(self, *args, **kwargs)
     return wrapper
 
-class ProcessInfo(object):
-    def update(self):
-        processes = [int(entry) for entry in os.listdir("/proc") if entry.isdigit()]
-        parent = {}
-        children = {}
-        commands = {}
-        for pid in processes:
-            with open("/proc/%s/stat" % pid) as f:
-                stat = f.read().split()
-                f.close()
-                cmd = stat[1]
-                ppid = int(stat[3])
-                parent[pid] = ppid
-                children.setdefault(ppid, []).append(pid)
-                commands[pid] = cmd
-        self.parent = parent
-        self.children = children
-        self.commands = commands
-
-    def all_children(self, pid):
-        cl = self.children.get(pid, [])[:]
-        for child_pid in cl:
-            cl.extend(self.children.get(child_pid, []))
-        return cl
-
-    def cwd(self, pid):
+def session_synchronized(func):
+    # Hold the lock of the session named by the sid argument, taken
+    # after the registry lock when both are needed
+    index = func.__code__.co_varnames.index('sid') - 1
+    def wrapper(self, *args, **kwargs):
+        sid = args[index]
+        while True:
+            session = self.session.get(sid)
+            if session is None:
+                return func(self, *args, **kwargs)
+            with session['lock']:
+                # The session could be replaced while waiting
+                if self.session.get(sid) is session:
+                    return func(self, *args, **kwargs)
+    return wrapper
+
+class ProcessInspector(object):
+    """Processes of a session read from /proc, walking down from its
+    leader only, the info of a session is kept for ttl seconds"""
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self.cache = {}
+
+    def scan_children(self, pid):
+        # Without /proc/<pid>/task/<tid>/children every process is read
+        children = []
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/%s/stat" % entry) as f:
+                    stat = f.read()
+            except (IOError, OSError):
+                continue
+            if int(stat[stat.rindex(')') + 2:].split()[1]) == pid:
+                children.append(int(entry))
+        return children
+
+    def children(self, pid):
+        children = []
         try:
-            path = os.readlink("/proc/%s/cwd" % pid)
-        except OSError:
-            return
-        return path
-
-    def info(self, pid):
-        info = {}
-        cwd = self.cwd(pid)
-        if pid in self.commands and cwd:
-            info[pid] = (self.commands[pid], self.cwd(pid))
-            for child_pid in self.children.get(pid, []):
-                if child_pid:
-                    info.update(self.info(child_pid))
+            tasks = os.listdir("/proc/%d/task" % pid)
+        except (IOError, OSError):
+            # The process is gone
+            return children
+        for tid in tasks:
+            try:
+                with open("/proc/%d/task/%s/children" % (pid, tid)) as f:
+                    children.extend(int(child) for child in f.read().split())
+            except FileNotFoundError:
+                if tid == str(pid) and os.path.exists("/proc/%d/task/%s" % (pid, tid)):
+                    # Kernel without CONFIG_PROC_CHILDREN
+                    return self.scan_children(pid)
+            except (IOError, OSError):
+                pass
+        return children
+
+    def process(self, pid):
+        """Command and working directory of a process, None once it is
+        gone"""
+        try:
+            with open("/proc/%d/stat" % pid) as f:
+                stat = f.read()
+            cwd = os.readlink("/proc/%d/cwd" % pid)
+        except (IOError, OSError):
+            return None
+        # The command is in parentheses and can have any character
+        return stat[stat.index('(') + 1:stat.rindex(')')], cwd
+
+    def info(self, pid, fd=None):
+        """Processes under pid, as [pid, command, cwd] lists, and the
+        foreground process group of the pty fd"""
+        now = time.monotonic()
+        cached = self.cache.get(pid)
+        if cached is not None and now - cached[0] < self.ttl:
+            return cached[1]
+        processes = []
+        pids = [ pid ]
+        while pids:
+            current = pids.pop()
+            process = self.process(current)
+            if process is None:
+                continue
+            processes.append([ current, process[0], process[1] ])
+            pids.extend(reversed(self.children(current)))
+        foreground = None
+        if fd is not None:
+            try:
+                pgid = os.tcgetpgrp(fd)
+            except (IOError, OSError):
+                pass
+            else:
+                process = self.process(pgid)
+                foreground = [ pgid, process and process[0] ]
+        info = { 'processes': processes, 'foreground': foreground }
+        self.cache = dict((key, value) for key, value in self.cache.items()
+            if now - value[0] < self.ttl)
+        self.cache[pid] = (now, info)
         return info
 
 class Multiplexer(base.Multiplexer):
-    def __init__(self, queue, cmd=os.environ["SHELL"], env_term = "xterm-color", timeout=60*60*24):
+    # Bytes read from a pty at a time, interactive sessions read all the
+    # output ready, bulk ones a small chunk per reactor turn so that
+    # every ready session gets its turn
+    READ_SIZE = 65536
+    BULK_READ_SIZE = 1024
+    # Seconds after a keystroke a session is interactive
+    INTERACTIVE_TIME = 1.0
+    # Seconds of parsing a bulk session may save up
+    READ_BURST = 0.05
+    # Seconds after a read of another session the sessions compete for
+    # the supervisor thread, longer than a pause
+    CONTENTION_TIME = 0.25
+    # Signals sent to a buried process, the next one when it is still
+    # running after KILL_TIMEOUT seconds
+    KILL_SIGNALS = (signal.SIGTERM, signal.SIGHUP, signal.SIGKILL)
+    KILL_TIMEOUT = 2.0
+    # Seconds between checks of a child without a pidfd
+    REAP_INTERVAL = 0.5
+    # Bytes written to a pty at a time, and queued for it. The clients
+    # are asked to hold their input above WRITE_HIGH until the queue is
+    # down to WRITE_LOW, a write over WRITE_LIMIT is refused
+    WRITE_SIZE = 65536
+    WRITE_HIGH = 1024 * 1024
+    WRITE_LOW = 64 * 1024
+    WRITE_LIMIT = 16 * 1024 * 1024
+    # Seconds a client has to accept the connection passing it a pty
+    DIRECT_TIMEOUT = 1.0
+
+    def __init__(self, queue, cmd=os.environ["SHELL"], env_term = "xterm-color", timeout=60*60*24,
+        history_bytes=constants.HISTORY_BYTES, frame_rate=60, read_share=0.5, pool_size=0):
         
         base.Multiplexer.__init__(self)
-        self.processInfo = ProcessInfo()
+        self.processInspector = ProcessInspector()
 
-        # Sessions
+        # Sessions, each one with its lock
+        self.lock = threading.RLock()
         self.session = {}
+        # Processes not reaped yet, by pid, and the timers of the next
+        # signal for the ones being killed
+        self.children = {}
+        self.kills = {}
         self.queue = queue
         self.cmd = cmd
         self.env_term = env_term
         self.timeout = timeout
+        self.history_bytes = history_bytes
+        # Frames are sent at most frame_rate times a second per session
+        self.frame_interval = 1.0 / frame_rate
+        # Share of the supervisor thread a bulk session may spend parsing
+        # its output, a token bucket of seconds, None to not throttle
+        self.read_share = read_share
+        # Last session read and when, when sessions last competed, and
+        # the last keystroke of any session
+        self.last_read = (None, 0)
+        self.contended = 0
+        self.last_typed = 0
+        self.counters = { 'reads': 0, 'frames': 0, 'coalesced': 0, 'paused': 0 }
+        # Shells running the default command started ahead, adopted by
+        # new sessions, as (pid, fd)
+        self.pool_size = pool_size
+        self.pool = []
+
+        self.start()
+        if self.pool_size:
+            self.reactor.call_later(0, self.proc_prewarm)
 
-        # Supervisor thread
+    def start(self):
+        # Supervisor thread, waits on the session fds and timers
+        self.reactor = Reactor()
         self.signal_stop = 0
         self.thread = threading.Thread(target=self.proc_thread)
         self.thread.start()
@@ -98,60 +221,90 @@ class Multiplexer(base.Multiplexer):
     def stop(self):
         # Stop supervisor thread
         self.signal_stop = 1
+        self.reactor.wakeup()
         self.thread.join()
 
     def _command(self, name, channel, **kwargs):
         kwargs.update({'cmd': name, 'channel': channel})
         self.queue.put(kwargs)
 
-    def setup_channel(self, client, address):
-        self._command('setup_channel', client, address=address)
+    def setup_channel(self, client, address, capabilities=None):
+        self._command('setup_channel', client, address=address,
+            capabilities=capabilities)
 
     def proc_resize(self, sid, w, h):
-        fd = self.session[sid]['fd']
         # Set terminal size
-        try:
-            fcntl.ioctl(fd,
-                struct.unpack('i',
-                    struct.pack('I', termios.TIOCSWINSZ)
-                )[0],
-                struct.pack("HHHH", h, w, 0, 0))
-        except (IOError, OSError):
-            pass
+        set_winsize(self.session[sid]['fd'], w, h)
         self.session[sid]['term'].set_size(w, h)
         self.session[sid]['w'] = w
         self.session[sid]['h'] = h
 
+    @synchronized
+    def proc_disconnect(self, client):
+        """
+        Forget a client gone, its sessions stop sending it frames
+        """
+        for sid in list(self.session.keys()):
+            with self.session[sid]['lock']:
+                self.session[sid]['clients'].discard(client)
+                self.session[sid]['shared'].discard(client)
+                self.session[sid]['frames'].pop(client, None)
+        self._command('close_channel', client)
+
     @synchronized
     def proc_keepalive(self, client, sid, w, h, cmd=None):
         if not sid in self.session:
             # Start a new session
             self.session[sid] = {
                 'state': 'unborn',
-                'term': Terminal(w, h),
+                'lock': threading.RLock(),
+                'term': Terminal(w, h, self.history_bytes),
                 'clients': set([ client ]),
+                'frames': {},
+                'shared': set(),
+                'screen': None,
+                'flushed': 0,
+                'flush': None,
+                'tokens': self.READ_BURST,
+                'refilled': self.reactor.time(),
+                'typed': 0,
+                'paused': None,
+                'output': bytearray(),
+                'writing': False,
+                'held': False,
+                'dropped': 0,
+                'direct': [],
                 'time': time.time(),
                 'w':	w,
                 'h':	h}
             return self.proc_spawn(sid, cmd)
-        elif self.session[sid]['state'] == 'alive':
+        self.proc_refresh(client, sid, w, h)
+
+    @session_synchronized
+    def proc_refresh(self, client, sid, w, h):
+        if self.session[sid]['state'] == 'alive':
             self.session[sid]['time'] = time.time()
             self.session[sid]['clients'].add(client)
             # Update terminal size
             if self.session[sid]['w'] != w or self.session[sid]['h'] != h:
                 self.proc_resize(sid, w, h)
 
-    def proc_spawn(self, sid, cmd=None):
-        # Session
-        self.session[sid]['state'] = 'alive'
-        w, h = self.session[sid]['w'], self.session[sid]['h']
-        # Fork new process
-        try:
-            pid, fd = pty.fork()
-        except (IOError, OSError):
-            self.session[sid]['state'] = 'dead'
+    def proc_fork(self, cmd, w, h):
+        """
+        Start cmd, a program or a list of arguments, on a new pty of w
+        columns and h lines, returns the pid and the pty fd
+        """
+        pid, fd = pty.fork()
         if pid == 0:
-            cmd = cmd or self.cmd
+            # Signals go to this process only, not through the wakeup fd
+            # of an event loop in the parent
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            except ValueError:
+                pass
+            argv = [ cmd ] if isinstance(cmd, str) else list(cmd)
             # Safe way to make it work under BSD and Linux
             try:
                 ls = os.environ['LANG'].split('.')
@@ -160,62 +313,236 @@ class Multiplexer(base.Multiplexer):
             if len(ls) < 2:
                 ls = ['en_US', 'UTF-8']
             try:
+                # The command only inherits the pty
+                os.closerange(3, os.sysconf('SC_OPEN_MAX'))
                 os.putenv('COLUMNS', str(w))
                 os.putenv('LINES', str(h))
                 os.putenv('TERM', self.env_term)
                 os.putenv('PATH', os.environ['PATH'])
                 os.putenv('LANG', ls[0] + '.UTF-8')
-                #os.system(cmd)
-                p = subprocess.Popen(cmd, shell=False)
-                #print "called with subprocess", p.pid
-                child_pid, sts = os.waitpid(p.pid, 0)
-                #print "child_pid", child_pid, sts
+                os.execvp(argv[0], argv)
+            except (IOError, OSError) as error:
+                os.write(2, ("%s: %s\r\n" % (argv[0], error.strerror)).encode(FS_ENCODING, 'replace'))
+            os._exit(127)
+        # Set file control
+        fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        set_winsize(fd, w, h)
+        return pid, fd
+
+    @synchronized
+    def proc_prewarm(self):
+        """
+        Start a shell for the pool, and schedule the next one until the
+        pool is full
+        """
+        if len(self.pool) >= self.pool_size:
+            return
+        try:
+            pid, fd = self.proc_fork(self.cmd, 80, 24)
+        except (IOError, OSError):
+            return
+        self.pool.append((pid, fd))
+        self.proc_watch(None, pid)
+        if len(self.pool) < self.pool_size:
+            self.reactor.call_later(0, self.proc_prewarm)
+
+    def proc_spawn(self, sid, cmd=None):
+        w, h = self.session[sid]['w'], self.session[sid]['h']
+        if cmd is None and self.pool:
+            # Adopt a shell of the pool, its prompt waits in the pty
+            pid, fd = self.pool.pop(0)
+            self.children[pid]['sid'] = sid
+            self.reactor.call_later(0, self.proc_prewarm)
+        else:
+            try:
+                pid, fd = self.proc_fork(cmd or self.cmd, w, h)
             except (IOError, OSError):
-                pass
-            # self.proc_finish(sid)
-            os._exit(0)
+                self.proc_remove(sid)
+                return
+            self.proc_watch(sid, pid)
+        # Store session vars
+        self.session[sid]['state'] = 'alive'
+        self.session[sid]['pid'] = pid
+        self.session[sid]['fd'] = fd
+        self.proc_resize(sid, w, h)
+        # Watch the pty and the session timeout
+        self.reactor.add_reader(fd, self.proc_ready, sid)
+        self.session[sid]['timer'] = self.reactor.call_later(
+            self.timeout, self.proc_expire, sid)
+
+    def proc_watch(self, sid, pid):
+        """
+        Reap the process of a session when it exits, told by its pidfd
+        or checked every REAP_INTERVAL seconds without one
+        """
+        child = self.children[pid] = {
+            'sid': sid,
+            'pidfd': None,
+            'poll': None}
+        try:
+            child['pidfd'] = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            child['poll'] = self.reactor.call_later(
+                self.REAP_INTERVAL, self.proc_reap, pid)
         else:
-            # Store session vars
-            self.session[sid]['pid'] = pid
-            self.session[sid]['fd'] = fd
-            # Set file control
-            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
-            # Set terminal size
-            self.proc_resize(sid, w, h)
-
-    def proc_waitfordeath(self, sid):
+            self.reactor.add_reader(child['pidfd'], self.proc_reap, pid)
+
+    @synchronized
+    def proc_reap(self, pid):
+        """
+        Collect the exit status of a child, and remove its session
+        """
+        child = self.children.get(pid)
+        if child is None:
+            return
         try:
-            os.close(self.session[sid]['fd'])
-        except (KeyError, IOError, OSError):
-            pass
-        if sid in self.session:
-            if 'fd' in self.session[sid]:
-                del self.session[sid]['fd']
+            done, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            done = pid
+        if not done:
+            if child['pidfd'] is None:
+                child['poll'] = self.reactor.call_later(
+                    self.REAP_INTERVAL, self.proc_reap, pid)
+            return
+        del self.children[pid]
+        kill = self.kills.pop(pid, None)
+        if kill is not None:
+            # The group id is free once its processes are gone and may be
+            # taken by another group, what is left of it is killed now
+            kill.cancel()
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except (IOError, OSError):
+                pass
+        if child['pidfd'] is not None:
+            self.reactor.remove_reader(child['pidfd'])
+            os.close(child['pidfd'])
+        if child['poll'] is not None:
+            child['poll'].cancel()
+        sid = child['sid']
+        if sid is None:
+            # A shell of the pool
+            for pid_fd in self.pool:
+                if pid_fd[0] == pid:
+                    self.pool.remove(pid_fd)
+                    os.close(pid_fd[1])
+                    break
+        elif sid in self.session and self.session[sid].get('pid') == pid:
+            self.proc_remove(sid)
+
+    def proc_kill(self, pid, level=0):
+        """
+        Send the signal of the level to the process group of a child, the
+        session leader of its pty, and the next one later while the group
+        has processes
+        """
+        self.kills.pop(pid, None)
         try:
-            os.waitpid(self.session[sid]['pid'], 0)
-        except (KeyError, IOError, OSError):
-            pass
-        if sid in self.session:
-            if 'pid' in self.session[sid]:
-                del self.session[sid]['pid']
-        if sid in self.session:
-            self.session[sid]['state'] = 'dead'
+            os.killpg(pid, self.KILL_SIGNALS[level])
+        except (IOError, OSError):
+            return
+        if level + 1 < len(self.KILL_SIGNALS):
+            self.kills[pid] = self.reactor.call_later(
+                self.KILL_TIMEOUT, self.proc_kill, pid, level + 1)
 
-    def proc_bury(self, client, sid):
-        if self.session[sid]['state'] == 'alive':
+    @synchronized
+    def proc_reapall(self):
+        """
+        Wait for the children left, the ones still running after
+        KILL_TIMEOUT seconds are killed
+        """
+        deadline = time.time() + self.KILL_TIMEOUT
+        for kill in self.kills.values():
+            kill.cancel()
+        self.kills = {}
+        for pid, child in list(self.children.items()):
+            while True:
+                try:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if done:
+                    break
+                if time.time() > deadline:
+                    os.killpg(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.01)
+            if child['pidfd'] is not None:
+                self.reactor.remove_reader(child['pidfd'])
+                os.close(child['pidfd'])
+        self.children = {}
+
+    @synchronized
+    def proc_shutdown(self):
+        """
+        Bury every session and end the shells of the pool
+        """
+        self.proc_buryall(None)
+        self.pool_size = 0
+        for pid, fd in self.pool:
+            os.close(fd)
+            self.proc_kill(pid)
+        self.pool = []
+        self.proc_reapall()
+
+    def proc_hangup(self, sid):
+        """
+        Stop reading from the pty of a session, the session is removed
+        once its process is reaped
+        """
+        session = self.session[sid]
+        session['state'] = 'dead'
+        session['output'] = bytearray()
+        if 'fd' in session:
             try:
-                os.kill(self.session[sid]['pid'], signal.SIGTERM)
-                for _client in self.session[sid]['clients']:
-                    self._command('send', _client, 
-                        payload={
-                            'sid': sid, 
-                            'state': 'dead'}
-                    )
+                self.reactor.remove_reader(session['fd'])
+                if session['writing']:
+                    session['writing'] = False
+                    self.reactor.remove_writer(session['fd'])
+                os.close(session['fd'])
             except (IOError, OSError):
                 pass
-        self.proc_waitfordeath(sid)
-        if sid in self.session:
-            del self.session[sid]
+            del session['fd']
+        if session['paused'] is not None:
+            session['paused'].cancel()
+            session['paused'] = None
+
+    @session_synchronized
+    def proc_remove(self, sid):
+        """
+        Tell the clients the session is dead and forget it, called with
+        the registry lock held
+        """
+        if self.session[sid]['flush'] is not None:
+            # The last output read reaches the clients before the death
+            self.session[sid]['flush'].cancel()
+            self.proc_flush(sid)
+        for client in self.session[sid]['clients']:
+            self._command('send', client,
+                payload={
+                    'sid': sid,
+                    'state': 'dead'}
+            )
+        self.proc_hangup(sid)
+        if 'timer' in self.session[sid]:
+            self.session[sid]['timer'].cancel()
+        if self.session[sid]['screen'] is not None:
+            self.session[sid]['screen'].close()
+        for handoff in self.session[sid]['direct']:
+            self.proc_direct_close(handoff)
+        del self.session[sid]
+
+    @synchronized
+    @session_synchronized
+    def proc_bury(self, client, sid):
+        if sid not in self.session:
+            return
+        # Terminated in the background, a process ignoring the signals
+        # never blocks the multiplexer
+        if 'pid' in self.session[sid]:
+            self.proc_kill(self.session[sid]['pid'])
+        self.proc_remove(sid)
 
     @synchronized
     def proc_buryall(self, client):
@@ -223,7 +550,7 @@ class Multiplexer(base.Multiplexer):
             self.proc_bury(client, sid)
         self._command('buried_all', client)
 
-    @synchronized
+    @session_synchronized
     def proc_read(self, sid):
         """
         Read from process
@@ -232,29 +559,49 @@ class Multiplexer(base.Multiplexer):
             return False
         elif self.session[sid]['state'] != 'alive':
             return False
+        session = self.session[sid]
+        now = self.reactor.time()
+        last_sid, last_time = self.last_read
+        if last_sid != sid and now - last_time < self.CONTENTION_TIME:
+            self.contended = now
+        self.last_read = (sid, now)
+        # A session alone keeps the thread, it is only throttled while
+        # another one has output or was typed into
+        contended = now - self.contended < self.CONTENTION_TIME or \
+            now - self.last_typed < self.INTERACTIVE_TIME
+        bulk = self.read_share is not None and contended and \
+            now - session['typed'] > self.INTERACTIVE_TIME
+        if bulk:
+            session['tokens'] = min(self.READ_BURST,
+                session['tokens'] + (now - session['refilled']) * self.read_share)
+            session['refilled'] = now
         try:
             fd = self.session[sid]['fd']
-            d = os.read(fd, 65536)
+            d = os.read(fd, bulk and self.BULK_READ_SIZE or self.READ_SIZE)
             if not d:
                 # Process finished, BSD
-                self.proc_waitfordeath(sid)
+                self.proc_hangup(sid)
                 return False
+        except BlockingIOError:
+            return False
         except (KeyError, IOError, OSError):
             # Process finished, Linux
-            self.proc_waitfordeath(sid)
+            self.proc_hangup(sid)
             return False
         term = self.session[sid]['term']
         term.write(d)
+        if bulk:
+            # Charged the time spent parsing
+            session['tokens'] -= self.reactor.time() - now
+            if session['tokens'] <= 0:
+                self.proc_pause(sid)
         # Read terminal response
         d = term.read()
         if d:
-            try:
-                os.write(fd, d)
-            except (IOError, OSError):
-                return False
+            self.proc_feed(sid, d)
         return True
 
-    @synchronized
+    @session_synchronized
     def proc_write(self, client, sid, d):
         """
         Write to process
@@ -263,16 +610,116 @@ class Multiplexer(base.Multiplexer):
             return False
         elif self.session[sid]['state'] != 'alive':
             return False
-        try:
-            term = self.session[sid]['term']
-            d = term.pipe(d)
-            fd = self.session[sid]['fd']
-            os.write(fd, d)
-        except (IOError, OSError):
+        d = self.session[sid]['term'].pipe(d)
+        if not self.proc_feed(sid, d):
             return False
+        self.proc_typed(client, sid)
         return True
 
-    @synchronized
+    @session_synchronized
+    def proc_typed(self, client, sid):
+        """
+        Typing makes the session interactive, its output is read at once.
+        Clients writing to the pty themselves send it now and then
+        """
+        if sid not in self.session:
+            return
+        self.session[sid]['typed'] = self.last_typed = self.reactor.time()
+        if self.session[sid]['paused'] is not None:
+            self.session[sid]['paused'].cancel()
+            self.proc_resume(sid)
+
+    def proc_feed(self, sid, d):
+        """
+        Queue bytes for the process, written as the pty takes them
+        """
+        session = self.session[sid]
+        if len(session['output']) + len(d) > self.WRITE_LIMIT:
+            # Counted until the clients are told of the next change
+            session['dropped'] += len(d)
+            self.proc_hold(sid, True)
+            return False
+        session['output'] += d
+        self.proc_drain(sid)
+        if not session['held'] and len(session['output']) > self.WRITE_HIGH:
+            self.proc_hold(sid, True)
+        return True
+
+    @session_synchronized
+    def proc_drain(self, sid):
+        """
+        Write the queued bytes until the pty is full, and again when it
+        is writable
+        """
+        if sid not in self.session or 'fd' not in self.session[sid]:
+            return
+        session = self.session[sid]
+        output = session['output']
+        while output:
+            try:
+                written = os.write(session['fd'], output[:self.WRITE_SIZE])
+            except BlockingIOError:
+                break
+            except (IOError, OSError):
+                # The process is gone, its pty is closed when read
+                del output[:]
+                break
+            del output[:written]
+        if output and not session['writing']:
+            session['writing'] = True
+            self.reactor.add_writer(session['fd'], self.proc_drain, sid)
+        elif not output and session['writing']:
+            session['writing'] = False
+            self.reactor.remove_writer(session['fd'])
+        if session['held'] and len(output) <= self.WRITE_LOW:
+            self.proc_hold(sid, False)
+        if not output and session['direct']:
+            self.proc_handoff(sid)
+
+    def proc_hold(self, sid, held):
+        """
+        Tell the clients to hold or resume their input when it changes,
+        and the bytes of the writes refused since they were last told
+        """
+        session = self.session[sid]
+        if session['held'] == held:
+            return
+        session['held'] = held
+        dropped, session['dropped'] = session['dropped'], 0
+        for client in session['clients']:
+            self._command('send', client,
+                payload={
+                    'sid': sid,
+                    'state': session['state'],
+                    'input': {
+                        'held': held,
+                        'pending': len(session['output']),
+                        'dropped': dropped}}
+            )
+
+    def proc_pause(self, sid):
+        """
+        Stop reading a bulk session out of tokens until the bucket is
+        refilled, the producer blocks when the pty buffer fills up
+        """
+        session = self.session[sid]
+        self.counters['paused'] += 1
+        self.reactor.remove_reader(session['fd'])
+        delay = -session['tokens'] / self.read_share
+        session['paused'] = self.reactor.call_later(delay, self.proc_resume, sid)
+
+    @session_synchronized
+    def proc_resume(self, sid):
+        """
+        Read again from a paused session
+        """
+        if sid not in self.session:
+            return
+        self.session[sid]['paused'] = None
+        if self.session[sid]['state'] == 'alive' and 'fd' in self.session[sid]:
+            self.reactor.add_reader(self.session[sid]['fd'], self.proc_ready, sid)
+
+    @session_synchronized
     def proc_dump(self, client, sid):
         """
         Dump terminal output
@@ -280,57 +727,259 @@ class Multiplexer(base.Multiplexer):
         if sid in self.session:
             return self.session[sid]['term'].dump()
 
+    @session_synchronized
+    def proc_dump_delta(self, client, sid):
+        """
+        Dump terminal rows changed since the last frame sent to the client
+        """
+        if sid in self.session:
+            frames = self.session[sid]['frames']
+            frame = self.session[sid]['term'].dump_delta(frames.get(client, 0))
+            frames[client] = frame['frame']
+            return frame
+
+    @session_synchronized
+    def proc_history(self, client, sid, start, count):
+        """
+        Send a page of scrollback rows
+        """
+        if sid in self.session:
+            self._command('send', client,
+                payload={
+                    'sid': sid,
+                    'state': self.session[sid]['state'],
+                    'history': self.session[sid]['term'].dump_history(start, count)}
+            )
+
     @synchronized
-    def proc_getalive(self):
-        """
-        Get alive sessions, bury timed out ones
-        """
-        fds = []
-        fd2sid = {}
-        now = time.time()
-        for sid in self.session.keys():
-            then = self.session[sid]['time']
-            if (now - then) > self.timeout:
-                for client in self.session[sid]['clients']:
-                    self.proc_bury(client, sid)
+    def proc_expire(self, sid):
+        """
+        Bury the session if it timed out, check again later otherwise
+        """
+        if sid not in self.session:
+            return
+        then = self.session[sid]['time']
+        if (time.time() - then) > self.timeout:
+            self.proc_bury(None, sid)
+        else:
+            self.session[sid]['timer'] = self.reactor.call_later(
+                then + self.timeout - time.time(), self.proc_expire, sid)
+
+    @session_synchronized
+    def proc_ready(self, sid):
+        """
+        Read from a process with output ready and schedule a frame
+        """
+        if self.proc_read(sid) and sid in self.session:
+            self.counters['reads'] += 1
+            self.session[sid]["changed"] = time.time()
+            if self.session[sid]['flush'] is not None:
+                # The frame already scheduled shows this read too
+                self.counters['coalesced'] += 1
+                return
+            due = self.session[sid]['flushed'] + self.frame_interval
+            if due <= self.reactor.time():
+                # Idle for a frame interval, like after typing
+                self.proc_flush(sid)
+            else:
+                self.session[sid]['flush'] = self.reactor.call_at(
+                    due, self.proc_flush, sid)
+
+    @session_synchronized
+    def proc_flush(self, sid):
+        """
+        Send the latest frame to the session clients
+        """
+        if sid not in self.session:
+            return
+        self.session[sid]['flush'] = None
+        self.session[sid]['flushed'] = self.reactor.time()
+        for client in self.session[sid]['clients']:
+            self.counters['frames'] += 1
+            if client in self.session[sid]['shared']:
+                self._command('send', client,
+                    payload={
+                        'sid': sid,
+                        'state': 'alive',
+                        'shared': self.proc_dump_shared(client, sid)}
+                )
             else:
-                if self.session[sid]['state'] == 'alive':
-                    fds.append(self.session[sid]['fd'])
-                    fd2sid[self.session[sid]['fd']] = sid
-        return (fds, fd2sid)
+                self._command('send', client,
+                    payload={
+                        'sid': sid,
+                        'state': 'alive',
+                        'screen': self.proc_dump_delta(client, sid)}
+                )
+
+    @session_synchronized
+    def proc_share(self, client, sid):
+        """
+        Send the screen to the client in a shared memory segment, its
+        frames only have the numbers of the rows to read from it
+        """
+        if sharedscreen.shared_memory is None or sid not in self.session:
+            return
+        elif self.session[sid]['state'] != 'alive':
+            return
+        self.session[sid]['shared'].add(client)
+        # Every row on the first frame
+        self.session[sid]['frames'][client] = 0
+        if self.session[sid]['flush'] is not None:
+            self.session[sid]['flush'].cancel()
+        self.proc_flush(sid)
+
+    @session_synchronized
+    def proc_dump_shared(self, client, sid):
+        """
+        Write the rows changed to the shared screen, and dump the frame
+        of the client without them
+        """
+        session = self.session[sid]
+        term = session['term']
+        screen = session['screen']
+        if screen is None or not screen.fits(term.w, term.h):
+            # The old segment stays mapped by the clients until they
+            # see the name of the new one
+            if screen is not None:
+                screen.close()
+            screen = session['screen'] = sharedscreen.SharedScreen(term.w, term.h)
+        screen.write(term.w, term.h, [ (y, ) + tuple(term.screen[y])
+            for y in range(term.h) if term.row_frame[y] > screen.since ])
+        # Rows changed later are marked with the current frame
+        screen.since = term.frame - 1
+        frame = term.dump_delta(session['frames'].get(client, 0), rows = False)
+        session['frames'][client] = frame['frame']
+        frame['name'] = screen.name
+        return frame
+
+    @session_synchronized
+    def proc_direct(self, client, sid, address):
+        """
+        Pass the pty of the session to the client at the unix socket
+        address, it writes its input there. The backend keeps reading
+        the output and its own fd, the session lives on without the client
+        """
+        if sid not in self.session or self.session[sid]['state'] != 'alive':
+            self.proc_refuse_direct(client, sid)
+            return False
+        # Connected without blocking the sessions, the pty is passed once
+        # the connection is up and the input queued before is written
+        sock = socket.socket(socket.AF_UNIX)
+        sock.setblocking(False)
+        try:
+            result = sock.connect_ex(address)
+        except (IOError, OSError) as error:
+            result = error.errno
+        except TypeError:
+            result = errno.EINVAL
+        if result not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.proc_refuse_direct(client, sid)
+            return False
+        self.session[sid]['direct'].append({
+            'client': client,
+            'sock': sock,
+            'connected': False,
+            'timer': self.reactor.call_later(self.DIRECT_TIMEOUT, self.proc_direct_timeout, sid, sock)
+        })
+        self.reactor.add_writer(sock.fileno(), self.proc_direct_connected, sid, sock)
+        return True
+
+    def proc_refuse_direct(self, client, sid):
+        # The client writes with proc_write
+        self._command('send', client,
+            payload={
+                'sid': sid,
+                'state': self.session[sid]['state'] if sid in self.session else 'dead',
+                'direct': None}
+        )
+
+    def proc_direct_close(self, handoff):
+        handoff['timer'].cancel()
+        if not handoff['connected']:
+            self.reactor.remove_writer(handoff['sock'].fileno())
+        handoff['sock'].close()
+
+    def proc_direct_find(self, sid, sock):
+        if sid in self.session:
+            for handoff in self.session[sid]['direct']:
+                if handoff['sock'] is sock:
+                    return handoff
+
+    @session_synchronized
+    def proc_direct_connected(self, sid, sock):
+        handoff = self.proc_direct_find(sid, sock)
+        if handoff is None:
+            return
+        self.reactor.remove_writer(sock.fileno())
+        handoff['connected'] = True
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self.session[sid]['direct'].remove(handoff)
+            self.proc_direct_close(handoff)
+            self.proc_refuse_direct(handoff['client'], sid)
+            return
+        # Connected, the pty waits for the input queued before
+        handoff['timer'].cancel()
+        self.proc_handoff(sid)
+
+    @session_synchronized
+    def proc_direct_timeout(self, sid, sock):
+        handoff = self.proc_direct_find(sid, sock)
+        if handoff is not None:
+            self.session[sid]['direct'].remove(handoff)
+            self.proc_direct_close(handoff)
+            self.proc_refuse_direct(handoff['client'], sid)
+
+    def proc_handoff(self, sid):
+        """
+        Pass the pty to the clients connected for it once the input queued
+        is written, the input of the clients goes after it
+        """
+        session = self.session[sid]
+        if session['output']:
+            # Called again by proc_drain
+            return
+        for handoff in [ handoff for handoff in session['direct'] if handoff['connected'] ]:
+            session['direct'].remove(handoff)
+            try:
+                # The fd goes with the first byte, the session after it,
+                # both fit in the buffer of the new socket
+                send_handle(handoff['sock'], session['fd'], None)
+                handoff['sock'].sendall(protocol.Encoder([]).encode({
+                    'sid': sid,
+                    'state': 'alive',
+                    'direct': { 'keys': session['term'].keys() }}))
+            except (IOError, OSError):
+                self.proc_refuse_direct(handoff['client'], sid)
+            finally:
+                self.proc_direct_close(handoff)
+
+    def proc_stats(self, client):
+        """
+        Send the frame counters, reads, frames sent and reads coalesced
+        into a later frame, the notifier adds up the ones of every worker
+        """
+        self._command('stats', client, counters=dict(self.counters))
 
     def proc_thread(self):
         """
         Supervisor thread
         """
         while not self.signal_stop:
-            # Read fds
-            (fds, fd2sid) = self.proc_getalive()
-            try:
-                i, o, e = select.select(fds, [], [], 1.0)
-            except (IOError, OSError):
-                i = []
-            for fd in i:
-                sid = fd2sid[fd]
-                if self.proc_read(sid) and sid in self.session:
-                    self.session[sid]["changed"] = time.time()
-                    for client in self.session[sid]['clients']: 
-                        self._command('send', client,
-                            payload={ 
-                                'sid': sid, 
-                                'state': 'alive', 
-                                'screen': self.proc_dump(client, sid)}
-                        )
-        self.proc_buryall()
+            self.reactor.run_once()
+        self.proc_shutdown()
 
+    @session_synchronized
     def session_info(self, client, sid):
-        if sid in self.session:
+        if sid in self.session and 'pid' in self.session[sid]:
             s = self.session[sid]
-            pid = s["pid"]
-            self.processInfo.update()
-            info = self.processInfo.info(pid)
+            info = dict(self.processInspector.info(s["pid"], s.get("fd")))
             info['changed'] = s.get("changed", None)
             info['clients'] = len(s["clients"])
-            info['state'] = s["state"]
-            self._command('send', client, payload=info) 
+            self._command('send', client,
+                payload={
+                    'sid': sid,
+                    'state': s["state"],
+                    'info': info}
+            )
             
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Readiness dispatch for the multiplexer. File descriptors stay registered
+# in a selector (epoll on Linux) for as long as they are watched, timers
+# are kept in a heap ordered by deadline. The method names are the ones
+# of the asyncio event loop, so the multiplexer can run on either.
+# License: GPL2
+
+import os
+import time
+import heapq
+import fcntl
+import selectors
+import threading
+import traceback
+
+class Timer(object):
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+class Reactor(object):
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.cancelled = 0
+        self.lock = threading.RLock()
+        self.thread = None
+        # Self pipe, wakes up the loop from other threads
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.add_reader(self.wakeup_r, self._drain)
+
+    def time(self):
+        return time.monotonic()
+
+    def _drain(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except (IOError, OSError):
+            pass
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except (IOError, OSError):
+            # The pipe is full, the loop is already awake
+            pass
+
+    def _changed(self):
+        # Changes made by other threads are seen once select returns
+        if self.thread is not None and self.thread != threading.current_thread():
+            self.wakeup()
+
+    # File descriptors
+    def _update(self, fd, event, callback):
+        with self.lock:
+            try:
+                key = self.selector.get_key(fd)
+                handlers = dict(key.data)
+            except KeyError:
+                key, handlers = None, {}
+            if callback is None:
+                handlers.pop(event, None)
+            else:
+                handlers[event] = callback
+            events = 0
+            for mask in handlers:
+                events |= mask
+            if key is None and events:
+                self.selector.register(fd, events, handlers)
+            elif key is not None and events:
+                self.selector.modify(fd, events, handlers)
+            elif key is not None:
+                self.selector.unregister(fd)
+        self._changed()
+
+    def add_reader(self, fd, callback, *args):
+        self._update(fd, selectors.EVENT_READ, (callback, args))
+
+    def remove_reader(self, fd):
+        self._update(fd, selectors.EVENT_READ, None)
+
+    def add_writer(self, fd, callback, *args):
+        self._update(fd, selectors.EVENT_WRITE, (callback, args))
+
+    def remove_writer(self, fd):
+        self._update(fd, selectors.EVENT_WRITE, None)
+
+    # Timers
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        with self.lock:
+            heapq.heappush(self.timers, timer)
+            first = self.timers[0] is timer
+        if first:
+            self._changed()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def _timeout(self):
+        # Seconds until the next deadline, dropping cancelled timers
+        with self.lock:
+            timers = self.timers
+            while timers and timers[0].cancelled:
+                heapq.heappop(timers)
+            if len(timers) > 64 and sum(1 for timer in timers if timer.cancelled) > len(timers) // 2:
+                # Many cancelled timers far in the future
+                timers[:] = [ timer for timer in timers if not timer.cancelled ]
+                heapq.heapify(timers)
+            if timers:
+                return max(timers[0].deadline - self.time(), 0)
+
+    def _due(self):
+        due = []
+        with self.lock:
+            now = self.time()
+            timers = self.timers
+            while timers and (timers[0].cancelled or timers[0].deadline <= now):
+                timer = heapq.heappop(timers)
+                if not timer.cancelled:
+                    due.append(timer)
+        return due
+
+    # Loop
+    def run_once(self, timeout = None):
+        """Wait for events up to timeout seconds, or until the next timer
+        when None, and run the callbacks of ready fds and due timers"""
+        self.thread = threading.current_thread()
+        deadline = self._timeout()
+        if deadline is not None:
+            timeout = deadline if timeout is None else min(timeout, deadline)
+        try:
+            events = self.selector.select(timeout)
+        except (IOError, OSError):
+            events = []
+        for key, mask in events:
+            for event in (selectors.EVENT_READ, selectors.EVENT_WRITE):
+                # An earlier callback may have removed this one
+                current = self.selector.get_map().get(key.fd)
+                if mask & event and current is not None and event in current.data:
+                    callback, args = current.data[event]
+                    self._run(callback, args)
+        for timer in self._due():
+            self._run(timer.callback, timer.args)
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            # A failing callback is reported, the loop and the other
+            # sessions go on
+            traceback.print_exc()
+
+    def close(self):
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
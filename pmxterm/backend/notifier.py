@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Delivery of messages to the clients. Every client has an outbound
+# buffer written when its socket is writable, a slow client never blocks
+# the others. While a client is behind, the screen frames of a session
+# wait in one slot where newer frames are merged ("latest wins"), other
+# messages keep their order. Memory per client is bounded, a client too
+# far behind is disconnected.
+# License: GPL2
+
+import os
+import sys
+import json
+import errno
+import socket
+import collections
+
+import constants
+import protocol
+
+def merge_frames(old, new):
+    """One frame with the changes of old and then new"""
+    if old['epoch'] != new['epoch']:
+        # Styles were renumbered and every row sent again
+        return new
+    height = new['size'][1]
+    rows = dict((y, line) for y, line in old['rows'] if y < height)
+    rows.update((y, line) for y, line in new['rows'])
+    styles = dict((attr, style) for attr, style in old['styles'])
+    styles.update((attr, style) for attr, style in new['styles'])
+    frame = dict(new)
+    frame['rows'] = [ [y, rows[y]] for y in sorted(rows) ]
+    frame['styles'] = [ [attr, styles[attr]] for attr in sorted(styles) ]
+    return frame
+
+def merge_shared(old, new):
+    """One shared screen frame with the rows changed in old and new"""
+    if old['epoch'] != new['epoch']:
+        return new
+    height = new['size'][1]
+    styles = dict((attr, style) for attr, style in old['styles'])
+    styles.update((attr, style) for attr, style in new['styles'])
+    frame = dict(new)
+    frame['changed'] = sorted(set(y for y in old['changed'] if y < height) | set(new['changed']))
+    frame['styles'] = [ [attr, styles[attr]] for attr in sorted(styles) ]
+    return frame
+
+def encode(payload):
+    return json.dumps(payload).encode(constants.FS_ENCODING)
+
+class Channel(object):
+    # Bytes encoded ahead of the socket, frames after it are merged
+    HIGH_WATER = 64 * 1024
+    # Bytes of ordered messages a client may fall behind
+    MAX_PENDING = 16 * 1024 * 1024
+
+    def __init__(self, reactor, sock, encode = encode):
+        self.reactor = reactor
+        self.sock = sock
+        self.encode = encode
+        self.buffer = bytearray()
+        # Ordered messages, bytes already encoded or the sid of a frame slot
+        self.queue = collections.deque()
+        self.frames = {}
+        self.pending = 0
+        self.writing = False
+        self.closing = False
+        self.closed = False
+        self.counters = { 'messages': 0, 'frames': 0, 'merged': 0 }
+        sock.setblocking(False)
+
+    def send(self, payload):
+        if self.closed or self.closing:
+            return
+        self.counters['messages'] += 1
+        frame = payload.get('screen', payload.get('shared'))
+        if frame is not None and ('rows' in frame or 'changed' in frame):
+            sid = payload['sid']
+            if sid in self.frames:
+                self.counters['merged'] += 1
+                pending = self.frames[sid]
+                # A frame of the other kind, the first after proc_share,
+                # has every row and replaces the pending one
+                if 'shared' in payload and 'shared' in pending:
+                    payload = dict(payload, shared = merge_shared(pending['shared'], frame))
+                elif 'screen' in payload and 'screen' in pending:
+                    payload = dict(payload, screen = merge_frames(pending['screen'], frame))
+            else:
+                self.queue.append(sid)
+            self.frames[sid] = payload
+        else:
+            data = self.encode(payload)
+            self.queue.append(data)
+            self.pending += len(data)
+            if self.pending > self.MAX_PENDING:
+                # Too far behind to catch up
+                self.close(flush = False)
+                return
+        self.flush()
+
+    def fill(self):
+        # Encode queued messages up to the high water mark
+        while self.queue and len(self.buffer) < self.HIGH_WATER:
+            item = self.queue.popleft()
+            if isinstance(item, bytes):
+                self.pending -= len(item)
+                self.buffer += item
+            else:
+                self.counters['frames'] += 1
+                self.buffer += self.encode(self.frames.pop(item))
+
+    def flush(self):
+        if self.closed:
+            return
+        self.fill()
+        while self.buffer:
+            try:
+                sent = self.sock.send(self.buffer)
+            except (IOError, OSError) as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.close(flush = False)
+                return
+            del self.buffer[:sent]
+            self.fill()
+        if self.buffer and not self.writing:
+            self.writing = True
+            self.reactor.add_writer(self.sock.fileno(), self.flush)
+        elif not self.buffer and self.writing:
+            self.writing = False
+            self.reactor.remove_writer(self.sock.fileno())
+        if not self.buffer and self.closing:
+            self.close(flush = False)
+
+    def close(self, flush = True):
+        if self.closed:
+            return
+        if flush and (self.buffer or self.queue):
+            # Closed once everything is sent
+            self.closing = True
+            return
+        if self.writing:
+            self.writing = False
+            self.reactor.remove_writer(self.sock.fileno())
+        self.closed = True
+        self.buffer = bytearray()
+        self.queue.clear()
+        self.frames.clear()
+        self.sock.close()
+
+def resolve(address):
+    """Family and socket address of a client notifier, a unix socket
+    path or host:port"""
+    if isinstance(address, (list, tuple)):
+        return socket.AF_INET, tuple(address)
+    elif not address.startswith('/') and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+class Notifier(object):
+    """Runs the notifier commands of the multiplexers, on the thread of
+    the reactor"""
+    # Seconds a client notifier has to accept the connection
+    CONNECT_TIMEOUT = 5.0
+
+    def __init__(self, reactor, workers = 1):
+        self.reactor = reactor
+        self.workers = workers
+        self.channels = {}
+        # Clients still connecting, the messages for them wait here
+        self.connecting = {}
+        self.buried = {}
+        self.stats = {}
+
+    def send(self, client, payload):
+        channel = self.channels.get(client)
+        if channel is not None:
+            channel.send(payload)
+        elif client in self.connecting:
+            self.connecting[client]['pending'].append(payload)
+
+    # Connections, made without blocking the other clients
+    def setup_channel(self, client, address, capabilities):
+        try:
+            family, sockaddr = resolve(address)
+            sock = socket.socket(family)
+        except (IOError, OSError, ValueError) as error:
+            self.failed(client, address, error)
+            return
+        sock.setblocking(False)
+        try:
+            result = sock.connect_ex(sockaddr)
+        except (IOError, OSError) as error:
+            result = error.errno
+        if result not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.failed(client, address, OSError(result, os.strerror(result)))
+            return
+        self.abort(client)
+        # The handle, cancelled once the attempt is over, is the deadline
+        self.connecting[client] = { 'sock': sock, 'address': address,
+            'capabilities': capabilities, 'pending': [],
+            'handle': self.reactor.call_later(self.CONNECT_TIMEOUT, self.timeout, client, sock) }
+        self.reactor.add_writer(sock.fileno(), self.connected, client, sock)
+
+    def connected(self, client, sock):
+        attempt = self.connecting.get(client)
+        if attempt is None or attempt['sock'] is not sock:
+            return
+        result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if result:
+            self.abort(client)
+            self.failed(client, attempt['address'], OSError(result, os.strerror(result)))
+            return
+        self.attach(client, sock)
+
+    def timeout(self, client, sock):
+        attempt = self.connecting.get(client)
+        if attempt is not None and attempt['sock'] is sock:
+            self.abort(client)
+            self.failed(client, attempt['address'], OSError(errno.ETIMEDOUT, "timed out"))
+
+    def attach(self, client, sock):
+        attempt = self.connecting.pop(client)
+        attempt['handle'].cancel()
+        self.reactor.remove_writer(sock.fileno())
+        if client in self.channels:
+            self.channels[client].close(flush = False)
+        # Older clients take JSON, the others the encodings agreed
+        capabilities = attempt['capabilities']
+        channel = self.channels[client] = Channel(self.reactor, sock,
+            encode if capabilities is None else protocol.Encoder(capabilities).encode)
+        for payload in attempt['pending']:
+            channel.send(payload)
+
+    def abort(self, client):
+        attempt = self.connecting.pop(client, None)
+        if attempt is not None:
+            attempt['handle'].cancel()
+            self.reactor.remove_writer(attempt['sock'].fileno())
+            attempt['sock'].close()
+
+    def failed(self, client, address, error):
+        # Only this client goes without messages
+        sys.stderr.write("Client %s notifier at %r: %s\n" % (client, address, error))
+
+    def message(self, message):
+        if message['cmd'] == 'send':
+            self.send(message['channel'], message['payload'])
+        elif message['cmd'] == 'buried_all':
+            # Every worker buries its sessions
+            self.buried[message['channel']] = self.buried.get(message['channel'], 0) + 1
+            if self.buried[message['channel']] < self.workers:
+                return
+            del self.buried[message['channel']]
+            for channel in self.channels.values():
+                channel.close()
+            self.channels = {}
+            for client in list(self.connecting):
+                self.abort(client)
+        elif message['cmd'] == 'stats':
+            # Every worker counts its own sessions
+            count, counters = self.stats.get(message['channel'], (0, {}))
+            for name, value in message['counters'].items():
+                counters[name] = counters.get(name, 0) + value
+            if count + 1 < self.workers:
+                self.stats[message['channel']] = (count + 1, counters)
+                return
+            self.stats.pop(message['channel'], None)
+            self.send(message['channel'], {'sid': None, 'stats': counters})
+        elif message['cmd'] == 'close_channel':
+            # The client is gone, every worker says so
+            self.stats.pop(message['channel'], None)
+            self.abort(message['channel'])
+            channel = self.channels.pop(message['channel'], None)
+            if channel is not None:
+                channel.close(flush = False)
+        elif message['cmd'] == 'setup_channel':
+            self.setup_channel(message['channel'], message['address'],
+                message.get('capabilities'))
+
+    def close(self):
+        for client in list(self.connecting):
+            self.abort(client)
+        for channel in self.channels.values():
+            channel.close(flush = False)
+        self.channels = {}
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Wire protocol between the frontends and the backend. Every message is
+# a header, the length of the body and its type, followed by the body.
+# A client starts with a HELLO with its version and capabilities, the
+# backend answers with its own, and both use the encodings they share.
+# A connection starting with "{" is an older client sending JSON objects
+# one after the other, its notifications are JSON too.
+# Only the standard library is used, the frontend imports it as well.
+# License: GPL2
+
+import json
+import zlib
+import codecs
+import socket
+import struct
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+VERSION = 1
+
+HEADER = struct.Struct("!IB")
+SID_LENGTH = struct.Struct("!H")
+# A longer message is taken for a corrupt stream
+MAX_MESSAGE = 64 * 1024 * 1024
+
+# Message types
+HELLO = 0   # JSON object with the version and the capabilities
+JSON = 1    # JSON object, a command or a notification
+INPUT = 2   # proc_write command, the sid and the input as UTF-8
+ZJSON = 3   # JSON object compressed with zlib
+
+# Capabilities, "input" for INPUT commands, "zlib" for ZJSON
+# notifications bigger than COMPRESS_SIZE, and on the same host only
+# "shm" for screens in shared memory and "direct" for ptys passed to
+# the client to write its input
+CAPABILITIES = ('input', 'zlib')
+if shared_memory is not None:
+    CAPABILITIES += ('shm', )
+if hasattr(socket, 'SCM_RIGHTS'):
+    CAPABILITIES += ('direct', )
+COMPRESS_SIZE = 4096
+
+def pack(kind, body):
+    return HEADER.pack(len(body), kind) + body
+
+def hello(capabilities = CAPABILITIES):
+    return pack(HELLO, json.dumps({
+        'version': VERSION,
+        'capabilities': list(capabilities)}).encode("utf-8"))
+
+def agree(message, capabilities = CAPABILITIES):
+    """Capabilities of the HELLO message also in capabilities"""
+    theirs = message.get('capabilities', [])
+    if not isinstance(theirs, list):
+        theirs = []
+    return [ capability for capability in capabilities if capability in theirs ]
+
+def decode(kind, body):
+    """Message of a body of type kind, None for types of later versions.
+    A bad body raises ValueError"""
+    try:
+        if kind in (HELLO, JSON):
+            message = json.loads(body.decode("utf-8"))
+        elif kind == ZJSON:
+            inflater = zlib.decompressobj()
+            body = inflater.decompress(body, MAX_MESSAGE)
+            if inflater.unconsumed_tail:
+                raise ValueError("Message over %d bytes" % MAX_MESSAGE)
+            message = json.loads(body.decode("utf-8"))
+        elif kind == INPUT:
+            length, = SID_LENGTH.unpack_from(body)
+            start = SID_LENGTH.size
+            if start + length > len(body):
+                raise ValueError("Session id past the end of the message")
+            message = {
+                'command': 'proc_write',
+                'args': [ body[start:start + length].decode("utf-8"),
+                    body[start + length:].decode("utf-8") ]}
+        else:
+            # Types of later versions are skipped
+            return None
+    except (struct.error, zlib.error) as error:
+        raise ValueError(str(error))
+    if not isinstance(message, dict):
+        raise ValueError("Message is not an object")
+    return message
+
+class Encoder(object):
+    """Encodes the messages of one connection, as JSON objects for older
+    clients when capabilities is None"""
+    def __init__(self, capabilities = None):
+        self.capabilities = capabilities
+
+    def encode(self, message):
+        if self.capabilities is None:
+            return json.dumps(message).encode("utf-8")
+        if 'input' in self.capabilities and message.get('command') == 'proc_write' \
+            and len(message['args']) == 2:
+            sid = message['args'][0].encode("utf-8")
+            return pack(INPUT, SID_LENGTH.pack(len(sid)) + sid +
+                message['args'][1].encode("utf-8"))
+        body = json.dumps(message).encode("utf-8")
+        if 'zlib' in self.capabilities and len(body) > COMPRESS_SIZE:
+            return pack(ZJSON, zlib.compress(body, 1))
+        return pack(JSON, body)
+
+class Decoder(object):
+    """Messages in the bytes read from a connection, as (type, message)
+    tuples, framed or the JSON objects of older clients"""
+    def __init__(self):
+        self.framed = None
+        self.buffer = bytearray()
+        self.text = ""
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.parser = json.JSONDecoder()
+
+    def feed(self, data):
+        if self.framed is None:
+            if not data.lstrip():
+                return []
+            self.framed = data.lstrip()[:1] != b"{"
+        if not self.framed:
+            return self.feed_json(data)
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            length, kind = HEADER.unpack_from(self.buffer)
+            if length > MAX_MESSAGE:
+                raise ValueError("Message of %d bytes" % length)
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            body = bytes(self.buffer[HEADER.size:end])
+            del self.buffer[:end]
+            messages.append((kind, decode(kind, body)))
+        return messages
+
+    def feed_json(self, data):
+        self.text += self.utf8.decode(data)
+        messages = []
+        while True:
+            self.text = self.text.lstrip()
+            if self.text[:1] not in ("", "{"):
+                raise ValueError("Not a JSON object")
+            try:
+                message, end = self.parser.raw_decode(self.text)
+            except ValueError:
+                # The rest of the object in a later read
+                if len(self.text) > MAX_MESSAGE:
+                    raise ValueError("Message over %d bytes" % MAX_MESSAGE)
+                break
+            self.text = self.text[end:]
+            messages.append((JSON, message))
+        return messages
+
+class Connection(object):
+    """Backend side of a client connection, the commands in the bytes
+    read. The HELLO is answered with send, and setup_channel commands
+    get the capabilities agreed for the notifications. Messages that are
+    not commands, and proc_direct without "direct" agreed, raise
+    ValueError. Ptys are only passed to local clients, on unix sockets"""
+    def __init__(self, send, local = True):
+        self.send = send
+        self.decoder = Decoder()
+        self.capabilities = None
+        self.offered = CAPABILITIES if local else \
+            tuple(capability for capability in CAPABILITIES if capability != 'direct')
+
+    def feed(self, data):
+        commands = []
+        for kind, message in self.decoder.feed(data):
+            if kind == HELLO:
+                self.capabilities = agree(message, self.offered)
+                self.send(hello(self.offered))
+            elif message is not None:
+                if not isinstance(message.get('command'), str) or \
+                    not isinstance(message.get('args'), list):
+                    raise ValueError("Not a command")
+                if message['command'] == 'proc_direct' and \
+                    'direct' not in (self.capabilities or ()):
+                    raise ValueError("Direct input not agreed")
+                if message['command'] == 'setup_channel':
+                    message['args'].append(self.capabilities)
+                commands.append(message)
+        return commands
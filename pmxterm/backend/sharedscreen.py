@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Screens shared with frontends on the same host. The cells of a session
+# live in a shared memory segment, the backend writes the rows changed
+# and only sends the segment name and the numbers of the rows, frontends
+# read them from the segment. A seqlock guards the rows: the generation
+# is odd while the backend writes, a read is good when the generation
+# was the same even number before and after it.
+# The frontend still copies the rows read and turns them into runs of
+# text, what the segment saves are the bytes of the rows on the socket
+# and their JSON encoding and decoding, not the work of the frontend.
+# Only the standard library is used, the frontend imports it as well.
+# License: GPL2
+
+import sys
+import array
+import struct
+import itertools
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+# Generation, columns and lines of the screen in the segment, and the
+# cells it has room for
+HEADER = struct.Struct("=QIII")
+CELL = array.array('i').itemsize
+UTF32 = sys.byteorder == 'little' and 'utf-32-le' or 'utf-32-be'
+
+def dump_row(chars, attrs):
+    """Runs of text, each one after its style ID, as the rows of the
+    frames of the backend"""
+    text = chars.tobytes().decode(UTF32, 'replace')
+    line = []
+    x = 0
+    for attr, run in itertools.groupby(attrs):
+        n = len(list(run))
+        line.append(attr)
+        # Continuation cells are not text
+        line.append(text[x:x + n].replace("\x00", ""))
+        x += n
+    return line
+
+class SharedScreen(object):
+    """Segment written by the backend, chars and then attrs of the
+    cells, a row after the other"""
+    def __init__(self, w, h):
+        self.shm = shared_memory.SharedMemory(create = True,
+            size = HEADER.size + 2 * CELL * w * h)
+        self.capacity = w * h
+        self.generation = 0
+        # Frame of the terminal the segment is up to date with
+        self.since = 0
+        HEADER.pack_into(self.shm.buf, 0, 0, w, h, self.capacity)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def fits(self, w, h):
+        return w * h <= self.capacity
+
+    def write(self, w, h, rows):
+        """Store rows, (y, chars, attrs) tuples, of a w x h screen"""
+        buf = self.shm.buf
+        self.generation += 1
+        HEADER.pack_into(buf, 0, self.generation, w, h, self.capacity)
+        attrs_offset = HEADER.size + CELL * self.capacity
+        size = CELL * w
+        for y, chars, attrs in rows:
+            offset = size * y
+            buf[HEADER.size + offset:HEADER.size + offset + size] = chars.tobytes()
+            buf[attrs_offset + offset:attrs_offset + offset + size] = attrs.tobytes()
+        self.generation += 1
+        HEADER.pack_into(buf, 0, self.generation, w, h, self.capacity)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+class SharedScreenReader(object):
+    """Segment read by a frontend"""
+    RETRIES = 100
+
+    def __init__(self, name):
+        self.untracked = False
+        try:
+            self.shm = shared_memory.SharedMemory(name = name, track = False)
+        except TypeError:
+            # Python < 3.13 tracks segments it did not create, and
+            # would remove it when the frontend exits
+            self.shm = shared_memory.SharedMemory(name = name)
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+                self.untracked = True
+            except (ImportError, AttributeError):
+                pass
+        self.name = name
+        self.capacity = HEADER.unpack_from(self.shm.buf, 0)[3]
+
+    def read(self, w, h, ys):
+        """Chars and attrs arrays of the rows ys of a w x h screen, as
+        {y: (chars, attrs)}, None when the screen has another size or
+        stays busy"""
+        buf = self.shm.buf
+        attrs_offset = HEADER.size + CELL * self.capacity
+        size = CELL * w
+        for _ in range(self.RETRIES):
+            generation, sw, sh, capacity = HEADER.unpack_from(buf, 0)
+            if (sw, sh) != (w, h):
+                return None
+            if generation & 1:
+                continue
+            rows = {}
+            for y in ys:
+                offset = size * y
+                chars = array.array('i')
+                chars.frombytes(buf[HEADER.size + offset:HEADER.size + offset + size])
+                attrs = array.array('i')
+                attrs.frombytes(buf[attrs_offset + offset:attrs_offset + offset + size])
+                rows[y] = (chars, attrs)
+            if HEADER.unpack_from(buf, 0)[0] == generation:
+                return rows
+
+    def close(self):
+        self.shm.close()
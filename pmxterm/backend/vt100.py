@@ -9,21 +9,82 @@ from __future__ import unicode_literals
 # http://vim.wikia.com/wiki/Xterm256_color_names_for_console_Vim
 # http://shallowsky.com/blog/2011/Jan/18/
 
+import re
 import sys
 import array
+import itertools
+import functools
+import collections
+import codecs
+import unicodedata
 import constants
+import vtparser
+import keyfilter
+import sharedscreen
 
 if sys.version_info.major == 3:
     unichr = chr
 
+UTF32 = sys.byteorder == 'little' and 'utf-32-le' or 'utf-32-be'
+
+def narrow_characters():
+    """Character class of the printable characters that are not double
+    width, from the East Asian width of unicodedata"""
+    wide = bytes(bytearray(unicodedata.east_asian_width(c) in ('W', 'F')
+        for c in map(unichr, range(sys.maxunicode + 1))))
+    ranges = [ (0x20, 0x7e) ]
+    start = 0xa0
+    for m in re.finditer(b'\x01+', wide):
+        if m.start() > start:
+            ranges.append((start, m.start() - 1))
+        start = max(start, m.end())
+    if start <= sys.maxunicode:
+        ranges.append((start, sys.maxunicode))
+    return '[%s]' % ''.join('%s-%s' % (re.escape(unichr(a)), re.escape(unichr(b)))
+        for a, b in ranges)
+
+@functools.lru_cache(maxsize = None)
+def printable_run():
+    """Runs of the characters that are neither controls nor double
+    width, the table is built on the first use and not at import"""
+    return re.compile(narrow_characters() + '+')
+
+def codepoints(text):
+    # Array of code points, built by the codec instead of a Python loop
+    a = array.array('i')
+    a.frombytes(text.encode(UTF32))
+    return a
+
 class Terminal(object):
     CHARACTERS = 0
     ATTRIBUTES = 1
-    DEFAULTATTR = constants.SGR39 | constants.SGR49
+    # Second cell of a double width character
+    CONTINUATION = 0
+    # Cells store style IDs, an index in the table of (fg, bg, flags)
+    DEFAULTATTR = 0
+    DEFAULTSTYLE = (0, 0, constants.DEFAULTSGR)
+    # Styles interned before unused ones are collected
+    MAX_STYLES = 1024
+    # Bytes charged to the scrollback for a row besides its cells
+    HISTORY_ROW_OVERHEAD = 192
     
-    def __init__(self, w, h):
+    def __init__(self, w, h, history_bytes = constants.HISTORY_BYTES):
         self.w = w
         self.h = h
+        # Scrollback, rows scrolled off the top of the main screen. Rows
+        # are numbered from the first one ever stored, the oldest ones are
+        # dropped when the rows take more than history_bytes.
+        self.history = collections.deque()
+        self.history_bytes = history_bytes
+        self.history_size = 0
+        self.history_end = 0
+        # Interned styles, the number of the frame that added each one
+        # and the epoch, changed when the table is compacted
+        self.styles = [ self.DEFAULTSTYLE ]
+        self.style_ids = { self.DEFAULTSTYLE: self.DEFAULTATTR }
+        self.style_frame = [ 0 ]
+        self.style_epoch = 0
+        self.style_limit = self.MAX_STYLES
         self.vt100_charset_graph = [
             0x25ca, 0x2026, 0x2022, 0x3f,
             0xb6, 0x3f, 0xb0, 0xb1,
@@ -34,6 +95,8 @@ class Terminal(object):
             0x7c, 0x2264, 0x2265, 0xb6,
             0x2260, 0xa3, 0xb7, 0x7f
         ]
+        self.vt100_charset_graph_table = dict(
+            (0x60 + i, c) for i, c in enumerate(self.vt100_charset_graph))
         self.vt100_esc = {
             '#8':	self.esc_DECALN,
             '(A':	self.esc_G0_0,
@@ -56,14 +119,8 @@ class Terminal(object):
             'M':	self.esc_RI,
             'N':	self.esc_SS2,
             'O':	self.esc_SS3,
-            'P':	self.esc_DCS,
-            'X':	self.esc_SOS,
             'Z':	self.esc_DECID,
-            '[':	self.esc_CSI,
             '\\':	self.esc_ST,
-            ']':	self.esc_OSC,
-            '^':	self.esc_PM,
-            '_':	self.esc_APC,
             'c':	self.reset_hard,
         }
         self.vt100_csi = {
@@ -91,94 +148,46 @@ class Terminal(object):
             'a':	self.csi_HPR,
             'b':	self.csi_REP,
             'c':	self.csi_DA,
+            '>c':	self.csi_DA2,
             'd':	self.csi_VPA,
             'e':	self.csi_VPR,
             'f':	self.csi_HVP,
             'g':	self.csi_TBC,
             'h':	self.csi_SM,
+            '?h':	self.csi_DECSET,
             'l':	self.csi_RM,
+            '?l':	self.csi_DECRST,
             'm':	self.csi_SGR,
             'n':	self.csi_DSR,
+            '?n':	self.csi_DECDSR,
             'r':	self.csi_DECSTBM,
             's':	self.csi_SCP,
             'u':	self.csi_RCP,
             'x':	self.csi_DECREQTPARM,
             '!p':	self.csi_DECSTR,
         }
-        self.vt100_keyfilter_ansikeys = {
-            '~':'~',
-            'A':'\x1b[A',
-            'B':'\x1b[B',
-            'C':'\x1b[C',
-            'D':'\x1b[D',
-            'F':'\x1b[F',
-            'H':'\x1b[H',
-            '1':'\x1b[5~',
-            '2':'\x1b[6~',
-            '3':'\x1b[2~',
-            '4':'\x1b[3~',
-            'a':'\x1bOP',
-            'b':'\x1bOQ',
-            'c':'\x1bOR',
-            'd':'\x1bOS',
-            'e':'\x1b[15~',
-            'f':'\x1b[17~',
-            'g':'\x1b[18~',
-            'h':'\x1b[19~',
-            'i':'\x1b[20~',
-            'j':'\x1b[21~',
-            'k':'\x1b[23~',
-            'l':'\x1b[24~',
+        self.vt100_osc = {
+            0:	self.osc_title,
+            2:	self.osc_title,
         }
-        self.vt100_keyfilter_appkeys = {
-            '~':'~',
-            'A':'\x1bOA',
-            'B':'\x1bOB',
-            'C':'\x1bOC',
-            'D':'\x1bOD',
-            'F':'\x1bOF',
-            'H':'\x1bOH',
-            '1':'\x1b[5~',
-            '2':'\x1b[6~',
-            '3':'\x1b[2~',
-            '4':'\x1b[3~',
-            'a':'\x1bOP',
-            'b':'\x1bOQ',
-            'c':'\x1bOR',
-            'd':'\x1bOS',
-            'e':'\x1b[15~',
-            'f':'\x1b[17~',
-            'g':'\x1b[18~',
-            'h':'\x1b[19~',
-            'i':'\x1b[20~',
-            'j':'\x1b[21~',
-            'k':'\x1b[23~',
-            'l':'\x1b[24~',
+        self.vt100_dcs = {
+            '$q':	self.dcs_DECRQSS,
         }
+        self.vt100_parser = vtparser.Parser(self)
         self.reset_hard()
 
     # Reset functions
     def reset_hard(self):
-        # Attribute mask: 0x0X00FFBB
-        #	X:	Bit 0 - Underlined
-        #		Bit 1 - Negative
-        #		Bit 2 - Concealed
-        #	F:	Foreground
-        #	B:	Background
-        self.attr = constants.DEFAULTSGR
-        # UTF-8 decoder
-        self.utf8_units_count = 0
-        self.utf8_units_received = 0
-        self.utf8_char = 0
+        # Current style ID
+        self.attr = self.DEFAULTATTR
+        # UTF-8 decoder, keeps incomplete sequences between reads
+        self.utf8_decoder = codecs.getincrementaldecoder('utf-8')('replace')
         # Key filter
         self.vt100_keyfilter_escape = False
         # Last char
         self.vt100_lastchar = 0
-        # Control sequences
-        self.vt100_parse_len = 0
-        self.vt100_parse_state = ""
-        self.vt100_parse_func = ""
-        self.vt100_parse_param = ""
+        # Window title
+        self.title = ""
         # Buffers
         self.vt100_out = ""
         # Invoke other resets
@@ -186,7 +195,7 @@ class Terminal(object):
         self.reset_soft()
 
     def reset_soft(self):
-        self.attr = constants.DEFAULTSGR
+        self.attr = self.DEFAULTATTR
         # Scroll parameters
         self.scroll_area_y0 = 0
         self.scroll_area_y1 = self.h
@@ -213,93 +222,159 @@ class Terminal(object):
         self.esc_DECSC()
 
     def reset_screen(self):
-        # Screen
-        self.screen = (array.array('i', [ 0x20 ] * self.w * self.h),
-                    array.array('i', [ self.attr ] * self.w * self.h))
-        self.screen2 = (array.array('i', [ 0x20 ] * self.w * self.h),
-                    array.array('i', [ self.attr ] * self.w * self.h))
+        # Screen, a table of rows, each one a pair of characters and
+        # attributes arrays. Scrolling moves rows in the table.
+        self.blank = (array.array('i', [ 0x20 ]) * self.w,
+                    array.array('i', [ self.DEFAULTATTR ]) * self.w)
+        self.screen = [ (array.array('i', [ 0x20 ]) * self.w,
+                    array.array('i', [ self.attr ]) * self.w) for _ in range(self.h) ]
+        self.screen2 = [ (array.array('i', [ 0x20 ]) * self.w,
+                    array.array('i', [ self.attr ]) * self.w) for _ in range(self.h) ]
         # Scroll parameters
         self.scroll_area_y0 = 0
         self.scroll_area_y1 = self.h
         # Cursor position
         self.cx = 0
         self.cy = 0
+        self.vt100_saved_cx = 0
+        self.vt100_saved_cy = 0
         # Tab stops
-        self.tab_stops = range(0, self.w, 8)
+        self.tab_stops = list(range(0, self.w, 8))
+        # Damaged rows, the number of the frame that last changed each row
+        try:
+            self.frame
+        except AttributeError:
+            self.frame = 1
+        self.row_frame = [ self.frame ] * self.h
+
+    # Style functions
+    def style_intern(self, fg, bg, flags):
+        style = (fg, bg, flags)
+        try:
+            return self.style_ids[style]
+        except KeyError:
+            pass
+        if len(self.styles) >= self.style_limit:
+            self.style_compact()
+            # Collect again when the table doubles
+            self.style_limit = max(self.MAX_STYLES, 2 * len(self.styles))
+        attr = self.style_ids[style] = len(self.styles)
+        self.styles.append(style)
+        self.style_frame.append(self.frame)
+        return attr
+
+    def style_compact(self):
+        # Drop the styles no cell refers to and renumber the others,
+        # clients get the whole table and screen again
+        rows = self.screen + self.screen2 + list(self.history)
+        used = set([ self.DEFAULTATTR, self.attr,
+            self.vt100_saved['attr'], self.vt100_saved2['attr'] ])
+        for chars, attrs in rows:
+            used.update(attrs)
+        renumber = [ self.DEFAULTATTR ] * len(self.styles)
+        styles = []
+        for attr in sorted(used):
+            renumber[attr] = len(styles)
+            styles.append(self.styles[attr])
+        for chars, attrs in rows:
+            attrs[:] = array.array('i', map(renumber.__getitem__, attrs))
+        self.attr = renumber[self.attr]
+        self.vt100_saved['attr'] = renumber[self.vt100_saved['attr']]
+        self.vt100_saved2['attr'] = renumber[self.vt100_saved2['attr']]
+        self.styles = styles
+        self.style_ids = dict((style, attr) for attr, style in enumerate(styles))
+        self.style_frame = [ self.frame ] * len(styles)
+        self.style_epoch += 1
+        self.damage(0, self.h)
 
     # UTF-8 functions
     def utf8_decode(self, d):
-        o = ''
-        for char in d:
-            #char = ord(c)
-            if self.utf8_units_count != self.utf8_units_received:
-                self.utf8_units_received += 1
-                if (char & 0xc0) == 0x80:
-                    self.utf8_char = (self.utf8_char << 6) | (char & 0x3f)
-                    if self.utf8_units_count == self.utf8_units_received:
-                        if self.utf8_char<0x10000:
-                            o += unichr(self.utf8_char)
-                        self.utf8_units_count = self.utf8_units_received = 0
-                else:
-                    o += '?'
-                    while self.utf8_units_received:
-                        o += '?'
-                        self.utf8_units_received -= 1
-                    self.utf8_units_count = 0
-            else:
-                if (char & 0x80) == 0x00:
-                    o += unichr(char)
-                elif (char & 0xe0) == 0xc0:
-                    self.utf8_units_count = 1
-                    self.utf8_char = char & 0x1f
-                elif (char & 0xf0) == 0xe0:
-                    self.utf8_units_count = 2
-                    self.utf8_char = char & 0x0f
-                elif (char & 0xf8) == 0xf0:
-                    self.utf8_units_count = 3
-                    self.utf8_char = char & 0x07
-                else:
-                    o += '?'
-        return o
+        return self.utf8_decoder.decode(d)
 
     def utf8_encode(self, d):
         return d.encode(constants.FS_ENCODING)
 
     def utf8_charwidth(self, char):
-        if char >= 0x2e80:
-            return 2
-        else:
+        if char < 0x80:
             return 1
+        if unicodedata.east_asian_width(unichr(char)) in ('W', 'F'):
+            return 2
+        return 1
 
     # Low-level terminal functions
-    def peek(self, y0, x0, y1, x1):
-        return self.screen[self.CHARACTERS][self.w * y0 + x0:self.w * (y1 - 1) + x1], self.screen[self.ATTRIBUTES][self.w * y0 + x0:self.w * (y1 - 1) + x1]
+    def peek(self, y, x0, x1):
+        chars, attrs = self.screen[y]
+        return chars[x0:x1], attrs[x0:x1]
 
     def poke(self, y, x, c, a):
-        pos = self.w * y + x
-        self.screen[self.CHARACTERS][pos:pos + len(c)] = c
-        self.screen[self.ATTRIBUTES][pos:pos + len(a)] = a
+        chars, attrs = self.screen[y]
+        end = x + len(c)
+        # Do not leave halves of double width characters
+        if x < end:
+            if x > 0 and chars[x] == self.CONTINUATION:
+                chars[x - 1] = 0x20
+            if end < self.w and chars[end] == self.CONTINUATION:
+                chars[end] = 0x20
+        chars[x:end] = c
+        attrs[x:x + len(a)] = a
+        self.row_frame[y] = self.frame
+
+    def damage(self, y0, y1):
+        self.row_frame[y0:y1] = [ self.frame ] * (y1 - y0)
 
     def fill(self, y0, x0, y1, x1, char, attr):
-        n = self.w * (y1 - y0 - 1) + (x1 - x0)
-        self.poke(y0, x0, 
-            array.array('i', [ char ] * n),
-            array.array('i', [ attr ] * n))
+        # From (y0, x0) up to (y1 - 1, x1), rows in between are filled
+        for y in range(y0, y1):
+            start = y == y0 and x0 or 0
+            end = y == y1 - 1 and min(x1, self.w) or self.w
+            if end > start:
+                self.poke(y, start,
+                    array.array('i', [ char ]) * (end - start),
+                    array.array('i', [ attr ]) * (end - start))
 
     def clear(self, y0, x0, y1, x1):
-        self.fill(y0, x0, y1, x1, 0x20, constants.DEFAULTSGR)
+        self.fill(y0, x0, y1, x1, 0x20, self.DEFAULTATTR)
 
     # Scrolling functions
-    def scroll_area_up(self, y0, y1, n = 1):
+    def scroll_rows(self, rows):
+        # Blank the rows in place, so they can be reused
+        for chars, attrs in rows:
+            chars[:] = self.blank[self.CHARACTERS]
+            attrs[:] = self.blank[self.ATTRIBUTES]
+        return rows
+
+    def scroll_history(self, rows):
+        # Move the rows to the scrollback and return new blank rows
+        for row in rows:
+            self.history.append(row)
+            self.history_size += len(row[self.CHARACTERS]) * 8 + self.HISTORY_ROW_OVERHEAD
+        self.history_end += len(rows)
+        while self.history and self.history_size > self.history_bytes:
+            row = self.history.popleft()
+            self.history_size -= len(row[self.CHARACTERS]) * 8 + self.HISTORY_ROW_OVERHEAD
+        return [ (self.blank[self.CHARACTERS][:], self.blank[self.ATTRIBUTES][:])
+            for row in rows ]
+
+    def scroll_area_up(self, y0, y1, n = 1, history = False):
+        # Rows scrolled off the top of the screen go to the history when
+        # history is set, deleted rows do not
         n = min(y1-y0, n)
-        self.poke(y0, 0, *self.peek(y0 + n, 0, y1, self.w))
-        self.clear(y1-n, 0, y1, self.w)
+        rows = self.screen[y0:y0 + n]
+        del self.screen[y0:y0 + n]
+        if history and y0 == 0 and not self.vt100_mode_alt_screen and self.history_bytes:
+            rows = self.scroll_history(rows)
+        else:
+            rows = self.scroll_rows(rows)
+        self.screen[y1 - n:y1 - n] = rows
+        self.damage(y0, y1)
         self._scroll_area_up += n
 
     def scroll_area_down(self, y0, y1, n = 1):
         n = min(y1-y0, n)
-        self.poke(y0 + n, 0, *self.peek(y0, 0, y1-n, self.w))
-        self.clear(y0, 0, y0 + n, self.w)
+        rows = self.screen[y1 - n:y1]
+        del self.screen[y1 - n:y1]
+        self.screen[y0:y0] = self.scroll_rows(rows)
+        self.damage(y0, y1)
         self._scroll_area_down += n
 
     def scroll_area_set(self, y0, y1):
@@ -312,25 +387,16 @@ class Terminal(object):
     def scroll_line_right(self, y, x, n = 1):
         if x < self.w:
             n = min(self.w-self.cx, n)
-            self.poke(y, x + n, *self.peek(y, x, y + 1, self.w - n))
+            self.poke(y, x + n, *self.peek(y, x, self.w - n))
             self.clear(y, x, y + 1, x + n)
 
     def scroll_line_left(self, y, x, n = 1):
         if x < self.w:
             n = min(self.w - self.cx, n)
-            self.poke(y, x, *self.peek(y, x + n, y + 1, self.w))
+            self.poke(y, x, *self.peek(y, x + n, self.w))
             self.clear(y, self.w - n, y + 1, self.w)
 
     # Cursor functions
-    def cursor_line_width(self, next_char):
-        wx = self.utf8_charwidth(next_char)
-        lx = 0
-        for x in range(min(self.cx, self.w)):
-            char = self.peek(self.cy, x, self.cy + 1, x + 1)[self.CHARACTERS][0]
-            wx += self.utf8_charwidth(char)
-            lx += 1
-        return wx, lx
-
     def cursor_up(self, n = 1):
         self.cy = max(self.scroll_area_y0, self.cy - n)
 
@@ -379,7 +445,7 @@ class Terminal(object):
         if self.vt100_mode_lfnewline:
             self.ctrl_CR()
         if self.cy == self.scroll_area_y1 - 1:
-            self.scroll_area_up(self.scroll_area_y0, self.scroll_area_y1)
+            self.scroll_area_up(self.scroll_area_y0, self.scroll_area_y1, history = True)
         else:
             self.cursor_down()
 
@@ -400,25 +466,55 @@ class Terminal(object):
         return False
 
     def dumb_echo(self, char):
+        width = self.utf8_charwidth(char)
         # Check right bound
-        wx, cx = self.cursor_line_width(char)
-        # Newline
-        if wx > self.w:
+        if self.cx + width > self.w:
             if self.vt100_mode_autowrap:
                 self.ctrl_CR()
                 self.ctrl_LF()
             else:
-                self.cx = cx - 1
+                self.cx = self.w - width
         if self.vt100_mode_insert:
-            self.scroll_line_right(self.cy, self.cx)
+            self.scroll_line_right(self.cy, self.cx, width)
         if self.vt100_charset_is_single_shift:
             self.vt100_charset_is_single_shift = False
         elif self.vt100_charset_is_graphical and (char & 0xffe0) == 0x0060:
             char = self.vt100_charset_graph[char - 0x60]
-        self.poke(self.cy, self.cx,
-            array.array('i', [ char ]),
-            array.array('i', [ self.attr ]))
-        self.cursor_set_x(self.cx + 1)
+        if width == 2:
+            c = array.array('i', [ char, self.CONTINUATION ])
+        else:
+            c = array.array('i', [ char ])
+        self.poke(self.cy, self.cx, c,
+            array.array('i', [ self.attr ]) * width)
+        self.cursor_set_x(self.cx + width)
+
+    def dumb_echo_run(self, text):
+        # Echo a run of printable single width characters, row by row
+        self.vt100_lastchar = ord(text[-1])
+        if self.vt100_charset_is_single_shift:
+            self.dumb_echo(ord(text[0]))
+            text = text[1:]
+        if self.vt100_charset_is_graphical:
+            text = text.translate(self.vt100_charset_graph_table)
+        while text:
+            room = self.w - self.cx
+            if room <= 0:
+                if self.vt100_mode_autowrap:
+                    self.ctrl_CR()
+                    self.ctrl_LF()
+                    continue
+                # Without autowrap only the last character survives
+                self.cx = self.w - 1
+                text = text[-1:]
+                room = 1
+            chunk, text = text[:room], text[room:]
+            n = len(chunk)
+            if self.vt100_mode_insert:
+                self.scroll_line_right(self.cy, self.cx, n)
+            self.poke(self.cy, self.cx,
+                codepoints(chunk),
+                array.array('i', [ self.attr ]) * n)
+            self.cursor_set_x(self.cx + n)
 
     # VT100 CTRL, ESC, CSI handlers
     def vt100_charset_update(self):
@@ -436,19 +532,22 @@ class Terminal(object):
         self.vt100_charset_update()
 
     def vt100_setmode(self, p, state):
-        # Set VT100 mode
-        p = self.vt100_parse_params(p, [], False)
+        # Set ANSI mode
         for m in p:
-            if m == '4':
+            if m == 4:
                 # Insertion replacement mode
                 self.vt100_mode_insert = state
-            elif m == '20':
+            elif m == 20:
                 # Linefeed/new line mode
                 self.vt100_mode_lfnewline = state
-            elif m == '?1':
+
+    def vt100_setmode_dec(self, p, state):
+        # Set DEC private mode
+        for m in p:
+            if m == 1:
                 # Cursor key mode
                 self.vt100_mode_cursorkey = state
-            elif m == '?3':
+            elif m == 3:
                 # Column mode
                 if self.vt100_mode_column_switch:
                     if state:
@@ -456,33 +555,34 @@ class Terminal(object):
                     else:
                         self.w = 80
                     self.reset_screen()
-            elif m == '?5':
+            elif m == 5:
                 # Screen mode
                 self.vt100_mode_inverse = state
-            elif m == '?6':
+            elif m == 6:
                 # Region origin mode
                 self.vt100_mode_origin = state
                 if state:
                     self.cursor_set(self.scroll_area_y0, 0)
                 else:
                     self.cursor_set(0, 0)
-            elif m == '?7':
+            elif m == 7:
                 # Autowrap mode
                 self.vt100_mode_autowrap = state
-            elif m == '?25':
+            elif m == 25:
                 # Text cursor enable mode
                 self.vt100_mode_cursor = state
-            elif m == '?40':
+            elif m == 40:
                 # Column switch control
                 self.vt100_mode_column_switch = state
-            elif m == '?47':
+            elif m == 47:
                 # Alternate screen mode
                 if ((state and not self.vt100_mode_alt_screen) or
                     (not state and self.vt100_mode_alt_screen)):
                     self.screen, self.screen2 = self.screen2, self.screen
                     self.vt100_saved, self.vt100_saved2 = self.vt100_saved2, self.vt100_saved
+                    self.damage(0, self.h)
                 self.vt100_mode_alt_screen = state
-            elif m == '?67':
+            elif m == 67:
                 # Backspace/delete
                 self.vt100_mode_backspace = state
 
@@ -494,13 +594,9 @@ class Terminal(object):
         # Shift in
         self.vt100_charset_set(0)
 
-    def esc_CSI(self):
-        # CSI start sequence
-        self.vt100_parse_reset('csi')
-
     def esc_DECALN(self):
         # Screen alignment display
-        self.fill(0, 0, self.h, self.w, 0x45, 0x00fe0000)
+        self.fill(0, 0, self.h, self.w, 0x45, self.style_intern(0, 0, 0x00fe0000))
 
     def esc_G0_0(self):
         self.vt100_charset_select(0, 0)
@@ -573,7 +669,7 @@ class Terminal(object):
 
     def esc_HTS(self):
         # Character tabulation set
-        self.csi_CTC('0')
+        self.csi_CTC([0])
 
     def esc_RI(self):
         # Reverse line feed
@@ -590,34 +686,14 @@ class Terminal(object):
         # Single-shift three
         self.vt100_charset_is_single_shift = True
 
-    def esc_DCS(self):
-        # Device control string
-        self.vt100_parse_reset('str')
-
-    def esc_SOS(self):
-        # Start of string
-        self.vt100_parse_reset('str')
-
     def esc_DECID(self):
         # Identify terminal
-        self.csi_DA('0')
+        self.csi_DA([0])
 
     def esc_ST(self):
         # String terminator
         pass
 
-    def esc_OSC(self):
-        # Operating system command
-        self.vt100_parse_reset('str')
-
-    def esc_PM(self):
-        # Privacy message
-        self.vt100_parse_reset('str')
-
-    def esc_APC(self):
-        # Application program command
-        self.vt100_parse_reset('str')
-
     def csi_ICH(self, p):
         # Insert character
         p = self.vt100_parse_params(p, [1])
@@ -673,22 +749,22 @@ class Terminal(object):
 
     def csi_ED(self, p):
         # Erase in display
-        p = self.vt100_parse_params(p, ['0'], False)
-        if p[0] == '0':
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 0:
             self.clear(self.cy, self.cx, self.h, self.w)
-        elif p[0] == '1':
+        elif p[0] == 1:
             self.clear(0, 0, self.cy + 1, self.cx + 1)
-        elif p[0] == '2':
+        elif p[0] == 2:
             self.clear(0, 0, self.h, self.w)
 
     def csi_EL(self, p):
         # Erase in line
-        p = self.vt100_parse_params(p, ['0'], False)
-        if p[0] == '0':
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 0:
             self.clear(self.cy, self.cx, self.cy + 1, self.w)
-        elif p[0] == '1':
+        elif p[0] == 1:
             self.clear(self.cy, 0, self.cy + 1, self.cx + 1)
-        elif p[0] == '2':
+        elif p[0] == 2:
             self.clear(self.cy, 0, self.cy + 1, self.w)
 
     def csi_IL(self, p):
@@ -711,7 +787,8 @@ class Terminal(object):
     def csi_SU(self, p):
         # Scroll up
         p = self.vt100_parse_params(p, [1])
-        self.scroll_area_up(self.scroll_area_y0, self.scroll_area_y1, max(1, p[0]))
+        self.scroll_area_up(self.scroll_area_y0, self.scroll_area_y1, max(1, p[0]),
+            history = True)
 
     def csi_SD(self, p):
         # Scroll down
@@ -720,9 +797,9 @@ class Terminal(object):
 
     def csi_CTC(self, p):
         # Cursor tabulation control
-        p = self.vt100_parse_params(p, ['0'], False)
+        p = self.vt100_parse_params(p, [0])
         for m in p:
-            if m == '0':
+            if m == 0:
                 try:
                     ts = self.tab_stops.index(self.cx)
                 except ValueError:
@@ -730,12 +807,12 @@ class Terminal(object):
                     tab_stops.append(self.cx)
                     tab_stops.sort()
                     self.tab_stops = tab_stops
-            elif m == '2':
+            elif m == 2:
                 try:
                     self.tab_stops.remove(self.cx)
                 except ValueError:
                     pass
-            elif m == '5':
+            elif m == 5:
                 self.tab_stops = [0]
 
     def csi_ECH(self, p):
@@ -772,10 +849,14 @@ class Terminal(object):
 
     def csi_DA(self, p):
         # Device attributes
-        p = self.vt100_parse_params(p, ['0'], False)
-        if p[0] == '0':
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 0:
             self.vt100_out = "\x1b[?1;2c"
-        elif p[0] == '>0' or p[0] == '>':
+
+    def csi_DA2(self, p):
+        # Secondary device attributes
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 0:
             self.vt100_out = "\x1b[>0;184;0c"
 
     def csi_VPA(self, p):
@@ -793,11 +874,11 @@ class Terminal(object):
 
     def csi_TBC(self, p):
         # Tabulation clear
-        p = self.vt100_parse_params(p, ['0'], False)
-        if p[0] == '0':
-            self.csi_CTC('2')
-        elif p[0] == '3':
-            self.csi_CTC('5')
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 0:
+            self.csi_CTC([2])
+        elif p[0] == 3:
+            self.csi_CTC([5])
 
     def csi_SM(self, p):
         # Set mode
@@ -807,81 +888,133 @@ class Terminal(object):
         # Reset mode
         self.vt100_setmode(p, False)
 
+    def csi_DECSET(self, p):
+        # Set DEC private mode
+        self.vt100_setmode_dec(p, True)
+
+    def csi_DECRST(self, p):
+        # Reset DEC private mode
+        self.vt100_setmode_dec(p, False)
+
+    def sgr_color(self, p, i):
+        # Extended color at p[i], 5;n or 2;r;g;b, separated by semicolons
+        # or colons. Return the color, None if invalid, and the next index.
+        m = p[i]
+        if isinstance(m, tuple):
+            sub, i = [ v or 0 for v in m[1:] ], i + 1
+            if sub[:1] == [2] and len(sub) > 4:
+                # The color space ID is optional
+                sub = [2] + sub[-3:]
+        else:
+            sub = [ v or 0 for v in p[i + 1:i + 5] ]
+            if sub[:1] == [5]:
+                sub, i = sub[:2], i + 3
+            elif sub[:1] == [2]:
+                sub, i = sub[:4], i + 5
+            else:
+                return None, i + 1
+        if sub[:1] == [5] and len(sub) == 2 and sub[1] <= 255:
+            return sub[1], i
+        if sub[:1] == [2] and len(sub) == 4 and max(sub[1:]) <= 255:
+            return constants.TRUECOLOR | (sub[1] << 16) | (sub[2] << 8) | sub[3], i
+        return None, i
+
     def csi_SGR(self, p):
         # Select graphic rendition
         p = self.vt100_parse_params(p, [0])
-        if not p:
-            self.attr = constants.DEFAULTSGR
-        while p:
-            m = p.pop(0)
-            if m == 0:
+        fg, bg, flags = self.styles[self.attr]
+        i, n = 0, len(p)
+        while i < n:
+            m = p[i]
+            if isinstance(m, tuple):
+                m = m[0]
+                if m == 38 or m == 48:
+                    color, i = self.sgr_color(p, i)
+                    if color is not None and m == 38:
+                        fg, flags = color, flags & ~constants.SGR39
+                    elif color is not None:
+                        bg, flags = color, flags & ~constants.SGR49
+                else:
+                    # Other sub parameters are ignored
+                    i += 1
+                continue
+            i += 1
+            if m == 0 or m is None:
                 # Reset
-                self.attr = constants.DEFAULTSGR
+                fg, bg, flags = self.DEFAULTSTYLE
             elif m == 1:
                 # Bright
-                self.attr |= constants.SGR1
+                flags |= constants.SGR1
             elif m == 4:
                 # Underlined
-                self.attr |= constants.SGR4
+                flags |= constants.SGR4
             elif m == 7:
                 # Negative
-                self.attr |= constants.SGR7
+                flags |= constants.SGR7
             elif m == 8:
                 # Concealed
-                self.attr |= constants.SGR8
+                flags |= constants.SGR8
             elif m == 24:
                 # Not underlined
-                self.attr &= (constants.SGR4 ^ 0xffffffff)
+                flags &= ~constants.SGR4
             elif m == 27:
                 # Positive
-                self.attr &= (constants.SGR7 ^ 0xffffffff)
+                flags &= ~constants.SGR7
             elif m == 28:
                 # Revealed
-                self.attr &= (constants.SGR8 ^ 0xffffffff)
+                flags &= ~constants.SGR8
             elif m >= 30 and m <= 37:
                 # Foreground
-                self.attr = (self.attr & (0xffff00ff ^ constants.SGR39)) | ((m - 30) << 8)
-            elif m == 38 and p and p[0] == 5 and 0 <= p[1] <= 255:
-                self.attr = (self.attr & (0xffff00ff ^ constants.SGR39)) | (p[1] << 8)
-                p = p[2:]
+                fg, flags = m - 30, flags & ~constants.SGR39
+            elif m == 38:
+                # 256 and 24-bit Foreground Mode
+                color, i = self.sgr_color(p, i - 1)
+                if color is not None:
+                    fg, flags = color, flags & ~constants.SGR39
             elif m == 39:
                 # Default fg color
-                self.attr |= constants.SGR39
+                flags |= constants.SGR39
             elif m >= 40 and m <= 47:
                 # Background
-                self.attr = (self.attr & (0xffffff00 ^ constants.SGR49)) | (m - 40)
-            elif m == 48 and p and p[0] == 5 and 0 <= p[1] <= 255:
-                # 255 Background Mode
-                self.attr = (self.attr & (0xffffff00 ^ constants.SGR49)) | p[1]
-                p = p[2:]
+                bg, flags = m - 40, flags & ~constants.SGR49
+            elif m == 48:
+                # 256 and 24-bit Background Mode
+                color, i = self.sgr_color(p, i - 1)
+                if color is not None:
+                    bg, flags = color, flags & ~constants.SGR49
             elif m == 49:
                 # Default bg color
-                self.attr |= constants.SGR49
+                flags |= constants.SGR49
+        self.attr = self.style_intern(fg, bg, flags)
 
     def csi_DSR(self, p):
         # Device status report
-        p = self.vt100_parse_params(p, ['0'], False)
-        if p[0] == '5':
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 5:
             self.vt100_out = "\x1b[0n"
-        elif p[0] == '6':
+        elif p[0] == 6:
             x = self.cx + 1
             y = self.cy + 1
             self.vt100_out = '\x1b[%d;%dR' % (y, x)
-        elif p[0] == '7':
+        elif p[0] == 7:
             self.vt100_out = 'WebShell'
-        elif p[0] == '8':
+        elif p[0] == 8:
             self.vt100_out = __version__
-        elif p[0] == '?6':
+
+    def csi_DECDSR(self, p):
+        # DEC device status report
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 6:
             x = self.cx + 1
             y = self.cy + 1
             self.vt100_out = '\x1b[?%d;%dR' % (y, x)
-        elif p[0] == '?15':
+        elif p[0] == 15:
             self.vt100_out = '\x1b[?13n'
-        elif p[0] == '?25':
+        elif p[0] == 25:
             self.vt100_out = '\x1b[?20n'
-        elif p[0] == '?26':
+        elif p[0] == 26:
             self.vt100_out = '\x1b[?27;1n'
-        elif p[0] == '?53':
+        elif p[0] == 53:
             self.vt100_out = '\x1b[?53n'
 
     def csi_DECSTBM(self, p):
@@ -900,123 +1033,93 @@ class Terminal(object):
 
     def csi_RCP(self, p):
         # Restore cursor position
-        self.cx = self.vt100_saved_cx
-        self.cy = self.vt100_saved_cy
+        self.cursor_set(self.vt100_saved_cy, self.vt100_saved_cx)
 
     def csi_DECREQTPARM(self, p):
         # Request terminal parameters
-        p = self.vt100_parse_params(p, [], False)
-        if p[0] == '0':
+        p = self.vt100_parse_params(p, [0])
+        if p[0] == 0:
             self.vt100_out = "\x1b[2;1;1;112;112;1;0x"
-        elif p[0] == '1':
+        elif p[0] == 1:
             self.vt100_out = "\x1b[3;1;1;112;112;1;0x"
 
     def csi_DECSTR(self, p):
         # Soft terminal reset
         self.reset_soft()
 
-    # VT100 Parser
-    def vt100_parse_params(self, p, d, to_int = True):
-        # Process parameters (params p with defaults d)
-        # Add prefix to all parameters
-        prefix = ''
-        if len(p) > 0:
-            if p[0] >= '<' and p[0] <= '?':
-                prefix = p[0]
-                p = p[1:]
-            p = p.split(';')
+    def osc_title(self, d):
+        # Set window title
+        self.title = d.decode('utf-8', 'replace')
+
+    def dcs_DECRQSS(self, p, d):
+        # Request selection or setting
+        if d == b'r':
+            self.vt100_out = '\x1bP1$r%d;%dr\x1b\\' % (
+                self.scroll_area_y0 + 1, self.scroll_area_y1)
         else:
-            p = ''
-        # Process parameters
-        n = max(len(p), len(d))
-        o = []
-        for i in range(n):
-            value_def = False
-            if i < len(p):
-                value = prefix + p[i]
-                value_def = True
-                if to_int:
-                    try:
-                        value = int(value)
-                    except ValueError:
-                        value_def = False
-            if (not value_def) and i < len(d):
-                value = d[i]
-            o.append(value)
+            self.vt100_out = '\x1bP0$r\x1b\\'
+
+    # VT100 Parser
+    def vt100_parse_params(self, p, d):
+        # Parameters p with defaults d, omitted values are None
+        o = list(p)
+        for i, value in enumerate(d):
+            if i >= len(o):
+                o.append(value)
+            elif o[i] is None:
+                o[i] = value
         return o
 
-    def vt100_parse_reset(self, vt100_parse_state = ""):
-        self.vt100_parse_state = vt100_parse_state
-        self.vt100_parse_len = 0
-        self.vt100_parse_func = ""
-        self.vt100_parse_param = ""
-
-    def vt100_parse_process(self):
-        if self.vt100_parse_state == 'esc':
-            # ESC mode
-            f = self.vt100_parse_func
-            try:
-                self.vt100_esc[f]()
-            except KeyError:
-                pass
-            if self.vt100_parse_state == 'esc':
-                self.vt100_parse_reset()
-        else:
-            # CSI mode
-            f = self.vt100_parse_func
-            p = self.vt100_parse_param
-            try:
-                self.vt100_csi[f](p)
-            except KeyError:
-                pass
-            if self.vt100_parse_state == 'csi':
-                self.vt100_parse_reset()
-
-    def vt100_write(self, char):
-        if char < 32:
-            if char == 27:
-                self.vt100_parse_reset('esc')
-                return True
-            elif char == 14:
-                self.ctrl_SO()
-            elif char == 15:
-                self.ctrl_SI()
-        elif (char & 0xffe0) == 0x0080:
-            self.vt100_parse_reset('esc')
-            self.vt100_parse_func = chr(char - 0x40)
-            self.vt100_parse_process()
-            return True
+    def vt100_print(self, d):
+        d = self.utf8_decode(d)
+        i, n = 0, len(d)
+        match = printable_run().match
+        while i < n:
+            m = match(d, i)
+            if m is not None:
+                self.dumb_echo_run(m.group())
+                i = m.end()
+                continue
+            char = ord(d[i])
+            i += 1
+            # C1 controls are not recognized in UTF-8
+            if char >= 0xa0:
+                self.vt100_lastchar = char
+                self.dumb_echo(char)
 
-        if self.vt100_parse_state:
-            if self.vt100_parse_state == 'str':
-                if char >= 32:
-                    return True
-                self.vt100_parse_reset()
-            else:
-                if char < 32:
-                    if char == 24 or char == 26:
-                        self.vt100_parse_reset()
-                        return True
-                else:
-                    self.vt100_parse_len += 1
-                    if self.vt100_parse_len > 32:
-                        self.vt100_parse_reset()
-                    else:
-                        char_msb = char & 0xf0
-                        if char_msb == 0x20:
-                            # Intermediate bytes (added to function)
-                            self.vt100_parse_func += unichr(char)
-                        elif char_msb == 0x30 and self.vt100_parse_state == 'csi':
-                            # Parameter byte
-                            self.vt100_parse_param += unichr(char)
-                        else:
-                            # Function byte
-                            self.vt100_parse_func += unichr(char)
-                            self.vt100_parse_process()
-                        return True
+    def vt100_execute(self, char):
+        if char == 14:
+            self.ctrl_SO()
+        elif char == 15:
+            self.ctrl_SI()
+        else:
+            self.dumb_write(char)
         self.vt100_lastchar = char
-        return False
 
+    def vt100_esc_dispatch(self, intermediates, final):
+        func = self.vt100_esc.get(intermediates + final)
+        if func is not None:
+            func()
+
+    def vt100_csi_dispatch(self, private, params, intermediates, final):
+        func = self.vt100_csi.get(private + intermediates + final)
+        if func is not None:
+            # Only SGR takes sub parameters
+            if final != 'm' and tuple in map(type, params):
+                return
+            func(params)
+
+    def vt100_osc_dispatch(self, payload):
+        command, _, d = payload.partition(b';')
+        if command.isdigit():
+            func = self.vt100_osc.get(int(command))
+            if func is not None:
+                func(d)
+
+    def vt100_dcs_dispatch(self, private, params, intermediates, final, payload):
+        func = self.vt100_dcs.get(private + intermediates + final)
+        if func is not None:
+            func(params, payload)
 
     # External interface
     def set_size(self, w, h):
@@ -1033,85 +1136,76 @@ class Terminal(object):
         return self.utf8_encode(d)
 
     def write(self, d):
-        d = self.utf8_decode(d)
-        for c in d:
-            char = ord(c)
-            if self.vt100_write(char):
-                continue
-            if self.dumb_write(char):
-                continue
-            if char <= 0xffff:
-                self.dumb_echo(char)
+        self.vt100_parser.feed(d)
         return True
 
+    def keys(self):
+        """Modes of the keyboard, for keyfilter"""
+        return (self.vt100_mode_cursorkey, self.vt100_mode_backspace,
+            self.vt100_mode_lfnewline)
+
     def pipe(self, d):
-        o = ''
-        for c in d:
-            char = ord(c)
-            if self.vt100_keyfilter_escape:
-                self.vt100_keyfilter_escape = False
-                try:
-                    if self.vt100_mode_cursorkey:
-                        o += self.vt100_keyfilter_appkeys[c]
-                    else:
-                        o += self.vt100_keyfilter_ansikeys[c]
-                except KeyError:
-                    pass
-            elif c == '~':
-                self.vt100_keyfilter_escape = True
-            elif char == 127:
-                if self.vt100_mode_backspace:
-                    o += chr(8)
-                else:
-                    o += chr(127)
-            else:
-                o += c
-                if self.vt100_mode_lfnewline and char == 13:
-                    o += chr(10)
-        return self.utf8_encode(o)
+        d, self.vt100_keyfilter_escape = keyfilter.translate(d, self.keys(),
+            self.vt100_keyfilter_escape)
+        return self.utf8_encode(d)
+
+    def dump_line(self, y):
+        return self.dump_row(*self.screen[y])
+
+    def dump_row(self, chars, attrs):
+        # The frontends reading shared screens build the same rows
+        return sharedscreen.dump_row(chars, attrs)
 
     def dump(self):
-        screen = []
         cx, cy = min(self.cx, self.w - 1), self.cy
-        for y in range(0, self.h):
-            wx = 0
-            attr_ = -1
-            line = [""]
-            for x in range(0, self.w):
-                char = self.screen[self.CHARACTERS][y * self.w + x]
-                attr = self.screen[self.ATTRIBUTES][y * self.w + x]
-                # Cursor
-                #if cy == y and cx == x and self.vt100_mode_cursor:
-                #    attr = attr & 0xfff0 | 0x000c
-                # Attributes
-                if attr != attr_:
-                    if attr_ != -1:
-                        line.append("")
-                    bg = attr & 0x000000ff
-                    fg = (attr & 0x0000ff00) >> 8
-                    flags = (attr & 0xffff0000)
-                    # Inverse
-                    #inv = attr & constants.SGR7
-                    #inv2 = self.vt100_mode_inverse
-                    #if (inv and not inv2) or (inv2 and not inv):
-                    #    fg, bg = bg, fg
-                    # Concealed
-                    #if attr & 0x0400:
-                    #    fg = 0xc
-                    # Underline
-                    #if attr & 0x0100:
-                    #    ul = True
-                    #else:
-                    #    ul = False
-                    line.append((fg, bg, flags))
-                    line.append("")
-                    attr_ = attr
-                wx += self.utf8_charwidth(char)
-                if wx <= self.w:
-                    line[-1] += unichr(char)
-            screen.append(line)
+        screen = [ self.dump_line(y) for y in range(0, self.h) ]
 
         # Scroll values
         su, sd = self._scroll_area_up, self._scroll_area_down
         self._scroll_area_up = self._scroll_area_down = 0
-        return (cx, cy, su, sd), screen
\ No newline at end of file
+        return (cx, cy, su, sd), screen
+
+    def dump_delta(self, since = 0, rows = True):
+        """Rows changed after frame number since, the returned frame
+        number is the since value for the next call. Without rows only
+        the numbers of the rows changed are returned, as 'changed'"""
+        changed = [ y for y in range(0, self.h) if self.row_frame[y] > since ]
+        styles = [ [attr, self.styles[attr]] for attr in range(len(self.styles))
+            if self.style_frame[attr] > since ]
+        if max(self.row_frame) == self.frame or \
+                (self.style_frame and self.style_frame[-1] == self.frame):
+            # Later changes are marked with the next frame number, the
+            # clients dumping before then share this one
+            self.frame += 1
+        frame = {
+            'frame': self.frame - 1,
+            'size': (self.w, self.h),
+            'cursor': (min(self.cx, self.w - 1), self.cy),
+            'history': (self.history_end - len(self.history), self.history_end),
+            'styles': styles,
+            'epoch': self.style_epoch,
+            'keys': self.keys()
+        }
+        if rows:
+            frame['rows'] = [ [y, self.dump_line(y)] for y in changed ]
+        else:
+            frame['changed'] = changed
+        return frame
+
+    def dump_history(self, start, count):
+        """Scrollback rows from number start, at most count of them,
+        rows already dropped are skipped"""
+        first = self.history_end - len(self.history)
+        start = max(start, first)
+        end = min(start + max(count, 0), self.history_end)
+        rows = list(itertools.islice(self.history, start - first, max(end - first, 0)))
+        used = set()
+        for chars, attrs in rows:
+            used.update(attrs)
+        return {
+            'history': (first, self.history_end),
+            'start': start,
+            'rows': [ self.dump_row(chars, attrs) for chars, attrs in rows ],
+            'styles': [ [attr, self.styles[attr]] for attr in sorted(used) ],
+            'epoch': self.style_epoch
+        }
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# DEC/ANSI escape sequence parser.
+# Implements the VT500 series state machine described by Paul Williams
+# http://vt100.net/emu/dec_ansi_parser
+# with precomputed transition tables. Bytes 0x80-0xff are not C1 controls
+# here, they are UTF-8 units and printed or collected as string payload.
+# License: GPL2
+
+import re
+
+# States
+GROUND = 0
+ESCAPE = 1
+ESCAPE_INTERMEDIATE = 2
+CSI_ENTRY = 3
+CSI_PARAM = 4
+CSI_INTERMEDIATE = 5
+CSI_IGNORE = 6
+DCS_ENTRY = 7
+DCS_PARAM = 8
+DCS_INTERMEDIATE = 9
+DCS_PASSTHROUGH = 10
+DCS_IGNORE = 11
+OSC_STRING = 12
+SOS_PM_APC_STRING = 13
+
+# Actions
+NONE = 0
+IGNORE = 1
+PRINT = 2
+EXECUTE = 3
+COLLECT = 4
+PARAM = 5
+ESC_DISPATCH = 6
+CSI_DISPATCH = 7
+PUT = 8
+OSC_PUT = 9
+
+MAX_PARAMS = 32
+MAX_PARAM_VALUE = 0xffff
+MAX_PAYLOAD = 4096
+
+# Runs of printable bytes and complete CSI sequences, both handled
+# without walking the tables byte by byte
+PRINTABLE_RUN = re.compile(b'[\x20-\x7e\x80-\xff]+')
+CSI_SEQUENCE = re.compile(b'\x1b\\[([<=>?]?)([0-9:;]*)([\x20-\x2f]*)([\x40-\x7e])')
+
+def _build_table():
+    table = [ [ (NONE << 4) | state ] * 256 for state in range(14) ]
+
+    def add(states, first, last, action, next_state=None):
+        for state in states:
+            for byte in range(first, last + 1):
+                table[state][byte] = (action << 4) | (
+                    state if next_state is None else next_state)
+
+    def add_c0(states, action):
+        add(states, 0x00, 0x17, action)
+        add(states, 0x19, 0x19, action)
+        add(states, 0x1c, 0x1f, action)
+
+    add_c0([GROUND, ESCAPE, ESCAPE_INTERMEDIATE,
+        CSI_ENTRY, CSI_PARAM, CSI_INTERMEDIATE, CSI_IGNORE], EXECUTE)
+    add_c0([DCS_ENTRY, DCS_PARAM, DCS_INTERMEDIATE, DCS_IGNORE,
+        OSC_STRING, SOS_PM_APC_STRING], IGNORE)
+    add_c0([DCS_PASSTHROUGH], PUT)
+
+    # Ground
+    add([GROUND], 0x20, 0x7e, PRINT)
+    add([GROUND], 0x7f, 0x7f, IGNORE)
+    add([GROUND], 0x80, 0xff, PRINT)
+
+    # Escape
+    add([ESCAPE], 0x20, 0x2f, COLLECT, ESCAPE_INTERMEDIATE)
+    add([ESCAPE], 0x30, 0x7e, ESC_DISPATCH, GROUND)
+    add([ESCAPE], 0x50, 0x50, NONE, DCS_ENTRY)
+    add([ESCAPE], 0x58, 0x58, NONE, SOS_PM_APC_STRING)
+    add([ESCAPE], 0x5b, 0x5b, NONE, CSI_ENTRY)
+    add([ESCAPE], 0x5d, 0x5d, NONE, OSC_STRING)
+    add([ESCAPE], 0x5e, 0x5f, NONE, SOS_PM_APC_STRING)
+    add([ESCAPE_INTERMEDIATE], 0x20, 0x2f, COLLECT)
+    add([ESCAPE_INTERMEDIATE], 0x30, 0x7e, ESC_DISPATCH, GROUND)
+
+    # Control sequences, ':' separates sub parameters
+    add([CSI_ENTRY], 0x20, 0x2f, COLLECT, CSI_INTERMEDIATE)
+    add([CSI_ENTRY], 0x30, 0x3b, PARAM, CSI_PARAM)
+    add([CSI_ENTRY], 0x3c, 0x3f, COLLECT, CSI_PARAM)
+    add([CSI_ENTRY], 0x40, 0x7e, CSI_DISPATCH, GROUND)
+    add([CSI_PARAM], 0x20, 0x2f, COLLECT, CSI_INTERMEDIATE)
+    add([CSI_PARAM], 0x30, 0x3b, PARAM)
+    add([CSI_PARAM], 0x3c, 0x3f, NONE, CSI_IGNORE)
+    add([CSI_PARAM], 0x40, 0x7e, CSI_DISPATCH, GROUND)
+    add([CSI_INTERMEDIATE], 0x20, 0x2f, COLLECT)
+    add([CSI_INTERMEDIATE], 0x30, 0x3f, NONE, CSI_IGNORE)
+    add([CSI_INTERMEDIATE], 0x40, 0x7e, CSI_DISPATCH, GROUND)
+    add([CSI_IGNORE], 0x40, 0x7e, NONE, GROUND)
+
+    # Device control strings
+    add([DCS_ENTRY], 0x20, 0x2f, COLLECT, DCS_INTERMEDIATE)
+    add([DCS_ENTRY], 0x30, 0x3b, PARAM, DCS_PARAM)
+    add([DCS_ENTRY], 0x3c, 0x3f, COLLECT, DCS_PARAM)
+    add([DCS_ENTRY], 0x40, 0x7e, COLLECT, DCS_PASSTHROUGH)
+    add([DCS_PARAM], 0x20, 0x2f, COLLECT, DCS_INTERMEDIATE)
+    add([DCS_PARAM], 0x30, 0x3b, PARAM)
+    add([DCS_PARAM], 0x3c, 0x3f, NONE, DCS_IGNORE)
+    add([DCS_PARAM], 0x40, 0x7e, COLLECT, DCS_PASSTHROUGH)
+    add([DCS_INTERMEDIATE], 0x20, 0x2f, COLLECT)
+    add([DCS_INTERMEDIATE], 0x30, 0x3f, NONE, DCS_IGNORE)
+    add([DCS_INTERMEDIATE], 0x40, 0x7e, COLLECT, DCS_PASSTHROUGH)
+    add([DCS_PASSTHROUGH], 0x20, 0x7e, PUT)
+    add([DCS_PASSTHROUGH], 0x80, 0xff, PUT)
+
+    # Operating system commands, terminated by ST or BEL as xterm does
+    add([OSC_STRING], 0x20, 0x7f, OSC_PUT)
+    add([OSC_STRING], 0x80, 0xff, OSC_PUT)
+    add([OSC_STRING], 0x07, 0x07, EXECUTE, GROUND)
+
+    # Text cancels unfinished escape and control sequences
+    add([ESCAPE, ESCAPE_INTERMEDIATE, CSI_ENTRY, CSI_PARAM,
+        CSI_INTERMEDIATE, CSI_IGNORE], 0x80, 0xff, PRINT, GROUND)
+
+    # Anywhere
+    for state in range(14):
+        add([state], 0x18, 0x18, EXECUTE, GROUND)
+        add([state], 0x1a, 0x1a, EXECUTE, GROUND)
+        add([state], 0x1b, 0x1b, NONE, ESCAPE)
+    return table
+
+TABLE = _build_table()
+
+def parse_param(value):
+    if not value:
+        return None
+    return min(int(value[:6]), MAX_PARAM_VALUE)
+
+def parse_params(data):
+    # Parameter bytes to integers, sub parameters grouped in tuples
+    if not data:
+        return []
+    params = []
+    for value in data.split(b';')[:MAX_PARAMS]:
+        if b':' in value:
+            params.append(tuple([ parse_param(sub) for sub in value.split(b':') ]))
+        else:
+            params.append(parse_param(value))
+    return params
+
+class Parser(object):
+    """Feed bytes, get calls on the handler:
+        vt100_print(data)
+        vt100_execute(byte)
+        vt100_esc_dispatch(intermediates, final)
+        vt100_csi_dispatch(private, params, intermediates, final)
+        vt100_osc_dispatch(payload)
+        vt100_dcs_dispatch(private, params, intermediates, final, payload)
+    The state is kept between calls, sequences can be split anywhere."""
+    def __init__(self, handler):
+        self.print_ = handler.vt100_print
+        self.execute = handler.vt100_execute
+        self.esc_dispatch = handler.vt100_esc_dispatch
+        self.csi_dispatch = handler.vt100_csi_dispatch
+        self.osc_dispatch = handler.vt100_osc_dispatch
+        self.dcs_dispatch = handler.vt100_dcs_dispatch
+        self.reset()
+
+    def reset(self):
+        self.state = GROUND
+        self.clear()
+
+    def clear(self):
+        self.private = ""
+        self.intermediates = ""
+        self.params = []
+        self.param = None
+        self.subparams = None
+        self.payload = bytearray()
+
+    # Parameters
+    def param_end(self):
+        if self.subparams is not None:
+            self.subparams.append(self.param)
+            param = tuple(self.subparams)
+            self.subparams = None
+        else:
+            param = self.param
+        self.param = None
+        if len(self.params) < MAX_PARAMS:
+            self.params.append(param)
+
+    def param_byte(self, byte):
+        if byte == 0x3b:
+            self.param_end()
+        elif byte == 0x3a:
+            if self.subparams is None:
+                self.subparams = []
+            self.subparams.append(self.param)
+            self.param = None
+        else:
+            self.param = min((self.param or 0) * 10 + byte - 0x30, MAX_PARAM_VALUE)
+
+    def collected_params(self):
+        if self.params or self.param is not None or self.subparams is not None:
+            self.param_end()
+        return self.params
+
+    # State changes
+    def leave(self, state):
+        if state == OSC_STRING:
+            self.osc_dispatch(bytes(self.payload))
+        elif state == DCS_PASSTHROUGH:
+            self.dcs_dispatch(self.private, self.collected_params(),
+                self.intermediates[:-1], self.intermediates[-1:],
+                bytes(self.payload))
+
+    def enter(self, state):
+        if state in (ESCAPE, CSI_ENTRY, DCS_ENTRY, OSC_STRING):
+            self.clear()
+
+    def feed(self, data):
+        state = self.state
+        table = TABLE
+        i, n = 0, len(data)
+        while i < n:
+            if state == GROUND:
+                m = PRINTABLE_RUN.match(data, i)
+                if m is not None:
+                    i = m.end()
+                    self.print_(m.group())
+                    continue
+                m = CSI_SEQUENCE.match(data, i)
+                if m is not None:
+                    i = m.end()
+                    private, params, intermediates, final = m.groups()
+                    self.csi_dispatch(private.decode('latin-1'),
+                        parse_params(params),
+                        intermediates.decode('latin-1'),
+                        final.decode('latin-1'))
+                    continue
+            byte = data[i]
+            i += 1
+            transition = table[state][byte]
+            action, next_state = transition >> 4, transition & 0x0f
+            if next_state != state:
+                self.leave(state)
+            if action == PARAM:
+                self.param_byte(byte)
+            elif action == COLLECT:
+                # Private markers come first, then intermediates
+                if byte >= 0x3c and byte <= 0x3f and not self.intermediates:
+                    self.private += chr(byte)
+                else:
+                    self.intermediates += chr(byte)
+            elif action == PUT or action == OSC_PUT:
+                if len(self.payload) < MAX_PAYLOAD:
+                    self.payload.append(byte)
+            elif action == EXECUTE:
+                self.execute(byte)
+            elif action == CSI_DISPATCH:
+                self.csi_dispatch(self.private, self.collected_params(),
+                    self.intermediates, chr(byte))
+            elif action == ESC_DISPATCH:
+                self.esc_dispatch(self.intermediates, chr(byte))
+            elif action == PRINT:
+                self.print_(data[i - 1:i])
+            if next_state != state:
+                self.enter(next_state)
+                state = next_state
+        self.state = state
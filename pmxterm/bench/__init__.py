@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the terminal emulation, run them with
+#   python -m pmxterm.bench --help
+
+import os
+import sys
+
+# The backend modules import each other as top level modules
+BACKEND_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "backend"))
+if BACKEND_PATH not in sys.path:
+    sys.path.insert(0, BACKEND_PATH)
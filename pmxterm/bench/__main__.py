@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Terminal emulation benchmark.
+# Usage: python -m pmxterm.bench [-s <size>] [-r <repeat>] [-c <cases>]
+#            [-S <screens>] [-k <chunk>] [-j <file>]
+
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+from . import BACKEND_PATH
+from .corpus import CASES
+from vt100 import Terminal
+
+def chunks(data, size):
+    return [ data[i:i + size] for i in range(0, len(data), size) ]
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def rank(p):
+        return samples[min(int(len(samples) * p), len(samples) - 1)] * 1e3
+    return {
+        'p50': rank(0.50),
+        'p90': rank(0.90),
+        'p99': rank(0.99),
+        'max': samples[-1] * 1e3
+    }
+
+def report_to(destination):
+    # The text report goes to the standard error when the JSON goes to
+    # the standard output
+    return sys.stderr if destination == "-" else sys.stdout
+
+def write_json(document, destination):
+    # The results as JSON in the file destination, "-" for the standard
+    # output, nowhere without one
+    if destination == "-":
+        json.dump(document, sys.stdout, indent = 2)
+        sys.stdout.write("\n")
+    elif destination:
+        with open(destination, "w") as f:
+            json.dump(document, f, indent = 2)
+
+def measure_write(data, w, h, size, repeat):
+    # Best time writing the data as reads of size bytes
+    pieces = chunks(data, size)
+    best = None
+    for _ in range(repeat):
+        term = Terminal(w, h)
+        write = term.write
+        start = time.perf_counter()
+        for piece in pieces:
+            write(piece)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def measure_dump(data, w, h, size):
+    # Latency of a full dump and of a delta frame after every read
+    dumps = []
+    deltas = []
+    term = Terminal(w, h)
+    frame = 0
+    for piece in chunks(data, size):
+        term.write(piece)
+        start = time.perf_counter()
+        term.dump()
+        dumps.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        frame = term.dump_delta(frame)['frame']
+        deltas.append(time.perf_counter() - start)
+    return percentiles(dumps), percentiles(deltas)
+
+def measure_memory(data, w, h, size):
+    # Peak of the memory allocated by the terminal while writing
+    tracemalloc.start()
+    try:
+        term = Terminal(w, h)
+        for piece in chunks(data, size):
+            term.write(piece)
+        term.dump()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd = BACKEND_PATH, stderr = subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def screen_size(value):
+    try:
+        w, h = [ int(n) for n in value.lower().split("x") ]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a screen size like 80x24" % value)
+    return (w, h)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pmxterm.bench",
+        description = "Terminal.write throughput and Terminal.dump latency.")
+    parser.add_argument('-s', metavar='<size>', dest='size', type=int,
+        default=1 << 20, help='Bytes of output to feed the terminal per case'
+    )
+    parser.add_argument('-r', metavar='<repeat>', dest='repeat', type=int,
+        default=3, help='Number of write runs, the best one is reported'
+    )
+    parser.add_argument('-c', metavar='<cases>', dest='cases', type=str,
+        default=",".join(name for name, corpus in CASES),
+        help='Comma separated cases to run'
+    )
+    parser.add_argument('-S', metavar='<screens>', dest='screens', type=str,
+        default="80x24,132x50,240x80", help='Comma separated screen sizes'
+    )
+    parser.add_argument('-k', metavar='<chunk>', dest='chunk', type=int,
+        default=4096, help='Bytes per write, like a read from the pty'
+    )
+    parser.add_argument('-j', metavar='<file>', dest='json', type=str,
+        help='Write the results as JSON, "-" for the standard output'
+    )
+    args = parser.parse_args(argv)
+
+    corpora = dict(CASES)
+    names = [ name for name in args.cases.split(",") if name ]
+    for name in names:
+        if name not in corpora:
+            parser.error("unknown case %r, choose from %s" % (
+                name, ", ".join(name for name, corpus in CASES)))
+    try:
+        screens = [ screen_size(value) for value in args.screens.split(",") ]
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+
+    report = report_to(args.json)
+    results = []
+    for name in names:
+        for w, h in screens:
+            data = corpora[name](args.size, w, h)
+            elapsed = measure_write(data, w, h, args.chunk, args.repeat)
+            dump, delta = measure_dump(data, w, h, args.chunk)
+            peak = measure_memory(data, w, h, args.chunk)
+            result = {
+                'case': name,
+                'screen': "%dx%d" % (w, h),
+                'bytes': len(data),
+                'seconds': elapsed,
+                'mb_per_s': len(data) / elapsed / 1e6,
+                'ns_per_byte': elapsed / len(data) * 1e9,
+                'dump_ms': dump,
+                'delta_ms': delta,
+                'peak_kib': peak / 1024.0
+            }
+            results.append(result)
+            report.write("%-10s %8s %7.2f MB/s %8.1f ns/B  dump p50 %.3f p99 %.3f ms"
+                "  delta p50 %.3f p99 %.3f ms  peak %.0f KiB\n" % (
+                name, result['screen'], result['mb_per_s'], result['ns_per_byte'],
+                dump['p50'], dump['p99'], delta['p50'], delta['p99'], result['peak_kib']))
+            report.flush()
+
+    if args.json:
+        document = {
+            'revision': revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'size': args.size,
+            'chunk': args.chunk,
+            'repeat': args.repeat,
+            'results': results
+        }
+        write_json(document, args.json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contention between the sessions of one multiplexer: latency of a
+# keystroke and frame dump on a quiet session, and of its echo frame,
+# alone, while another session floods its terminal with output and
+# while text is pasted into another session.
+# Usage: python -m pmxterm.bench.contention [-n <samples>] [-j <file>]
+
+import sys
+import time
+import queue
+import argparse
+import threading
+
+from . import BACKEND_PATH
+from .__main__ import percentiles, report_to, write_json
+from multiplexer import Multiplexer
+
+CLIENT = "bench"
+
+# Colored output as fast as the pty takes it
+FLOOD = ("import sys\n"
+    "line = ''.join('\\x1b[3%dmword%d ' % (i % 8, i) for i in range(12)) + '\\x1b[0m\\r\\n'\n"
+    "while True:\n"
+    "    sys.stdout.write(line * 64)\n")
+
+def drain(notifications, echoed):
+    # Frames are dropped, as a notifier would send them, the ones of
+    # the quiet session are signaled
+    while True:
+        message = notifications.get()
+        if message is None:
+            break
+        if message.get('payload', {}).get('sid') == "quiet":
+            echoed.set()
+
+def paste(multiplexer, sid, size, stop):
+    text = ("pasted line of text\r" * (size // 20 + 1))[:size]
+    while not stop.is_set():
+        multiplexer.proc_write(CLIENT, sid, text)
+
+def wait_alive(multiplexer, sid, timeout = 5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        session = multiplexer.session.get(sid)
+        if session is not None and session['state'] == 'alive' and 'fd' in session:
+            return True
+        time.sleep(0.01)
+    return False
+
+def sample(multiplexer, sid, count, interval):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        multiplexer.proc_write(CLIENT, sid, "x")
+        multiplexer.proc_dump_delta(CLIENT, sid)
+        samples.append(time.perf_counter() - start)
+        time.sleep(interval)
+    return samples
+
+def sample_echo(multiplexer, sid, count, interval, echoed):
+    samples = []
+    for i in range(count):
+        echoed.clear()
+        start = time.perf_counter()
+        multiplexer.proc_write(CLIENT, sid, "x")
+        if echoed.wait(1.0):
+            samples.append(time.perf_counter() - start)
+        time.sleep(interval)
+    return samples
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pmxterm.bench.contention",
+        description = "Keystroke latency of a session while another one floods.")
+    parser.add_argument('-n', metavar='<samples>', dest='samples', type=int,
+        default=500, help='Keystrokes measured per scenario'
+    )
+    parser.add_argument('-i', metavar='<interval>', dest='interval', type=float,
+        default=0.002, help='Seconds between keystrokes'
+    )
+    parser.add_argument('-p', metavar='<paste>', dest='paste', type=int,
+        default=64 * 1024, help='Characters per paste'
+    )
+    parser.add_argument('-j', metavar='<file>', dest='json', type=str,
+        help='Write the results as JSON, "-" for the standard output'
+    )
+    args = parser.parse_args(argv)
+
+    notifications = queue.Queue()
+    echoed = threading.Event()
+    drainer = threading.Thread(target = drain, args = (notifications, echoed))
+    drainer.start()
+    multiplexer = Multiplexer(notifications, cmd = "/bin/cat", timeout = 3600)
+    results = {}
+    try:
+        multiplexer.proc_keepalive(CLIENT, "quiet", 80, 24)
+        wait_alive(multiplexer, "quiet")
+        results['idle'] = percentiles(sample(multiplexer, "quiet", args.samples, args.interval))
+        results['idle_echo'] = percentiles(sample_echo(multiplexer, "quiet", args.samples,
+            multiplexer.frame_interval, echoed))
+        multiplexer.proc_keepalive(CLIENT, "flood", 80, 24, [ sys.executable, "-c", FLOOD ])
+        wait_alive(multiplexer, "flood")
+        time.sleep(0.5)
+        results['flood'] = percentiles(sample(multiplexer, "quiet", args.samples, args.interval))
+        results['flood_echo'] = percentiles(sample_echo(multiplexer, "quiet", args.samples,
+            multiplexer.frame_interval, echoed))
+        multiplexer.proc_bury(CLIENT, "flood")
+        multiplexer.proc_keepalive(CLIENT, "paste", 80, 24)
+        wait_alive(multiplexer, "paste")
+        stop = threading.Event()
+        paster = threading.Thread(target = paste,
+            args = (multiplexer, "paste", args.paste, stop))
+        paster.start()
+        try:
+            results['paste'] = percentiles(sample(multiplexer, "quiet", args.samples, args.interval))
+        finally:
+            stop.set()
+            paster.join()
+    finally:
+        multiplexer.stop()
+        notifications.put(None)
+        drainer.join()
+
+    report = report_to(args.json)
+    for name in ('idle', 'idle_echo', 'flood', 'flood_echo', 'paste'):
+        report.write("%-10s keystroke p50 %.3f p90 %.3f p99 %.3f max %.3f ms\n" % (
+            name, results[name]['p50'], results[name]['p90'],
+            results[name]['p99'], results[name]['max']))
+    write_json(results, args.json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Deterministic synthetic terminal output. Every case is a function of
+# (size, w, h) returning size bytes, the same ones on every run.
+
+import random
+
+SEED = 0x5eed
+
+def _fill(size, line):
+    # Join line(i) until size bytes
+    chunks = []
+    total = i = 0
+    while total < size:
+        chunk = line(i).encode("utf-8")
+        chunks.append(chunk)
+        total += len(chunk)
+        i += 1
+    return b"".join(chunks)[:size]
+
+def ascii_flood(size, w, h):
+    # Plain ASCII output, like running cat on a big log
+    return _fill(size, lambda i: "%06d 2026-10-18 12:00:00 INFO worker.py:%d "
+        "processed request id=%08x status=ok\r\n" % (i, i % 997, i * 7919))
+
+def dense_sgr(size, w, h):
+    # Colored compiler diagnostics, 256 and 24-bit colors
+    return _fill(size, lambda i: "\x1b[1m\x1b[38;5;%dmsrc/module%d.c:%d:%d:\x1b[0m "
+        "\x1b[1;31merror:\x1b[0m unused variable \x1b[1m'v%d'\x1b[0m "
+        "\x1b[38;2;%d;%d;%dm[-Wunused]\x1b[39m\r\n" % (
+            i % 256, i % 13, i, i % 80, i, i % 256, (i * 7) % 256, (i * 13) % 256))
+
+def tui_redraw(size, w, h):
+    # Full screen applications repainting every row with cursor addressing
+    rnd = random.Random(SEED)
+    words = [ "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(2, 9)))
+        for _ in range(64) ]
+    def frame(i):
+        rows = [ "\x1b[H\x1b[44;37m PID USER %s\x1b[K\x1b[0m" % (" " * max(w - 10, 0)) ]
+        for y in range(2, h + 1):
+            text = " ".join(rnd.choice(words) for _ in range(w // 6))[:w - 20]
+            rows.append("\x1b[%d;1H\x1b[3%dm%5d\x1b[0m %s \x1b[1m%5.1f%%\x1b[0m\x1b[K" % (
+                y, (i + y) % 8, rnd.randint(1, 99999), text, rnd.random() * 100))
+        rows.append("\x1b[%d;%dH" % (h, 1))
+        return "".join(rows)
+    return _fill(size, frame)
+
+def wide_cjk(size, w, h):
+    # Double width text mixed with ASCII
+    rnd = random.Random(SEED)
+    chars = [ chr(c) for c in range(0x4e00, 0x4e00 + 512) ] + [ chr(c) for c in range(0xac00, 0xac00 + 128) ]
+    return _fill(size, lambda i: "%d: %s ok\r\n" % (
+        i, "".join(rnd.choice(chars) for _ in range(rnd.randint(5, 60)))))
+
+def scroll_region(size, w, h):
+    # Scroll regions, inserted and deleted lines, reverse index, like an
+    # editor or a pager scrolling part of the screen
+    top, bottom = 2, max(h - 2, 3)
+    def burst(i):
+        lines = [ "\x1b[%d;%dr\x1b[%d;1H" % (top, bottom, bottom) ]
+        lines.extend("\r\nline %d of burst %d" % (n, i) for n in range(8))
+        lines.append("\x1b[%d;1H\x1bM\x1bMreverse %d" % (top, i))
+        lines.append("\x1b[%d;1H\x1b[3L\x1b[2Minserted %d" % (top + 1, i))
+        lines.append("\x1b[r\x1b[%d;1Hstatus %d\x1b[K" % (h, i))
+        return "".join(lines)
+    return _fill(size, burst)
+
+def alt_screen(size, w, h):
+    # Short full screen programs, saving the cursor and switching to
+    # the alternate screen and back
+    def session(i):
+        page = "".join("\x1b[%d;1Hpager line %d of %d\x1b[K" % (y, y, i) for y in range(1, h + 1))
+        return "$ less file%d\r\n\x1b7\x1b[?47h\x1b[2J%s\x1b[2J\x1b[?47l\x1b8" % (i, page)
+    return _fill(size, session)
+
+CASES = (
+    ("ascii", ascii_flood),
+    ("sgr", dense_sgr),
+    ("tui", tui_redraw),
+    ("cjk", wide_cjk),
+    ("scroll", scroll_region),
+    ("altscreen", alt_screen),
+)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Echo latency of a backend: from a keystroke sent on the command socket
+# to its frame on the notifier socket, with the roles in processes
+# joined by queues and with everything on one event loop. With -d the
+# keystrokes are also written to the pty passed in direct mode.
+# Usage: python -m pmxterm.bench.echo [-n <samples>] [-e <engines>]
+#            [-w <workers>] [-d] [-j <file>]
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import select
+import argparse
+import tempfile
+import subprocess
+
+from multiprocessing.reduction import recv_handle
+
+from . import BACKEND_PATH
+from .__main__ import percentiles, report_to, write_json
+import protocol
+
+MAIN = os.path.join(BACKEND_PATH, "main.py")
+
+def start_backend(engine, workers):
+    backend = subprocess.Popen([ sys.executable, MAIN, "-t", "unix", "-e", engine, "-w", str(workers) ],
+        stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, start_new_session = True)
+    backend.stdout.readline()
+    return backend, json.loads(backend.stdout.readline().decode("utf-8"))['address']
+
+def stop_backend(backend):
+    backend.terminate()
+    try:
+        backend.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(backend.pid, signal.SIGKILL)
+        backend.wait()
+        raise RuntimeError("The backend did not stop on SIGTERM")
+
+def receive(connection, decoder, timeout):
+    # Messages of the next read, none when it times out
+    if not select.select([ connection ], [], [], timeout)[0]:
+        return []
+    data = connection.recv(1 << 20)
+    return decoder.feed(data) if data else []
+
+def handoff(commands, encoder, sid):
+    # The pty of the session, passed to a socket of ours
+    path = tempfile.mktemp(prefix = "pmxbench")
+    listener = socket.socket(socket.AF_UNIX)
+    listener.bind(path)
+    listener.listen(1)
+    try:
+        commands.sendall(encoder.encode({ 'command': 'proc_direct', 'args': [ sid, path ] }))
+        connection, _ = listener.accept()
+        with connection:
+            return recv_handle(connection)
+    finally:
+        listener.close()
+        os.unlink(path)
+
+def measure(engine, workers, count, interval, direct = False):
+    backend, address = start_backend(engine, workers)
+    path = tempfile.mktemp(prefix = "pmxbench")
+    listener = socket.socket(socket.AF_UNIX)
+    listener.bind(path)
+    listener.listen(1)
+    commands = socket.socket(socket.AF_UNIX)
+    samples = []
+    fd = None
+    try:
+        commands.connect(address)
+        encoder = protocol.Encoder([])
+        commands.sendall(protocol.hello())
+        commands.sendall(encoder.encode({ 'command': 'setup_channel', 'args': [ path ] }))
+        commands.sendall(encoder.encode({ 'command': 'proc_keepalive', 'args': [ "echo", 80, 24, "/bin/cat" ] }))
+        hello = protocol.Decoder().feed(commands.recv(4096))
+        encoder = protocol.Encoder(protocol.agree(hello[0][1]))
+        notifications, _ = listener.accept()
+        decoder = protocol.Decoder()
+        # The first frames of the session
+        while receive(notifications, decoder, 0.5):
+            pass
+        if direct:
+            fd = handoff(commands, encoder, "echo")
+        for i in range(count):
+            start = time.perf_counter()
+            if direct:
+                os.write(fd, b"x")
+            else:
+                commands.sendall(encoder.encode({ 'command': 'proc_write', 'args': [ "echo", "x" ] }))
+            while True:
+                messages = receive(notifications, decoder, 2.0)
+                if not messages or any('screen' in message for kind, message in messages):
+                    break
+            if messages:
+                samples.append(time.perf_counter() - start)
+            time.sleep(interval)
+            while receive(notifications, decoder, 0):
+                pass
+    finally:
+        if fd is not None:
+            os.close(fd)
+        commands.close()
+        listener.close()
+        os.unlink(path)
+        stop_backend(backend)
+    return samples
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pmxterm.bench.echo",
+        description = "Keystroke to echo frame latency of the backend engines.")
+    parser.add_argument('-n', metavar='<samples>', dest='samples', type=int,
+        default=200, help='Keystrokes measured per engine'
+    )
+    parser.add_argument('-i', metavar='<interval>', dest='interval', type=float,
+        default=0.02, help='Seconds between keystrokes, over the frame interval'
+    )
+    parser.add_argument('-e', metavar='<engines>', dest='engines', type=str,
+        default="process,asyncio", help='Comma separated engines'
+    )
+    parser.add_argument('-w', metavar='<workers>', dest='workers', type=int,
+        default=1, help='Multiplexer processes of the "process" engine'
+    )
+    parser.add_argument('-d', dest='direct', action='store_true',
+        help='Also measure the keystrokes written to the pty in direct mode'
+    )
+    parser.add_argument('-j', metavar='<file>', dest='json', type=str,
+        help='Write the results as JSON, "-" for the standard output'
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    engines = []
+    for engine in args.engines.split(","):
+        for direct in (False, True) if args.direct else (False, ):
+            name = direct and engine + "+direct" or engine
+            samples = measure(engine, args.workers, args.samples, args.interval, direct)
+            results[name] = percentiles(samples)
+            results[name]['missed'] = args.samples - len(samples)
+            engines.append(name)
+
+    report = report_to(args.json)
+    for engine in engines:
+        report.write("%-15s echo p50 %.3f p90 %.3f p99 %.3f max %.3f ms, %d missed\n" % (
+            engine, results[engine]['p50'], results[engine]['p90'],
+            results[engine]['p99'], results[engine]['max'], results[engine]['missed']))
+    write_json(results, args.json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
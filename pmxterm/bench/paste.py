@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Throughput of a paste: text written to a session with one command,
+# or in pieces, counted by the process once it is all read, and the
+# longest time a write kept the caller.
+# Usage: python -m pmxterm.bench.paste [-s <megabytes>] [-k <chunk>]
+#            [-j <file>]
+
+import sys
+import time
+import queue
+import argparse
+import threading
+
+from . import BACKEND_PATH
+from .__main__ import report_to, write_json
+from multiplexer import Multiplexer
+
+CLIENT = "bench"
+
+# Counts the bytes it reads, without echo so the paste is not parsed
+COUNTER = [ "/bin/sh", "-c", "stty -echo; wc -c; sleep 60" ]
+
+class Counted(threading.Thread):
+    """Drains the notifications until a frame shows a line with only
+    a number, the count of wc"""
+    def __init__(self, notifications):
+        threading.Thread.__init__(self)
+        self.notifications = notifications
+        self.count = None
+        self.held = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while True:
+            message = self.notifications.get()
+            if message is None:
+                break
+            payload = message.get('payload', {})
+            if 'input' in payload and payload['input']['held']:
+                self.held += 1
+            for y, line in payload.get('screen', {}).get('rows', []):
+                text = "".join(item for item in line if isinstance(item, str)).strip()
+                if text.isdigit():
+                    self.count = int(text)
+                    self.done.set()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pmxterm.bench.paste",
+        description = "Paste throughput into a session.")
+    parser.add_argument('-s', metavar='<megabytes>', dest='size', type=float,
+        default=10, help='Size of the paste'
+    )
+    parser.add_argument('-k', metavar='<chunk>', dest='chunk', type=int,
+        default=0, help='Characters per write, 0 for the whole paste at once'
+    )
+    parser.add_argument('-j', metavar='<file>', dest='json', type=str,
+        help='Write the results as JSON, "-" for the standard output'
+    )
+    args = parser.parse_args(argv)
+
+    size = int(args.size * 1024 * 1024)
+    text = ("pasted line of text\r" * (size // 20 + 1))[:size - 1] + "\r"
+    chunk = args.chunk or size
+
+    notifications = queue.Queue()
+    counted = Counted(notifications)
+    counted.start()
+    multiplexer = Multiplexer(notifications, timeout = 3600)
+    try:
+        multiplexer.proc_keepalive(CLIENT, "paste", 80, 24, COUNTER)
+        time.sleep(0.5)
+        longest = 0
+        start = time.perf_counter()
+        for i in range(0, size, chunk):
+            call = time.perf_counter()
+            multiplexer.proc_write(CLIENT, "paste", text[i:i + chunk])
+            longest = max(longest, time.perf_counter() - call)
+        # End of file for wc
+        multiplexer.proc_write(CLIENT, "paste", "\x04")
+        counted.done.wait(60)
+        elapsed = time.perf_counter() - start
+    finally:
+        multiplexer.stop()
+        notifications.put(None)
+        counted.join()
+
+    results = {
+        'bytes': size,
+        'counted': counted.count,
+        'seconds': elapsed,
+        'mb_per_s': size / elapsed / 1024 / 1024,
+        'longest_write_ms': longest * 1e3,
+        'held': counted.held
+    }
+    report = report_to(args.json)
+    report.write("paste %d bytes, %s counted, %.1f MB/s, longest write %.1f ms, held %d times\n" % (
+        size, counted.count, results['mb_per_s'], results['longest_write_ms'], counted.held))
+    write_json(results, args.json)
+    return 0 if counted.count == size else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
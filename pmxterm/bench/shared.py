@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cost of a screen frame from the backend to a local frontend: rows
+# dumped, encoded and decoded as JSON, or written to a shared screen with
+# only the numbers of the rows in the JSON and read back by the frontend.
+# Both times include turning the rows into runs of text for the widget,
+# the shared screen saves bytes on the wire more than time, and only on
+# large screens. The rows read from the shared screen are checked
+# against the JSON ones.
+# Usage: python -m pmxterm.bench.shared [-s <size>] [-n <frames>]
+#            [-j <file>]
+
+import sys
+import time
+import argparse
+
+from multiprocessing import resource_tracker
+
+from . import BACKEND_PATH
+from .corpus import CASES
+from .__main__ import chunks, report_to, write_json
+import protocol
+import sharedscreen
+from vt100 import Terminal
+
+def redraw(term, case, n):
+    # Output of a full screen program, about a screen in each frame
+    data = dict(CASES)[case](n * term.w * term.h * 2, term.w, term.h)
+    for piece in chunks(data, len(data) // n):
+        term.write(piece)
+        yield
+
+def measure_json(w, h, case, n):
+    term = Terminal(w, h)
+    encoder = protocol.Encoder(['zlib'])
+    decoder = protocol.Decoder()
+    frames, elapsed, size = [], 0.0, 0
+    for _ in redraw(term, case, n):
+        start = time.perf_counter()
+        frame = term.dump_delta(frames and frames[-1]['frame'] or 0)
+        data = encoder.encode({'sid': "bench", 'screen': frame})
+        message = decoder.feed(data)[0][1]
+        elapsed += time.perf_counter() - start
+        size += len(data)
+        frames.append(message['screen'])
+    return elapsed, size, frames
+
+def measure_shared(w, h, case, n):
+    term = Terminal(w, h)
+    encoder = protocol.Encoder(['zlib'])
+    decoder = protocol.Decoder()
+    screen = sharedscreen.SharedScreen(w, h)
+    reader = sharedscreen.SharedScreenReader(screen.name)
+    if reader.untracked:
+        # Same process, the segment is still the one to remove at exit
+        resource_tracker.register(screen.shm._name, "shared_memory")
+    frames, elapsed, size = [], 0.0, 0
+    try:
+        for _ in redraw(term, case, n):
+            start = time.perf_counter()
+            # As proc_dump_shared in the backend and Session in the frontend
+            screen.write(w, h, [ (y, ) + tuple(term.screen[y])
+                for y in range(h) if term.row_frame[y] > screen.since ])
+            screen.since = term.frame - 1
+            frame = term.dump_delta(frames and frames[-1]['frame'] or 0, rows = False)
+            frame['name'] = screen.name
+            data = encoder.encode({'sid': "bench", 'shared': frame})
+            message = decoder.feed(data)[0][1]['shared']
+            rows = reader.read(w, h, message['changed'])
+            message['rows'] = [ [y, sharedscreen.dump_row(*rows[y])]
+                for y in message['changed'] ]
+            elapsed += time.perf_counter() - start
+            size += len(data)
+            frames.append(message)
+    finally:
+        reader.close()
+        screen.close()
+    return elapsed, size, frames
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pmxterm.bench.shared",
+        description = "Screen frames as JSON or in shared memory.")
+    parser.add_argument('-s', metavar='<size>', dest='sizes', type=str,
+        default="80x24,200x60", help='Screen sizes, as WxH separated by commas'
+    )
+    parser.add_argument('-n', metavar='<frames>', dest='frames', type=int,
+        default=200, help='Frames per screen size'
+    )
+    parser.add_argument('-j', metavar='<file>', dest='json', type=str,
+        help='Write the results as JSON, "-" for the standard output'
+    )
+    args = parser.parse_args(argv)
+    if sharedscreen.shared_memory is None:
+        print("Shared memory is not available")
+        return 1
+
+    report = report_to(args.json)
+    results = []
+    for size in args.sizes.split(","):
+        w, h = [ int(value) for value in size.split("x") ]
+        json_elapsed, json_size, json_frames = measure_json(w, h, "tui", args.frames)
+        shared_elapsed, shared_size, shared_frames = measure_shared(w, h, "tui", args.frames)
+        same = [ frame['rows'] for frame in json_frames ] == \
+            [ frame['rows'] for frame in shared_frames ]
+        result = {
+            'size': size,
+            'frames': args.frames,
+            'json_ms': json_elapsed / args.frames * 1e3,
+            'json_bytes': json_size // args.frames,
+            'shared_ms': shared_elapsed / args.frames * 1e3,
+            'shared_bytes': shared_size // args.frames,
+            'same_rows': same
+        }
+        results.append(result)
+        report.write("%(size)8s  json %(json_ms)7.3f ms %(json_bytes)7d B  "
+            "shared %(shared_ms)7.3f ms %(shared_bytes)6d B  same rows: %(same_rows)s\n" % result)
+    write_json(results, args.json)
+    return 0 if all(result['same_rows'] for result in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
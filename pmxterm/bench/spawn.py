@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Latency of opening a tab: from the keepalive starting a session to the
+# first frame showing the prompt of its shell, with the command started
+# on demand and adopted from a pool of shells started ahead.
+# Usage: python -m pmxterm.bench.spawn [-n <samples>] [-c <cmd>]
+#            [-s <shells>] [-i <interval>] [-j <file>]
+
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+
+from . import BACKEND_PATH
+from .__main__ import percentiles, report_to, write_json
+from multiplexer import Multiplexer
+
+CLIENT = "bench"
+
+class Prompts(threading.Thread):
+    """Drains the notifications, signaling the first frame of the
+    session waited for with text on it"""
+    def __init__(self, notifications):
+        threading.Thread.__init__(self)
+        self.notifications = notifications
+        self.sid = None
+        self.shown = threading.Event()
+
+    def wait(self, sid, timeout):
+        self.shown.clear()
+        self.sid = sid
+        return self.shown.wait(timeout)
+
+    def run(self):
+        while True:
+            message = self.notifications.get()
+            if message is None:
+                break
+            payload = message.get('payload', {})
+            if payload.get('sid') != self.sid or 'screen' not in payload:
+                continue
+            for y, line in payload['screen'].get('rows', []):
+                if any(isinstance(text, str) and text.strip() for text in line):
+                    self.shown.set()
+                    break
+
+def measure(cmd, pool_size, count, interval):
+    notifications = queue.Queue()
+    prompts = Prompts(notifications)
+    prompts.start()
+    multiplexer = Multiplexer(notifications, cmd = cmd, timeout = 3600,
+        pool_size = pool_size)
+    samples = []
+    try:
+        # The pool fills up before the first tab
+        time.sleep(interval)
+        for i in range(count):
+            sid = "tab-%d" % i
+            start = time.perf_counter()
+            multiplexer.proc_keepalive(CLIENT, sid, 80, 24)
+            if prompts.wait(sid, 5.0):
+                samples.append(time.perf_counter() - start)
+            multiplexer.proc_bury(CLIENT, sid)
+            time.sleep(interval)
+    finally:
+        multiplexer.stop()
+        notifications.put(None)
+        prompts.join()
+    return samples
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m pmxterm.bench.spawn",
+        description = "Tab open to first prompt latency.")
+    parser.add_argument('-n', metavar='<samples>', dest='samples', type=int,
+        default=50, help='Tabs opened per mode'
+    )
+    parser.add_argument('-c', metavar='<cmd>', dest='cmd', type=str,
+        default=os.environ.get("SHELL", "/bin/sh"), help='Shell of the sessions'
+    )
+    parser.add_argument('-s', metavar='<shells>', dest='pool_size', type=int,
+        default=2, help='Shells started ahead in the pool mode'
+    )
+    parser.add_argument('-i', metavar='<interval>', dest='interval', type=float,
+        default=0.5, help='Seconds between tabs, for the pool to refill'
+    )
+    parser.add_argument('-j', metavar='<file>', dest='json', type=str,
+        help='Write the results as JSON, "-" for the standard output'
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, pool_size in (('exec', 0), ('pool', args.pool_size)):
+        samples = measure(args.cmd, pool_size, args.samples, args.interval)
+        results[name] = percentiles(samples)
+        results[name]['missed'] = args.samples - len(samples)
+
+    report = report_to(args.json)
+    for name in ('exec', 'pool'):
+        report.write("%-5s first prompt p50 %.3f p90 %.3f p99 %.3f max %.3f ms, %d missed\n" % (
+            name, results[name]['p50'], results[name]['p90'],
+            results[name]['p99'], results[name]['max'], results[name]['missed']))
+    write_json(results, args.json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,7 +8,9 @@ import time
 import json
 import ast
 import signal
+import socket
 import tempfile
+import array
 import functools
 
 if sys.version_info.major < 3:
@@ -21,6 +23,7 @@ except:
 
 from .session import Session
 from ..utils import encoding
+from ..backend import protocol
 
 LOCAL_BACKEND_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "backend", "main.py"))
 
@@ -41,6 +44,8 @@ class Backend(QtCore.QObject):
     started = QtCore.pyqtSignal()
     finished = QtCore.pyqtSignal(int)
     stateChanged = QtCore.pyqtSignal(int)
+    # Seconds the backend has to pass a pty once connected
+    HANDOFF_TIMEOUT = 5.0
     
     def __init__(self, name, parent=None):
         QtCore.QObject.__init__(self, parent)
@@ -51,6 +56,13 @@ class Backend(QtCore.QObject):
         self._address = None
         self.multiplexer = None
         self.notifier = None
+        # Commands are framed, with the encodings agreed once the
+        # backend answers the hello
+        self._encoder = protocol.Encoder([])
+        self._decoders = {}
+        # Unix socket the backend passes the ptys to, in direct mode
+        self.direct = None
+        self._directAddress = None
 
     def _set_state(self, state):
         self._state = state
@@ -93,29 +105,140 @@ class Backend(QtCore.QObject):
     def startMultiplexer(self, address):
         if self.protocol() == 'unix':
             self.multiplexer = QtNetwork.QLocalSocket(self)
-            self.multiplexer.connectToServer(address, QtCore.QIODevice.WriteOnly)
+            self.multiplexer.connectToServer(address, QtCore.QIODevice.ReadWrite)
         else:
             self.multiplexer = QtNetwork.QTcpSocket(self)
             address, port = address.split(':')
-            self.multiplexer.connectToHost(address, int(port), QtCore.QIODevice.WriteOnly)
+            self.multiplexer.connectToHost(address, int(port), QtCore.QIODevice.ReadWrite)
+        self._decoders[self.multiplexer] = protocol.Decoder()
+        self.multiplexer.readyRead.connect(functools.partial(self.socketReadyRead, self.multiplexer))
+        self.multiplexer.write(protocol.hello(self.capabilities()))
         
+    def capabilities(self):
+        # Screens in shared memory and ptys only for a backend on this host
+        return [ capability for capability in protocol.CAPABILITIES
+            if capability not in ('shm', 'direct') or self.protocol() == 'unix' ]
+
+    def sharedScreens(self):
+        return 'shm' in (self._encoder.capabilities or [])
+
+    def startDirect(self):
+        # A python socket, Qt does not take the fds passed
+        self._directAddress = tempfile.mktemp(prefix="pmx")
+        self.direct = socket.socket(socket.AF_UNIX)
+        self.direct.bind(self._directAddress)
+        self.direct.listen(socket.SOMAXCONN)
+        self.direct.setblocking(False)
+        self.directNotifier = QtCore.QSocketNotifier(self.direct.fileno(), QtCore.QSocketNotifier.Read, self)
+        self.directNotifier.activated.connect(self.on_direct_activated)
+
+    def stopDirect(self):
+        if self.direct is not None:
+            self.directNotifier.setEnabled(False)
+            self.direct.close()
+            os.unlink(self._directAddress)
+            self.direct = self._directAddress = None
+
+    def directAddress(self):
+        return self._directAddress
+
+    def on_direct_activated(self, fileno):
+        try:
+            connection, _ = self.direct.accept()
+        except (IOError, OSError):
+            return
+        # Read as it arrives, the GUI never waits for the backend
+        connection.setblocking(False)
+        handoff = {
+            'connection': connection,
+            'decoder': protocol.Decoder(),
+            'messages': [],
+            'fd': None,
+            'skip': 1
+        }
+        handoff['notifier'] = QtCore.QSocketNotifier(connection.fileno(), QtCore.QSocketNotifier.Read, self)
+        handoff['notifier'].activated.connect(functools.partial(self.on_handoff_activated, handoff))
+        handoff['timer'] = QtCore.QTimer(self)
+        handoff['timer'].setSingleShot(True)
+        handoff['timer'].timeout.connect(functools.partial(self.closeHandoff, handoff))
+        handoff['timer'].start(int(self.HANDOFF_TIMEOUT * 1000))
+
+    def on_handoff_activated(self, handoff, fileno):
+        connection = handoff['connection']
+        while True:
+            try:
+                data, ancdata, flags, address = connection.recvmsg(4096,
+                    socket.CMSG_SPACE(array.array('i').itemsize))
+            except (BlockingIOError, InterruptedError):
+                return
+            except (IOError, OSError):
+                break
+            for level, kind, cmsg in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds = array.array('i')
+                    fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % fds.itemsize])
+                    for fd in fds:
+                        if handoff['fd'] is None:
+                            handoff['fd'] = fd
+                        else:
+                            os.close(fd)
+            if not data:
+                break
+            # The fd comes with the first byte, the session after it
+            data, handoff['skip'] = data[handoff['skip']:], 0
+            try:
+                handoff['messages'].extend(handoff['decoder'].feed(data))
+            except ValueError:
+                break
+        fd = handoff['fd']
+        messages = handoff['messages']
+        handoff['fd'] = None
+        self.closeHandoff(handoff)
+        if fd is None:
+            return
+        for kind, message in messages:
+            if message is not None and message.get('sid') in self.sessions:
+                message['direct']['fd'] = fd
+                self.sessions[message['sid']].message(message)
+                break
+        else:
+            os.close(fd)
+
+    def closeHandoff(self, handoff):
+        handoff['timer'].stop()
+        handoff['notifier'].setEnabled(False)
+        handoff['notifier'].deleteLater()
+        handoff['timer'].deleteLater()
+        handoff['connection'].close()
+        if handoff['fd'] is not None:
+            os.close(handoff['fd'])
+            handoff['fd'] = None
+
     def execute(self, command, args=None):
         if not isinstance(args, (tuple, list)):
             args = [ args ]
         data = {"command": command, "args": args}
-        self.multiplexer.write(json.dumps(data).encode(encoding.FS_ENCODING))
+        self.multiplexer.write(self._encoder.encode(data))
         self.multiplexer.flush()
 
     def on_notifier_newConnection(self):
         connection = self.notifier.nextPendingConnection()
+        self._decoders[connection] = protocol.Decoder()
         connection.readyRead.connect(functools.partial(self.socketReadyRead, connection))
+        connection.disconnected.connect(functools.partial(self._decoders.pop, connection, None))
         
     def socketReadyRead(self, connection):
-        data = encoding.from_fs(connection.readAll().data())
-        message = json.loads(data)
-        sid = message['sid']
-        if sid in self.sessions:
-            self.sessions[sid].message(message)
+        messages = self._decoders[connection].feed(connection.readAll().data())
+        for kind, message in messages:
+            if kind == protocol.HELLO:
+                self._encoder = protocol.Encoder(protocol.agree(message, self.capabilities()))
+                if 'direct' in self._encoder.capabilities and self.direct is None:
+                    self.startDirect()
+                for session in self.sessions.values():
+                    session.share()
+                    session.direct()
+            elif message is not None and message.get('sid') in self.sessions:
+                self.sessions[message['sid']].message(message)
         
     def start(self):
         self.startMultiplexer(self.address())
@@ -125,6 +248,7 @@ class Backend(QtCore.QObject):
         
     def stop(self):
         self.execute("proc_buryall")
+        self.stopDirect()
         self._set_state(self.NotRunning)
         self.finished.emit(0)
 
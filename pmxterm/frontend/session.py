@@ -13,9 +13,18 @@ try:
 except:
     from PyQt4 import QtCore
 
+from ..backend import keyfilter
+from ..backend import sharedscreen
+
 class Session(QtCore.QObject):
+    # Seconds between the notices of typing sent to the backend while
+    # writing to the pty, below the time a session stays interactive
+    TYPED_INTERVAL = 0.5
+
     readyRead = QtCore.pyqtSignal()
-    screenReady = QtCore.pyqtSignal(list)
+    screenReady = QtCore.pyqtSignal(dict)
+    historyReady = QtCore.pyqtSignal(dict)
+    infoReady = QtCore.pyqtSignal(dict)
     finished = QtCore.pyqtSignal(int)
     
     def __init__(self, backend, width=80, height=24):
@@ -32,12 +41,47 @@ class Session(QtCore.QObject):
         self._started = False
         self._state = 'stop'
         self._pid = None
+        # Input kept while the backend asks to hold it, or until the pty
+        # asked for arrives
+        self._held = False
+        self._awaiting = False
+        self._pending = []
+        # Segment of the screen shared by a local backend
+        self._shared = None
+        # Pty passed by a local backend, the input is written to it
+        # translated with the keyboard modes of the last frame
+        self._direct = None
+        self._writer = None
+        self._output = bytearray()
+        self._keys = (False, False, False)
+        self._escape = False
+        self._typed = 0
         
     def message(self, message):
         self._state = message['state']
-        if self._state == 'alive':
+        if 'history' in message:
+            self.historyReady.emit(message['history'])
+        elif 'info' in message:
+            self.infoReady.emit(message['info'])
+        elif 'direct' in message:
+            if message['direct'] is not None:
+                self.setDirect(message['direct']['fd'], message['direct']['keys'])
+            self._awaiting = False
+            self.flushPending()
+        elif 'shared' in message:
+            frame = self.sharedFrame(message['shared'])
+            if frame is not None:
+                self._keys = tuple(frame.get('keys', self._keys))
+                self.screenReady.emit(frame)
+        elif 'input' in message:
+            self._held = message['input']['held']
+            self.flushPending()
+        elif self._state == 'alive':
+            self._keys = tuple(message['screen'].get('keys', self._keys))
             self.screenReady.emit(message['screen'])
         elif self._state == 'dead':
+            self._awaiting = False
+            self.closeDirect()
             self.finished.emit(0)
         else:
             self.readyRead.emit()
@@ -49,7 +93,9 @@ class Session(QtCore.QObject):
     def resize(self, width, height):
         self._width = width
         self._height = height
-        if self._started:
+        # A dead session is removed by the backend, a keepalive would
+        # start it again
+        if self._started and self._state != 'dead':
             self.keepalive()
 
     def start(self, *largs):
@@ -58,10 +104,98 @@ class Session(QtCore.QObject):
             args.extend(largs)
         self.backend.execute("proc_keepalive", args)
         self._started = True
+        self.share()
+        self.direct()
         return self._started
 
+    def share(self):
+        if self._started and self.backend.sharedScreens():
+            self.backend.execute("proc_share", [self._session_id])
+
+    def direct(self):
+        address = self.backend.directAddress()
+        if self._started and self._direct is None and address is not None \
+            and not self._awaiting:
+            # The input waits for the pty, the backend passes it once the
+            # input sent before is written
+            self._awaiting = True
+            self.backend.execute("proc_direct", [self._session_id, address])
+
+    def setDirect(self, fd, keys):
+        self.closeDirect()
+        self._direct = fd
+        self._keys = tuple(keys)
+
+    def closeDirect(self):
+        if self._writer is not None:
+            self._writer.setEnabled(False)
+            self._writer.deleteLater()
+            self._writer = None
+        if self._direct is not None:
+            os.close(self._direct)
+            self._direct = None
+        del self._output[:]
+
+    def writeDirect(self, data):
+        now = time.time()
+        if now - self._typed > self.TYPED_INTERVAL:
+            # The backend does not see this input, its output is read
+            # at once as it were
+            self._typed = now
+            self.backend.execute("proc_typed", [self._session_id])
+        data, self._escape = keyfilter.translate(data, self._keys, self._escape)
+        self._output += data.encode("utf-8")
+        self.drain()
+
+    def drain(self):
+        # The pty is non blocking, the backend made it so
+        while self._output and self._direct is not None:
+            try:
+                written = os.write(self._direct, self._output[:65536])
+            except BlockingIOError:
+                break
+            except (IOError, OSError):
+                # The process is gone, the backend says so
+                self.closeDirect()
+                return
+            del self._output[:written]
+        if self._output and self._writer is None:
+            self._writer = QtCore.QSocketNotifier(self._direct, QtCore.QSocketNotifier.Write, self)
+            self._writer.activated.connect(lambda fd: self.drain())
+        elif not self._output and self._writer is not None:
+            self._writer.setEnabled(False)
+            self._writer.deleteLater()
+            self._writer = None
+
+    def sharedFrame(self, shared):
+        # The frame with the rows changed read from the segment
+        if self._shared is None or self._shared.name != shared['name']:
+            if self._shared is not None:
+                self._shared.close()
+                self._shared = None
+            try:
+                self._shared = sharedscreen.SharedScreenReader(shared['name'])
+            except (IOError, OSError):
+                # A segment replaced after the frame was sent
+                self.share()
+                return None
+        w, h = shared['size']
+        rows = self._shared.read(w, h, shared['changed'])
+        if rows is None:
+            # Resized or busy, every row again on the next frame
+            self.share()
+            return None
+        frame = dict(shared)
+        del frame['name'], frame['changed']
+        frame['rows'] = [ [y, sharedscreen.dump_row(*rows[y])] for y in shared['changed'] ]
+        return frame
+
     def close(self):
         self.backend.execute("proc_bury", [self._session_id])
+        self.closeDirect()
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
     
     stop = close
 
@@ -75,8 +209,21 @@ class Session(QtCore.QObject):
         if self.is_alive():
             self.backend.execute("proc_dump", [self._session_id])
 
-    def write(self, data):
+    def history(self, start, count):
         if self.is_alive():
+            self.backend.execute("proc_history", [self._session_id, start, count])
+
+    def flushPending(self):
+        if not self._held and not self._awaiting and self._pending:
+            data, self._pending = "".join(self._pending), []
+            self.write(data)
+
+    def write(self, data):
+        if self._held or self._awaiting:
+            self._pending.append(data)
+        elif self._direct is not None:
+            self.writeDirect(data)
+        elif self.is_alive():
             self.backend.execute("proc_write", [self._session_id, data])
     
     def info(self):
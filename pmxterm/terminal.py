@@ -79,6 +79,7 @@ class TerminalWidget(QtWidgets.QWidget):
         self.session = session
         self.session.readyRead.connect(self.on_session_readyRead)
         self.session.screenReady.connect(self.on_session_screenReady)
+        self.session.historyReady.connect(self.on_session_historyReady)
         self.session.finished.connect(self.on_session_finished)
         
         # Scroll
@@ -94,9 +95,18 @@ class TerminalWidget(QtWidgets.QWidget):
         
         self._last_update = None
         self._screen = []
-        self._screen_history = []
+        # Scrollback lives in the backend, rows are fetched by pages
+        # and a few of them are cached here
+        self._history = (0, 0)
+        self._history_cache = {}
+        self._history_request = None
         self._history_index = 0
         self._history_lines = 1000
+        # Style table of the session, style ID to (fg, bg, flags), and
+        # the pen, brush and font of each style ID
+        self._styles = {}
+        self._styles_epoch = 0
+        self._styles_painter = {}
         self._text = []
         self._cursor_rect = None
         self._cursor_col = 0
@@ -116,14 +126,38 @@ class TerminalWidget(QtWidgets.QWidget):
         else:
             self.on_session_screenReady(self.session.dump())
 
-    def on_session_screenReady(self, data):
-        (self._cursor_col, self._cursor_row, scroll_up, scroll_down), screen = data
-        if scroll_up:
-            self.store_history(scroll_up, self._screen)
+    def on_session_screenReady(self, frame):
+        self.store_styles(frame['epoch'], frame['styles'])
+        self._cursor_col, self._cursor_row = frame['cursor']
+        self.store_history(*frame['history'])
+        # Apply the changed rows to the last frame
+        columns, rows = frame['size']
+        screen = self._screen[:rows]
+        screen.extend([ [] ] * (rows - len(screen)))
+        for row, line in frame['rows']:
+            screen[row] = line
         self._screen = screen
         self._update_cursor_rect()
         self.update()
         
+    def on_session_historyReady(self, page):
+        self._history_request = None
+        if page['epoch'] != self._styles_epoch:
+            # Styles were renumbered, the rows are refetched
+            self.update()
+            return
+        self.store_styles(page['epoch'], page['styles'])
+        cache = self._history_cache
+        for number, line in enumerate(page['rows'], page['start']):
+            cache[number] = line
+        if len(cache) > self._history_lines:
+            # Keep the rows around the view
+            start = self._history[0] + self._history_index - self._history_lines // 2
+            for number in list(cache.keys()):
+                if not start <= number < start + self._history_lines:
+                    del cache[number]
+        self.update()
+
     def on_scrollBar_valueChanged(self, value):
         self._history_index = value
         self.update()
@@ -132,6 +166,7 @@ class TerminalWidget(QtWidgets.QWidget):
     # ------------------ Colors
     def setColorScheme(self, scheme):
         self.scheme = scheme
+        self._styles_painter = {}
         self.update()
 
     def backgroundColor(self, index = None, attrs = constants.DEFAULTSGR):
@@ -139,6 +174,8 @@ class TerminalWidget(QtWidgets.QWidget):
             return self.scheme.background()
         if attrs & constants.SGR49:
             return self.scheme.background()
+        if index & constants.TRUECOLOR:
+            return QtGui.QColor((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
         return self.scheme.color(index)
          
     def foregroundColor(self, index = None, attrs = constants.DEFAULTSGR):
@@ -146,6 +183,8 @@ class TerminalWidget(QtWidgets.QWidget):
              return self.scheme.foreground()
         if attrs & constants.SGR39:
             return self.scheme.foreground(intense = bool(attrs & constants.SGR1))
+        if index & constants.TRUECOLOR:
+            return QtGui.QColor((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
         return self.scheme.color(index, intense = bool(attrs & constants.SGR1))
 
     def mapToStyle(self, foregroundIndex, backgroundIndex, attrs = constants.DEFAULTSGR):
@@ -175,6 +214,7 @@ class TerminalWidget(QtWidgets.QWidget):
 
     def setFont(self, font):
         QtWidgets.QWidget.setFont(self, font)
+        self._styles_painter = {}
         self._update_metrics()
         
     def focusNextPrevChild(self, next):
@@ -196,18 +236,58 @@ class TerminalWidget(QtWidgets.QWidget):
             return
         self.session.close()
 
-    def store_history(self, lines, screen):
-        self._screen_history.extend(screen[:lines])
-        self._history_index = len(self._screen_history)
-        
-        if self._history_index > self._history_lines:
-            index = self._history_index - self._history_lines
-            self._screen_history = self._screen_history[index:]
-            self._history_index = len(self._screen_history)
-
-        self.scrollBar.setMaximum(self._history_index)
+    def store_history(self, first, end):
+        if (first, end) == self._history:
+            return
+        following = self.scrollBar.maximum() == self._history_index
+        position = self._history[0] + self._history_index
+        self._history = (first, end)
+        for number in [ number for number in self._history_cache if number < first ]:
+            del self._history_cache[number]
+
+        self._history_index = following and end - first or max(position - first, 0)
+        self.scrollBar.setMaximum(end - first)
         self.scrollBar.setValue(self._history_index)
 
+    def store_styles(self, epoch, styles):
+        if epoch != self._styles_epoch:
+            self._styles = {}
+            self._styles_epoch = epoch
+            self._history_cache = {}
+        for attr, style in styles:
+            self._styles[attr] = style
+            self._styles_painter.pop(attr, None)
+
+    def painterStyle(self, attr):
+        try:
+            return self._styles_painter[attr]
+        except KeyError:
+            pass
+        foregroundColor, backgroundColor, font = self.mapToStyle(
+            *self._styles.get(attr, (None, None, constants.DEFAULTSGR)))
+        style = self._styles_painter[attr] = (
+            QtGui.QPen(foregroundColor), QtGui.QBrush(backgroundColor), font)
+        return style
+
+    def request_history(self, start, end):
+        # One page at a time, a screen more than needed
+        if self._history_request is None and self.is_alive():
+            start = max(start - len(self._screen), self._history[0])
+            self._history_request = (start, end - start + len(self._screen))
+            self.session.history(*self._history_request)
+
+    def _viewscreen(self):
+        first, end = self._history
+        start = first + self._history_index
+        stop = min(start + len(self._screen), end)
+        missing = [ number for number in range(start, stop)
+            if number not in self._history_cache ]
+        if missing:
+            self.request_history(missing[0], missing[-1] + 1)
+        viewscreen = [ self._history_cache.get(number, []) for number in range(start, stop) ]
+        viewscreen.extend(self._screen[:len(self._screen) - len(viewscreen)])
+        return viewscreen
+
     def _update_metrics(self):
         fm = self.fontMetrics()
         self._char_height = fm.height()
@@ -270,19 +350,13 @@ class TerminalWidget(QtWidgets.QWidget):
         y = 0
         text = []
         # Calculate viewscreen
-        viewscreen = (self._screen_history + self._screen)[self._history_index:self._history_index + len(self._screen)]
+        viewscreen = self._viewscreen()
         for row, line in enumerate(viewscreen):
             col = 0
             text_line = ""
             for item in line:
-                if isinstance(item, list):
-                    foreground_color_idx, background_color_idx, flags = item
-                    foregroundColor, backgroundColor, font = self.mapToStyle(
-                        foreground_color_idx, 
-                        background_color_idx, 
-                        flags)
-                    pen = QtGui.QPen(foregroundColor)
-                    brush = QtGui.QBrush(backgroundColor)
+                if isinstance(item, int):
+                    pen, brush, font = self.painterStyle(item)
                     painter_setFont(font)
                     painter_setPen(pen)
                 else:
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The backend modules import each other as top level modules
+BACKEND_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "pmxterm", "backend"))
+if BACKEND_PATH not in sys.path:
+    sys.path.insert(0, BACKEND_PATH)
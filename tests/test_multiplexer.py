@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+
+from multiplexer import Multiplexer
+
+def payloads(notifications, sid):
+    while not notifications.empty():
+        payload = notifications.get().get('payload', {})
+        if payload.get('sid') == sid:
+            yield payload
+
+def test_last_output_reaches_the_clients_before_the_death():
+    notifications = queue.Queue()
+    # One frame a second, the one with the last line is still scheduled
+    multiplexer = Multiplexer(notifications, frame_rate = 1)
+    try:
+        multiplexer.proc_keepalive("c", "s", 40, 5, [ "/bin/sh", "-c", "echo first; sleep 0.2; echo last" ])
+        deadline = time.time() + 5
+        while "s" in multiplexer.session and time.time() < deadline:
+            time.sleep(0.05)
+        states, rows = [], []
+        for payload in payloads(notifications, "s"):
+            states.append(payload['state'])
+            if 'screen' in payload:
+                rows.extend(line for y, line in payload['screen']['rows'])
+        assert states[-1] == 'dead'
+        assert any("last" in str(line) for line in rows)
+    finally:
+        multiplexer.stop()
+
+def test_held_input_is_notified_once_per_change():
+    notifications = queue.Queue()
+    multiplexer = Multiplexer(notifications)
+    multiplexer.WRITE_LIMIT = 64 * 1024
+    try:
+        # A program that reads nothing
+        multiplexer.proc_keepalive("c", "s", 40, 5, [ "/bin/sh", "-c", "stty raw -echo; sleep 30" ])
+        time.sleep(0.3)
+        chunk = "x" * 16 * 1024
+        refused = sum(not multiplexer.proc_write("c", "s", chunk) for _ in range(40))
+        assert refused > 1
+        holds = [ payload['input'] for payload in payloads(notifications, "s") if 'input' in payload ]
+        assert [ hold['held'] for hold in holds ] == [ True ]
+        assert holds[0]['dropped'] == len(chunk)
+        # Released once the queue is gone, with the rest of the bytes refused
+        multiplexer.session["s"]['output'] = bytearray()
+        multiplexer.proc_drain("s")
+        holds = [ payload['input'] for payload in payloads(notifications, "s") if 'input' in payload ]
+        assert holds == [ { 'held': False, 'pending': 0, 'dropped': (refused - 1) * len(chunk) } ]
+    finally:
+        multiplexer.stop()
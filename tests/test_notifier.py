@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import socket
+
+from multiplexer.reactor import Reactor
+import notifier
+
+def frame(kind, rows, number):
+    frame = { 'size': (80, 24), 'cursor': (0, 0), 'history': (0, 0),
+        'styles': [], 'epoch': 0, 'frame': number }
+    if kind == 'screen':
+        frame['rows'] = [ [ y, [ 0, "row %d" % y ] ] for y in rows ]
+    else:
+        frame['changed'] = list(rows)
+        frame['name'] = "psm_test"
+    return { 'sid': "s1", 'state': 'alive', kind: frame }
+
+class Stalled(object):
+    """Socket of a client that reads nothing"""
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+        self.reactor = Reactor()
+        self.channel = notifier.Channel(self.reactor, self.sock)
+        # Fills the socket buffer, the frames after it wait in their slot
+        self.channel.send({ 'sid': None, 'fill': "x" * (4 * 1024 * 1024) })
+
+    def pending(self):
+        return self.channel.frames["s1"]
+
+    def close(self):
+        self.channel.close(flush = False)
+        self.peer.close()
+        self.reactor.close()
+
+def test_frames_of_a_slow_client_are_merged():
+    client = Stalled()
+    try:
+        client.channel.send(frame('screen', [ 1, 2 ], 1))
+        client.channel.send(frame('screen', [ 2, 3 ], 2))
+        assert [ y for y, line in client.pending()['screen']['rows'] ] == [ 1, 2, 3 ]
+        assert client.channel.counters['merged'] == 1
+    finally:
+        client.close()
+
+def test_shared_frame_replaces_a_pending_screen_frame():
+    client = Stalled()
+    try:
+        client.channel.send(frame('screen', [ 1, 2 ], 1))
+        client.channel.send(frame('shared', range(24), 2))
+        assert 'screen' not in client.pending()
+        assert client.pending()['shared']['changed'] == list(range(24))
+        client.channel.send(frame('screen', [ 5 ], 3))
+        assert client.pending()['screen']['rows'] == [ [ 5, [ 0, "row 5" ] ] ]
+    finally:
+        client.close()
+
+class Recorder(object):
+    """Channel keeping the payloads sent"""
+    def __init__(self):
+        self.sent = []
+
+    def send(self, payload):
+        self.sent.append(payload)
+
+def test_stats_of_every_worker_are_added_up():
+    reactor = Reactor()
+    try:
+        workers = notifier.Notifier(reactor, 3)
+        channel = workers.channels[1] = Recorder()
+        for reads in (1, 2, 3):
+            workers.message({ 'cmd': 'stats', 'channel': 1,
+                'counters': { 'reads': reads, 'frames': 1 } })
+        assert channel.sent == [ { 'sid': None, 'stats': { 'reads': 6, 'frames': 3 } } ]
+    finally:
+        reactor.close()
+
+def run_until(reactor, done, timeout = 2.0):
+    deadline = reactor.time() + timeout
+    while not done() and reactor.time() < deadline:
+        reactor.run_once(0.05)
+    return done()
+
+def test_messages_wait_for_the_connection():
+    listener = socket.socket(socket.AF_INET)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    reactor = Reactor()
+    workers = notifier.Notifier(reactor)
+    try:
+        workers.message({ 'cmd': 'setup_channel', 'channel': 1,
+            'address': "127.0.0.1:%d" % listener.getsockname()[1] })
+        workers.message({ 'cmd': 'send', 'channel': 1, 'payload': { 'sid': None, 'ping': 1 } })
+        assert run_until(reactor, lambda: 1 in workers.channels)
+        conn, address = listener.accept()
+        assert conn.recv(4096) == b'{"sid": null, "ping": 1}'
+        conn.close()
+    finally:
+        workers.close()
+        reactor.close()
+        listener.close()
+
+def test_a_notifier_that_never_accepts_does_not_stall_the_others():
+    # A full backlog, the connections after it wait for the handshake
+    listener = socket.socket(socket.AF_INET)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    backlog = []
+    for _ in range(4):
+        sock = socket.socket(socket.AF_INET)
+        sock.setblocking(False)
+        sock.connect_ex(listener.getsockname())
+        backlog.append(sock)
+    reactor = Reactor()
+    workers = notifier.Notifier(reactor)
+    workers.CONNECT_TIMEOUT = 0.3
+    other = socket.socketpair()
+    try:
+        start = reactor.time()
+        workers.message({ 'cmd': 'setup_channel', 'channel': 1,
+            'address': list(listener.getsockname()) })
+        assert reactor.time() - start < 0.1
+        workers.channels[2] = notifier.Channel(reactor, other[0])
+        workers.message({ 'cmd': 'send', 'channel': 2, 'payload': { 'sid': None, 'ping': 2 } })
+        assert other[1].recv(4096) == b'{"sid": null, "ping": 2}'
+        assert run_until(reactor, lambda: not workers.connecting)
+        assert 1 not in workers.channels
+    finally:
+        workers.close()
+        reactor.close()
+        other[1].close()
+        for sock in backlog:
+            sock.close()
+        listener.close()
+
+def test_event_loop_notifier_connects_in_a_task():
+    import asyncio
+    from multiplexer.aio import AsyncNotifier
+
+    listener = socket.socket(socket.AF_INET)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    backlog = []
+    for _ in range(4):
+        sock = socket.socket(socket.AF_INET)
+        sock.setblocking(False)
+        sock.connect_ex(listener.getsockname())
+        backlog.append(sock)
+    loop = asyncio.new_event_loop()
+    workers = AsyncNotifier(loop)
+    workers.CONNECT_TIMEOUT = 0.3
+    accepting = socket.socket(socket.AF_INET)
+    accepting.bind(("127.0.0.1", 0))
+    accepting.listen(1)
+
+    async def scenario():
+        workers.message({ 'cmd': 'setup_channel', 'channel': 1,
+            'address': list(listener.getsockname()) })
+        workers.message({ 'cmd': 'setup_channel', 'channel': 2,
+            'address': "127.0.0.1:%d" % accepting.getsockname()[1] })
+        workers.message({ 'cmd': 'send', 'channel': 2, 'payload': { 'sid': None, 'ping': 2 } })
+        while 2 not in workers.channels:
+            await asyncio.sleep(0.01)
+        assert 1 in workers.connecting
+        while workers.connecting:
+            await asyncio.sleep(0.01)
+
+    try:
+        loop.run_until_complete(asyncio.wait_for(scenario(), 2))
+        assert 1 not in workers.channels
+        conn, address = accepting.accept()
+        assert conn.recv(4096) == b'{"sid": null, "ping": 2}'
+        conn.close()
+    finally:
+        workers.close()
+        loop.close()
+        accepting.close()
+        for sock in backlog:
+            sock.close()
+        listener.close()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+
+import pytest
+
+import protocol
+
+MESSAGES = [
+    { 'command': 'setup_channel', 'args': [ "/tmp/pmxchannel" ] },
+    { 'command': 'proc_write', 'args': [ "s1", "ls -la\r" ] },
+    { 'command': 'proc_write', 'args': [ "s1", "ñandú ✅\r" ] },
+    { 'command': 'proc_keepalive', 'args': [ "s1", 80, 24, "x" * 5000 ] },
+]
+
+def stream(capabilities):
+    encoder = protocol.Encoder(capabilities)
+    return b"".join(encoder.encode(message) for message in MESSAGES)
+
+def decode_all(data, sizes):
+    decoder = protocol.Decoder()
+    messages = []
+    start = 0
+    for size in sizes:
+        messages.extend(decoder.feed(data[start:start + size]))
+        start += size
+    messages.extend(decoder.feed(data[start:]))
+    return messages
+
+@pytest.mark.parametrize("capabilities", [ None, [], [ 'input', 'zlib' ] ])
+def test_coalesced_in_one_read(capabilities):
+    data = stream(capabilities)
+    assert [ message for kind, message in decode_all(data, []) ] == MESSAGES
+
+@pytest.mark.parametrize("capabilities", [ None, [ 'input', 'zlib' ] ])
+def test_split_in_reads_of_one_byte(capabilities):
+    data = stream(capabilities)
+    assert [ message for kind, message in decode_all(data, [ 1 ] * len(data)) ] == MESSAGES
+
+@pytest.mark.parametrize("capabilities", [ None, [ 'input', 'zlib' ] ])
+def test_split_at_every_offset(capabilities):
+    data = stream(capabilities)
+    for offset in range(1, len(data)):
+        messages = decode_all(data, [ offset ])
+        assert [ message for kind, message in messages ] == MESSAGES, offset
+
+def test_hello_is_answered_and_channels_get_capabilities():
+    sent = []
+    connection = protocol.Connection(sent.append)
+    commands = connection.feed(protocol.hello([ 'zlib' ]) +
+        protocol.Encoder([]).encode({ 'command': 'setup_channel', 'args': [ "/tmp/c" ] }))
+    assert commands == [ { 'command': 'setup_channel', 'args': [ "/tmp/c", [ 'zlib' ] ] } ]
+    kind, message = protocol.Decoder().feed(sent[0])[0]
+    assert kind == protocol.HELLO and message['version'] == protocol.VERSION
+
+@pytest.mark.parametrize("frame", [
+    protocol.pack(protocol.JSON, b"[1, 2]"),
+    protocol.pack(protocol.JSON, b"{\"command\": "),
+    protocol.pack(protocol.JSON, b"\xff\xfe"),
+    protocol.pack(protocol.INPUT, b"x"),
+    protocol.pack(protocol.INPUT, b"\x00\x09s1"),
+    protocol.pack(protocol.ZJSON, b"not zlib"),
+    protocol.pack(protocol.ZJSON, zlib.compress(b"42")),
+])
+def test_bad_bodies_raise_value_error(frame):
+    with pytest.raises(ValueError):
+        protocol.Decoder().feed(frame)
+
+def test_frames_over_the_limit_raise_value_error():
+    with pytest.raises(ValueError):
+        protocol.Decoder().feed(protocol.HEADER.pack(protocol.MAX_MESSAGE + 1, protocol.JSON))
+
+def test_unknown_types_are_skipped():
+    data = protocol.pack(200, b"later") + protocol.Encoder([]).encode(MESSAGES[0])
+    assert protocol.Decoder().feed(data) == [ (200, None), (protocol.JSON, MESSAGES[0]) ]
+
+def test_json_clients_with_garbage_raise_value_error():
+    decoder = protocol.Decoder()
+    assert decoder.feed(json.dumps(MESSAGES[0]).encode("utf-8")) == [ (protocol.JSON, MESSAGES[0]) ]
+    with pytest.raises(ValueError):
+        decoder.feed(b" [1, 2]")
+
+def test_json_clients_are_capped(monkeypatch):
+    monkeypatch.setattr(protocol, "MAX_MESSAGE", 1024)
+    decoder = protocol.Decoder()
+    decoder.feed(b'{"args": "' + b"x" * 1000)
+    with pytest.raises(ValueError):
+        decoder.feed(b"x" * 100)
+
+@pytest.mark.parametrize("message", [
+    { 'args': [] },
+    { 'command': 'proc_write' },
+    { 'command': 1, 'args': [] },
+    { 'command': 'proc_write', 'args': "s1" },
+])
+def test_messages_that_are_not_commands_raise_value_error(message):
+    connection = protocol.Connection(lambda data: None)
+    with pytest.raises(ValueError):
+        connection.feed(protocol.Encoder([]).encode(message))
+
+@pytest.mark.skipif('direct' not in protocol.CAPABILITIES, reason = "no fd passing")
+def test_ptys_are_only_passed_to_local_clients():
+    direct = protocol.Encoder([]).encode({ 'command': 'proc_direct', 'args': [ "s1", "/tmp/d" ] })
+    for local in (True, False):
+        sent = []
+        connection = protocol.Connection(sent.append, local)
+        connection.feed(protocol.hello())
+        offered = protocol.Decoder().feed(sent[0])[0][1]['capabilities']
+        assert ('direct' in offered) == ('direct' in connection.capabilities) == local
+        if local:
+            assert connection.feed(direct)[0]['command'] == 'proc_direct'
+        else:
+            with pytest.raises(ValueError):
+                connection.feed(direct)
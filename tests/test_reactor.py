@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from multiplexer.reactor import Reactor
+
+def test_a_raising_callback_does_not_stop_the_loop(capsys):
+    reactor = Reactor()
+    r, w = os.pipe()
+    ran = []
+
+    def fail():
+        raise RuntimeError("callback failed")
+
+    def read():
+        ran.append(os.read(r, 1))
+
+    try:
+        reactor.add_reader(r, fail)
+        reactor.call_later(0, fail)
+        os.write(w, b"x")
+        reactor.run_once(0.1)
+        assert "callback failed" in capsys.readouterr().err
+        reactor.add_reader(r, read)
+        reactor.call_later(0, ran.append, "timer")
+        reactor.run_once(0.1)
+        assert sorted(ran, key = str) == [ b"x", "timer" ]
+    finally:
+        reactor.close()
+        os.close(r)
+        os.close(w)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import constants
+from vt100 import Terminal
+
+# Controls, CSI with parameters and intermediates, SGR with 256 and
+# 24-bit colors, OSC and DCS strings, and multibyte UTF-8 text
+SEQUENCES = ("\x1b]0;title ñ\x07plain \x1b[1;31mred\x1b[0m \x1b[38;5;200mpink"
+    "\x1b[38;2;10;20;30mrgb\x1b[m\r\n\x1b[2;5Hñandú 中文 \x1b[3Gx\x1b[K"
+    "\x1b[?25l\x1b[?7h\x1bP$qr\x1b\\\x1b7\x1b[10;1Hbottom\x1b8\tafter tab"
+    "\x1b[1A\x1b[2C\x1b[@\x1b[2P\x1b[1X\r\n\x1b(0lqk\x1b(B\x1b[4h!\x1b[4l").encode("utf-8")
+
+def state(term):
+    return term.dump(), term.title, term.read()
+
+def written(chunks, w = 40, h = 12):
+    term = Terminal(w, h)
+    for chunk in chunks:
+        term.write(chunk)
+    return state(term)
+
+def test_sequences_split_at_every_offset():
+    whole = written([ SEQUENCES ])
+    for offset in range(1, len(SEQUENCES)):
+        assert written([ SEQUENCES[:offset], SEQUENCES[offset:] ]) == whole, offset
+
+def test_sequences_in_reads_of_one_byte():
+    whole = written([ SEQUENCES ])
+    assert written([ SEQUENCES[i:i + 1] for i in range(len(SEQUENCES)) ]) == whole
+
+def test_title_and_report():
+    (cursor, screen), title, reply = written([ SEQUENCES ])
+    assert title == "title ñ"
+    # DECRQSS of the scroll region
+    assert reply == b"\x1bP1$r1;12r\x1b\\"
+
+def test_wide_characters_take_two_cells():
+    for text in ("✅", "❌", "⚡", "⭐", "⌚", "ᄀ", "中", "\U0001f600"):
+        term = Terminal(20, 2)
+        term.write(("a" + text + "b").encode("utf-8"))
+        assert term.cx == 4, text
+        assert term.screen[0][0][1:4].tolist() == [ ord(text), Terminal.CONTINUATION, ord("b") ]
+
+def test_narrow_characters_take_one_cell():
+    term = Terminal(20, 2)
+    term.write("añ→€█✓".encode("utf-8"))
+    assert term.cx == 6
+
+def test_deleted_lines_stay_out_of_history():
+    term = Terminal(20, 4)
+    term.write(b"top\x1b[H\x1b[2M")
+    assert term.history_end == 0 and not term.history
+
+def test_lines_scrolled_off_go_to_history():
+    term = Terminal(20, 4)
+    term.write(b"one\r\ntwo\r\nthree\r\nfour\r\nfive\x1bD\x1b[S")
+    assert term.history_end == 3
+    assert [ chr(row[0][0]) for row in term.history ] == [ "o", "t", "t" ]
+
+def test_clients_dumping_the_same_changes_share_a_frame():
+    term = Terminal(20, 4)
+    first, second = term.dump_delta(0), term.dump_delta(0)
+    assert first['frame'] == second['frame'] and first['rows'] == second['rows']
+    assert term.dump_delta(first['frame'])['rows'] == []
+    term.write(b"\x1b[3Habc")
+    frames = [ term.dump_delta(first['frame']), term.dump_delta(second['frame']) ]
+    assert [ frame['rows'] for frame in frames ] == [ [ [2, term.dump_line(2)] ] ] * 2
+    assert frames[0]['frame'] == frames[1]['frame'] == first['frame'] + 1
+
+def test_tab_stops_and_saved_cursor_without_a_save():
+    term = Terminal(40, 4)
+    term.write(b"\x1b[u\x1b[3G\x1bH\x1b[9G\x1b[g")
+    assert term.tab_stops == [ 0, 2, 16, 24, 32 ]
+    term.write(b"\x1b[2;5H\x1b[s\x1b[H\x1b[u")
+    assert (term.cx, term.cy) == (4, 1)
+
+@pytest.mark.parametrize("sequence, style", [
+    # 256 colors
+    (b"\x1b[38;5;196m", (196, 0, constants.SGR49)),
+    (b"\x1b[48;5;21m", (0, 21, constants.SGR39)),
+    (b"\x1b[48:5:100m", (0, 100, constants.SGR39)),
+    (b"\x1b[38:5:9;1m", (9, 0, constants.SGR49 | constants.SGR1)),
+    # 24-bit, with and without the color space of the colon form
+    (b"\x1b[38;2;1;2;3m", (constants.TRUECOLOR | 0x010203, 0, constants.SGR49)),
+    (b"\x1b[38:2::10:20:30m", (constants.TRUECOLOR | 0x0a141e, 0, constants.SGR49)),
+    (b"\x1b[38:2:10:20:30m", (constants.TRUECOLOR | 0x0a141e, 0, constants.SGR49)),
+    (b"\x1b[38;2;1;2;3;4m", (constants.TRUECOLOR | 0x010203, 0, constants.SGR49 | constants.SGR4)),
+    (b"\x1b[1;38;5;9;48;2;0;0;255;4m",
+        (9, constants.TRUECOLOR | 0xff, constants.SGR1 | constants.SGR4)),
+    # Truncated or out of range colors change nothing
+    (b"\x1b[38;2;1;2m", (0, 0, constants.DEFAULTSGR)),
+    (b"\x1b[1;38;2;1;2m", (0, 0, constants.DEFAULTSGR | constants.SGR1)),
+    (b"\x1b[38;5;300m", (0, 0, constants.DEFAULTSGR)),
+    (b"\x1b[38;5;9m\x1b[39m", (9, 0, constants.DEFAULTSGR)),
+])
+def test_sgr_colors(sequence, style):
+    term = Terminal(10, 2)
+    term.write(sequence)
+    assert term.styles[term.attr] == style
+
+def test_unused_styles_are_dropped_and_renumbered():
+    term = Terminal(10, 2)
+    term.style_limit = 4
+    term.write(b"\x1b[38;5;1mA\x1b[38;5;2mB\x1b[38;5;3m\r\x1b[0mZ")
+    since = term.dump_delta()['frame']
+    assert term.style_epoch == 0 and len(term.styles) == 4
+    # The table is full, the next style collects the ones not in use
+    term.write(b"\x1b[38;5;4m")
+    assert term.style_epoch == 1
+    assert (1, 0, constants.SGR49) not in term.styles
+    chars, attrs = term.screen[0]
+    assert term.styles[attrs[1]] == (2, 0, constants.SGR49)
+    assert term.styles[term.attr] == (4, 0, constants.SGR49)
+    assert term.style_ids == dict((style, attr) for attr, style in enumerate(term.styles))
+    # Clients get every row and style again with the new epoch
+    frame = term.dump_delta(since)
+    assert frame['epoch'] == 1
+    assert [ y for y, line in frame['rows'] ] == [ 0, 1 ]
+    assert [ attr for attr, style in frame['styles'] ] == list(range(len(term.styles)))
+
+def lines(count):
+    return "\r\n".join("l%d" % n for n in range(count)).encode("ascii")
+
+def test_history_is_paged():
+    term = Terminal(10, 2)
+    term.write(lines(10))
+    assert term.dump_history(0, 0)['history'] == (0, 8)
+    page = term.dump_history(2, 3)
+    assert page['start'] == 2
+    assert [ "l%d" % n in str(row) for n, row in zip(range(2, 5), page['rows']) ] == [ True ] * 3
+    assert len(term.dump_history(6, 10)['rows']) == 2
+    assert term.dump_history(-5, 1)['start'] == 0
+    assert term.dump_history(8, 5)['rows'] == []
+
+def test_history_is_trimmed_to_its_byte_budget():
+    row_bytes = 10 * 8 + Terminal.HISTORY_ROW_OVERHEAD
+    term = Terminal(10, 2, history_bytes = 3 * row_bytes)
+    term.write(lines(10))
+    assert len(term.history) == 3 and term.history_size <= term.history_bytes
+    page = term.dump_history(0, 10)
+    assert page['history'] == (5, 8) and page['start'] == 5
+    assert "l5" in str(page['rows'][0]) and "l7" in str(page['rows'][-1])